@@ -146,6 +146,5 @@ STATIC_ROOT = f"{BASE_DIR}/static"
 MEDIA_URL = "media/"
 MEDIA_ROOT = f"{BASE_DIR}/media/"
 
-CRONJOBS = [
-    ("*/1 * * * *", "botreader.services.services.new_messages_getter_scheduler"),
-]
+# Updates are consumed by the long-running `manage.py consume_updates` command.
+CRONJOBS = []
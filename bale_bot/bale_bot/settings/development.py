@@ -22,9 +22,89 @@ DATABASES = {"default": env.db(var="DEFAULT_DATABASE_URL")}
 TOKEN = env("BALE_BOT_TOKEN")
 BALE_BOT_BASE_URL = 'https://tapi.bale.ai/{token}/'.format(token=TOKEN)
 
+# pooled HTTP client shared by every Bale API call, timeouts are in seconds
+BALE_API_POOL_SIZE = env.int("BALE_API_POOL_SIZE", default=10)
+BALE_API_CONNECT_TIMEOUT = env.float("BALE_API_CONNECT_TIMEOUT", default=5)
+BALE_API_READ_TIMEOUT = env.float("BALE_API_READ_TIMEOUT", default=30)
+BALE_API_RETRIES = env.int("BALE_API_RETRIES", default=3)
+BALE_API_BACKOFF_BASE = env.float("BALE_API_BACKOFF_BASE", default=0.5)
+BALE_API_BACKOFF_MAX = env.float("BALE_API_BACKOFF_MAX", default=5)
+BALE_API_CIRCUIT_FAILURE_THRESHOLD = env.int("BALE_API_CIRCUIT_FAILURE_THRESHOLD", default=5)
+BALE_API_CIRCUIT_RESET_TIMEOUT = env.float("BALE_API_CIRCUIT_RESET_TIMEOUT", default=30)
+# read timeout of the single attempt made while an update is being handled
+BALE_API_INLINE_READ_TIMEOUT = env.float("BALE_API_INLINE_READ_TIMEOUT", default=5)
+
+# operations that failed every retry are queued and retried later
+BOTREADER_RETRY_QUEUE_MAX_ATTEMPTS = env.int("BOTREADER_RETRY_QUEUE_MAX_ATTEMPTS", default=8)
+BOTREADER_RETRY_QUEUE_BACKOFF_BASE = env.float("BOTREADER_RETRY_QUEUE_BACKOFF_BASE", default=30)
+BOTREADER_RETRY_QUEUE_BACKOFF_MAX = env.float("BOTREADER_RETRY_QUEUE_BACKOFF_MAX", default=3600)
+# a worker must finish an operation within the lease, or it is run again
+BOTREADER_RETRY_QUEUE_LEASE_SECONDS = env.int("BOTREADER_RETRY_QUEUE_LEASE_SECONDS", default=300)
+
+# outbox sender limits, in messages per second
+BOTREADER_OUTBOX_GLOBAL_RATE = env.float("BOTREADER_OUTBOX_GLOBAL_RATE", default=20)
+BOTREADER_OUTBOX_GLOBAL_BURST = env.int("BOTREADER_OUTBOX_GLOBAL_BURST", default=30)
+BOTREADER_OUTBOX_CHAT_RATE = env.float("BOTREADER_OUTBOX_CHAT_RATE", default=1)
+BOTREADER_OUTBOX_CHAT_BURST = env.int("BOTREADER_OUTBOX_CHAT_BURST", default=5)
+BOTREADER_OUTBOX_MAX_ATTEMPTS = env.int("BOTREADER_OUTBOX_MAX_ATTEMPTS", default=5)
+# a failed message is sent again with exponential backoff, in seconds
+BOTREADER_OUTBOX_BACKOFF_BASE = env.float("BOTREADER_OUTBOX_BACKOFF_BASE", default=5)
+BOTREADER_OUTBOX_BACKOFF_MAX = env.float("BOTREADER_OUTBOX_BACKOFF_MAX", default=600)
+# a sender must finish a batch within the lease, or its messages are sent again
+BOTREADER_OUTBOX_LEASE_SECONDS = env.int("BOTREADER_OUTBOX_LEASE_SECONDS", default=300)
+
+# PostgreSQL has no Persian text search configuration, "simple" only
+# lowercases words. The triggers are created with the value set at migrate time.
+BOTREADER_SEARCH_CONFIG = env("BOTREADER_SEARCH_CONFIG", default="simple")
+
+# the text message changelist opens on the messages of the last days, older
+# ones are listed when "All time" is picked
+BOTREADER_HOT_WINDOW_DAYS = env.int("BOTREADER_HOT_WINDOW_DAYS", default=30)
+# admin changelists count filtered rows up to this limit and estimate whole
+# tables above it from the planner statistics
+BOTREADER_ADMIN_COUNT_LIMIT = env.int("BOTREADER_ADMIN_COUNT_LIMIT", default=10000)
+# rows fetched per round trip by the streaming exports of the API
+BOTREADER_EXPORT_CHUNK_SIZE = env.int("BOTREADER_EXPORT_CHUNK_SIZE", default=2000)
+
 WELCOME_MESSAGE = env("WELCOME_MESSAGE")
 LEGAL_HOURS_FOR_MESSAGE_FORWARDING= env("LEGAL_HOURS_FOR_MESSAGE_FORWARDING")
 
+BALE_UPDATES_LONG_POLL_TIMEOUT = env.int("BALE_UPDATES_LONG_POLL_TIMEOUT", default=30)
+BALE_UPDATES_BATCH_SIZE = env.int("BALE_UPDATES_BATCH_SIZE", default=100)
+BALE_WEBHOOK_SECRET = env("BALE_WEBHOOK_SECRET", default="")
+
+# an inbox update claimed longer ago than the lease is taken over by another
+# worker, one failing this many times is marked FAILED
+BOTREADER_INBOX_LEASE_SECONDS = env.int("BOTREADER_INBOX_LEASE_SECONDS", default=300)
+BOTREADER_INBOX_MAX_ATTEMPTS = env.int("BOTREADER_INBOX_MAX_ATTEMPTS", default=5)
+# a failed update is claimed again with exponential backoff, in seconds
+BOTREADER_INBOX_BACKOFF_BASE = env.float("BOTREADER_INBOX_BACKOFF_BASE", default=10)
+BOTREADER_INBOX_BACKOFF_MAX = env.float("BOTREADER_INBOX_BACKOFF_MAX", default=600)
+# processed updates and performed side effects are pruned after this many days
+BOTREADER_INBOX_RETENTION_DAYS = env.int("BOTREADER_INBOX_RETENTION_DAYS", default=7)
+
+# type changes of more messages than the sync limit are queued as a
+# classification job and applied chunk by chunk by process_classification_jobs
+BOTREADER_CLASSIFICATION_SYNC_LIMIT = env.int("BOTREADER_CLASSIFICATION_SYNC_LIMIT", default=1000)
+BOTREADER_CLASSIFICATION_CHUNK_SIZE = env.int("BOTREADER_CLASSIFICATION_CHUNK_SIZE", default=1000)
+BOTREADER_CLASSIFICATION_LEASE_SECONDS = env.int("BOTREADER_CLASSIFICATION_LEASE_SECONDS", default=300)
+BOTREADER_CLASSIFICATION_MAX_ATTEMPTS = env.int("BOTREADER_CLASSIFICATION_MAX_ATTEMPTS", default=5)
+
+# in-process user and chat cache, a TTL of 0 keeps entries until evicted
+BOTREADER_CACHE_SIZE = env.int("BOTREADER_CACHE_SIZE", default=2048)
+BOTREADER_CACHE_TTL = env.int("BOTREADER_CACHE_TTL", default=3600)
+BOTREADER_ADMIN_CACHE_TTL = env.int("BOTREADER_ADMIN_CACHE_TTL", default=600)
+
+# handler and Bale API instrumentation. Every process writes its metrics to
+# BOTREADER_METRICS_DIR, /botreader/metrics/ serves them to Prometheus with
+# BOTREADER_METRICS_TOKEN as bearer token and is disabled while it is empty.
+BOTREADER_METRICS_ENABLED = env.bool("BOTREADER_METRICS_ENABLED", default=True)
+BOTREADER_METRICS_DIR = env("BOTREADER_METRICS_DIR", default="")
+BOTREADER_METRICS_FLUSH_INTERVAL = env.float("BOTREADER_METRICS_FLUSH_INTERVAL", default=10)
+BOTREADER_METRICS_TOKEN = env("BOTREADER_METRICS_TOKEN", default="")
+# log one line per handler call
+BOTREADER_METRICS_LOG = env.bool("BOTREADER_METRICS_LOG", default=False)
+
 
 LOGGING = {
     "version": 1,
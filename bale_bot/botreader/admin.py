@@ -1,9 +1,17 @@
+import io
+from datetime import timedelta
+
 from django.contrib import admin
 from django.contrib import messages
 from django.contrib.admin.helpers import ActionForm
-from django.urls import reverse
-from django.db.models import Count, Q
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.db.models import F
+from django.db.models.functions import Substr
 from django import forms
+from django.utils import timezone
 from django.utils.html import format_html
 from adminfilters.filters import (
     AutoCompleteFilter,
@@ -11,7 +19,12 @@ from adminfilters.filters import (
     ChoicesFieldComboFilter,
 )
 from adminfilters.mixin import AdminFiltersMixin
-from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from bale_bot.settings import (
+    BOTREADER_CLASSIFICATION_SYNC_LIMIT,
+    BOTREADER_HOT_WINDOW_DAYS,
+    BOTREADER_SEARCH_CONFIG,
+)
 from .models import (
     TextMessage,
     User,
@@ -19,13 +32,51 @@ from .models import (
     Membership,
     GeneratedAnswer,
     ArchivedTextMessage,
+    UserMessageStats,
+    ChatActivityRollup,
+    ClassificationJob,
+)
+from .services.archive_import import (
+    FORMATS,
+    get_format,
+    import_archived_messages,
+    iter_records,
+)
+from .services.hashtags import (
+    get_top_hashtags,
+    refresh_hashtag_counts,
+    update_hashtag_counts,
 )
+from .services.chat_activity import refresh_chat_activity_on_commit
+from .services.classification import (
+    create_classification_job_for_queryset,
+    set_text_messages_type,
+)
+from .services.message_stats import refresh_user_message_stats
+from .pagination import KeysetPaginationMixin
 from django_admin_inline_paginator.admin import TabularInlinePaginated
 from import_export import resources
 from import_export.admin import ImportMixin
 from import_export.forms import ImportForm, ConfirmImportForm
 
 
+class FullTextSearchMixin:
+    # Searches the stored, GIN indexed search_vector column instead of
+    # parsing the text of every row on each search.
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        query = SearchQuery(
+            search_term, search_type="websearch", config=BOTREADER_SEARCH_CONFIG
+        )
+        rank = SearchRank(F("search_vector"), query)
+        queryset = (
+            queryset.filter(search_vector=query).annotate(rank=rank).order_by("-rank")
+        )
+        return queryset, False
+
+
 class ChatMembersInline(TabularInlinePaginated):
     model = Membership
     per_page = 20
@@ -35,7 +86,7 @@ class ChatMembersInline(TabularInlinePaginated):
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
-        return queryset.filter(exited=False)
+        return queryset.filter(exited=False).select_related("member")
 
 
 @admin.register(Chat)
@@ -72,8 +123,62 @@ class ChatModelAdmin(admin.ModelAdmin):
         return False
 
 
+@admin.register(ChatActivityRollup)
+class ChatActivityRollupModelAdmin(AdminFiltersMixin, admin.ModelAdmin):
+    list_display = (
+        "period_start",
+        "granularity",
+        "chat",
+        "messages_count",
+        "entries_count",
+        "exits_count",
+        "unique_senders_count",
+    )
+    list_filter = (
+        ("chat", AutoCompleteFilter),
+        "granularity",
+    )
+    list_select_related = ("chat",)
+    date_hierarchy = "period_start"
+    ordering = ("-period_start",)
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ClassificationJob)
+class ClassificationJobModelAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "type",
+        "status",
+        "processed",
+        "total",
+        "updated",
+        "created_at",
+        "finished_at",
+    )
+    list_filter = ("status",)
+    ordering = ("-created_at",)
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(User)
-class UserModelAdmin(AdminFiltersMixin, admin.ModelAdmin):
+class UserModelAdmin(KeysetPaginationMixin, AdminFiltersMixin, admin.ModelAdmin):
     search_fields = ("name", "username", "first_name", "last_name", "mobile")
     list_display = (
         "display_name",
@@ -88,6 +193,8 @@ class UserModelAdmin(AdminFiltersMixin, admin.ModelAdmin):
         ("type", ChoicesFieldComboFilter),
     )
     list_editable = ("type",)
+    list_select_related = ("message_stats",)
+    ordering = ("-uid",)
     empty_value_display = "----"
     readonly_fields = ("uid", "name", "username")
     fieldsets = [
@@ -114,55 +221,43 @@ class UserModelAdmin(AdminFiltersMixin, admin.ModelAdmin):
         (None, {"fields": ("type",)}),
     ]
 
-    def get_queryset(self, request):
-        queryset = (
-            super()
-            .get_queryset(request)
-            .prefetch_related("textmessages")
-            .annotate(textmessages_count=Count("textmessages"))
-            .annotate(
-                replymessages_count=Count(
-                    "textmessages", filter=Q(textmessages__reply__isnull=False)
-                )
-            )
-            .annotate(
-                questions_count=Count(
-                    "textmessages", filter=Q(textmessages__type="QUESTION")
-                )
-            )
-            .annotate(
-                answers_and_suggestions_count=Count(
-                    "textmessages",
-                    filter=Q(textmessages__type="ANSWER")
-                    | Q(textmessages__type="SUGGESTION"),
-                )
-            )
-        )
-        return queryset
-
     @admin.display(description="Name", ordering="name")
     def display_name(self, obj):
         name = f"{obj.name}@{obj.username}" if obj.username else obj.name
         return name
 
-    @admin.display(description="Messages Count", ordering="textmessages_count")
+    def get_message_stats(self, obj):
+        # users without messages have no stats row yet
+        try:
+            return obj.message_stats
+        except UserMessageStats.DoesNotExist:
+            return UserMessageStats(user=obj)
+
+    @admin.display(
+        description="Messages Count", ordering="message_stats__messages_count"
+    )
     def display_messages_count(self, obj):
-        return obj.textmessages.count()
+        return self.get_message_stats(obj).messages_count
 
-    @admin.display(description="Reply Messages Count", ordering="replymessages_count")
+    @admin.display(
+        description="Reply Messages Count",
+        ordering="message_stats__reply_messages_count",
+    )
     def display_reply_messages_count(self, obj):
-        return obj.textmessages.filter(reply__isnull=False).count()
+        return self.get_message_stats(obj).reply_messages_count
 
-    @admin.display(description="Questions Count", ordering="questions_count")
+    @admin.display(
+        description="Questions Count", ordering="message_stats__questions_count"
+    )
     def display_questions_count(self, obj):
-        return obj.textmessages.filter(type="QUESTION").count()
+        return self.get_message_stats(obj).questions_count
 
     @admin.display(
         description="Answers and Suggestions Count",
-        ordering="answers_and_suggestions_count",
+        ordering="message_stats__answers_and_suggestions_count",
     )
     def display_answers_and_suggestions_count(self, obj):
-        return obj.textmessages.filter(Q(type="ANSWER") | Q(type="SUGGESTION")).count()
+        return self.get_message_stats(obj).answers_and_suggestions_count
 
     def has_add_permission(self, request, obj=None):
         return False
@@ -186,17 +281,57 @@ class TextMessageTypeForm(ActionForm):
     type = forms.ChoiceField(choices=TextMessage.TEXT_MESSAGE_TYPE)
 
 
+class RecentDateListFilter(admin.SimpleListFilter):
+    # Lists the messages of the last BOTREADER_HOT_WINDOW_DAYS days unless
+    # "All time" is picked, so the changelist and its count only scan the
+    # recent end of the date index.
+    title = "date"
+    parameter_name = "period"
+
+    def lookups(self, request, model_admin):
+        return (("all", "All time"),)
+
+    def queryset(self, request, queryset):
+        if self.value() == "all":
+            return queryset
+        return queryset.filter(
+            date__gte=timezone.now() - timedelta(days=BOTREADER_HOT_WINDOW_DAYS)
+        )
+
+    def choices(self, changelist):
+        yield {
+            "selected": self.value() is None,
+            "query_string": changelist.get_query_string(remove=[self.parameter_name]),
+            "display": "Last {days} days".format(days=BOTREADER_HOT_WINDOW_DAYS),
+        }
+        yield {
+            "selected": self.value() == "all",
+            "query_string": changelist.get_query_string(
+                {self.parameter_name: "all"}
+            ),
+            "display": "All time",
+        }
+
+
+# characters of a message text shown in the changelist
+TEXT_PREVIEW_LENGTH = 200
+
+
 @admin.register(TextMessage)
-class TextMessageModelAdmin(AdminFiltersMixin, admin.ModelAdmin):
+class TextMessageModelAdmin(
+    KeysetPaginationMixin, FullTextSearchMixin, AdminFiltersMixin, admin.ModelAdmin
+):
     list_display = ("text_message_link", "date", "type", "sender", "chat")
     search_fields = ("text",)
     list_filter = (
         ("chat", AutoCompleteFilter),
         ("sender", AutoCompleteFilter),
         ("type", ChoicesFieldComboFilter),
+        RecentDateListFilter,
         DjangoLookupFilter,
     )
     list_editable = ("type",)
+    list_select_related = ("sender", "chat")
     empty_value_display = "----"
     fieldsets = [
         (None, {"fields": (("chat", "sender"),)}),
@@ -204,7 +339,7 @@ class TextMessageModelAdmin(AdminFiltersMixin, admin.ModelAdmin):
         (None, {"fields": ("reply",)}),
     ]
     readonly_fields = ("id", "message_id", "chat", "sender", "text", "date", "reply")
-    ordering = ("-date", "sender", "chat")
+    ordering = ("-date", "-id")
 
     action_form = TextMessageTypeForm
 
@@ -214,37 +349,68 @@ class TextMessageModelAdmin(AdminFiltersMixin, admin.ModelAdmin):
         GeneratedAnswerTabularInline,
     ]
 
+    def changelist_view(self, request, extra_context=None):
+        # only on a plain listing, not after an action or a list edit
+        if (
+            request.method == "GET"
+            and RecentDateListFilter.parameter_name not in request.GET
+        ):
+            self.message_user(
+                request,
+                f"Only messages of the last {BOTREADER_HOT_WINDOW_DAYS} days are "
+                'listed, pick "All time" in the date filter to list older ones.',
+                messages.INFO,
+            )
+        return super().changelist_view(request, extra_context)
+
     @admin.action(permissions=["change"], description="Set Text Message Type")
     def set_text_message_type(self, request, queryset):
         type = request.POST.get("type", "")
-        queryset.update(type=type)
+        sync_limit = BOTREADER_CLASSIFICATION_SYNC_LIMIT
+        if queryset.order_by()[: sync_limit + 1].count() > sync_limit:
+            # too many to change within the request, a worker applies them
+            job = create_classification_job_for_queryset(type, queryset)
+            self.message_user(
+                request,
+                f"{job.total} text messages are queued for classification "
+                f"as job {job.pk}.",
+                messages.SUCCESS,
+            )
+            return
+        updated = set_text_messages_type(queryset, type)
         self.message_user(
             request,
-            f"{queryset.count()} text message was changed successfully.",
+            f"{updated} text message was changed successfully.",
             messages.SUCCESS,
         )
 
     @admin.display(description="Text")
     def text_message_link(self, obj):
         url = reverse("admin:botreader_textmessage_change", args=(obj.id,))
-        return format_html("<a target='{}' href='{}'>{}</a>", "_blank", url, obj.text)
+        text = obj.text_preview
+        if len(text) == TEXT_PREVIEW_LENGTH:
+            text += " ..."
+        return format_html("<a target='{}' href='{}'>{}</a>", "_blank", url, text)
 
     def get_queryset(self, request):
-        return super().get_queryset(request)
+        queryset = super().get_queryset(request)
+        # the changelist only shows the start of each text, the whole text
+        # is not read from the table
+        if request.resolver_match and request.resolver_match.url_name == (
+            "{app_label}_{model_name}_changelist".format(
+                app_label=self.opts.app_label, model_name=self.opts.model_name
+            )
+        ):
+            queryset = queryset.annotate(
+                text_preview=Substr("text", 1, TEXT_PREVIEW_LENGTH)
+            ).defer("text")
+        return queryset
 
-    def get_search_results(self, request, queryset, search_term):
-        if not search_term:
-            return super().get_search_results(request, queryset, search_term)
-        query = SearchQuery(search_term, search_type="websearch")
-        vector = SearchVector("text")
-        rank = SearchRank(vector, query)
-        queryset = (
-            queryset.annotate(search=vector)
-            .annotate(rank=rank)
-            .filter(search=query)
-            .order_by("-rank")
-        )
-        return queryset, False
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if "type" in form.changed_data:
+            refresh_user_message_stats([obj.sender_id])
+            refresh_chat_activity_on_commit([(obj.chat_id, obj.date)])
 
     def has_add_permission(self, request, obj=None):
         return False
@@ -264,6 +430,88 @@ class ArchivedTextMessageConfirmImportForm(ConfirmImportForm):
     chat_id = forms.CharField()
 
 
+class ArchivedTextMessageBulkImportForm(forms.Form):
+    file = forms.FileField()
+    chat_id = forms.CharField()
+    format = forms.ChoiceField(
+        choices=[("", "From the file extension")]
+        + [(format, format) for format in FORMATS],
+        required=False,
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if "file" in cleaned_data and not cleaned_data.get("format"):
+            try:
+                cleaned_data["format"] = get_format(cleaned_data["file"].name)
+            except ValueError as e:
+                raise forms.ValidationError(str(e))
+        return cleaned_data
+
+
+class HashtagListFilter(admin.ListFilter):
+    # Filters on several hashtags at once, messages carrying all of them by
+    # default or any of them with hashtags_match=any. Both lookups are
+    # served by the GIN index on hashtags.
+    title = "hashtags"
+    parameter_name = "hashtags"
+    match_parameter_name = "hashtags_match"
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        self.hashtags = get_selected_hashtags(params.pop(self.parameter_name, ""))
+        self.match_any = params.pop(self.match_parameter_name, "") == "any"
+        # the chat filter already took its parameter out of params
+        self.top_hashtags = get_top_hashtags(
+            request.GET.get("chat_id__exact"), limit=20
+        )
+
+    def has_output(self):
+        return bool(self.top_hashtags or self.hashtags)
+
+    def expected_parameters(self):
+        return [self.parameter_name, self.match_parameter_name]
+
+    def queryset(self, request, queryset):
+        if not self.hashtags:
+            return queryset
+        if self.match_any:
+            return queryset.filter(hashtags__overlap=self.hashtags)
+        return queryset.filter(hashtags__contains=self.hashtags)
+
+    def choices(self, changelist):
+        yield {
+            "selected": not self.hashtags,
+            "query_string": changelist.get_query_string(
+                remove=self.expected_parameters()
+            ),
+            "display": "All",
+        }
+        for hashtag, count in self.top_hashtags:
+            hashtags = toggle_hashtag(self.hashtags, hashtag)
+            if hashtags:
+                query_string = changelist.get_query_string(
+                    {self.parameter_name: ",".join(hashtags)}
+                )
+            else:
+                query_string = changelist.get_query_string(remove=[self.parameter_name])
+            yield {
+                "selected": hashtag in self.hashtags,
+                "query_string": query_string,
+                "display": f"{hashtag} ({count})",
+            }
+
+
+def get_selected_hashtags(value):
+    return [hashtag for hashtag in value.split(",") if hashtag]
+
+
+def toggle_hashtag(hashtags, hashtag):
+    if hashtag in hashtags:
+        return [selected for selected in hashtags if selected != hashtag]
+    return [*hashtags, hashtag]
+
+
 class ArchivedTextMessageResource(resources.ModelResource):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -273,21 +521,26 @@ class ArchivedTextMessageResource(resources.ModelResource):
         row["chat_id"] = self.chat_id
         return super().before_import_row(row, row_number, **kwargs)
 
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        super().after_import(dataset, result, using_transactions, dry_run, **kwargs)
+        if not dry_run:
+            refresh_hashtag_counts([self.chat_id])
+
     class Meta:
         model = ArchivedTextMessage
         fields = ("sid", "chat_id", "text", "hashtags")
-        import_id_fields = ("sid",)
+        import_id_fields = ("sid", "chat_id")
         skip_unchanged = True
         report_skipped = True
 
 
 @admin.register(ArchivedTextMessage)
-class ArchivedTextMessageModelAdmin(ImportMixin, admin.ModelAdmin):
+class ArchivedTextMessageModelAdmin(FullTextSearchMixin, ImportMixin, admin.ModelAdmin):
     list_display = ("sid", "text", "hashtags")
-    search_fields = ("text", "hashtags")
+    search_fields = ("text",)
     readonly_fields = ("sid", "chat_id", "text")
     list_editable = ("hashtags",)
-    list_filter = ("chat_id",)
+    list_filter = ("chat_id", HashtagListFilter)
     fieldsets = [
         (None, {"fields": (("sid", "chat_id"),)}),
         (None, {"fields": ("text",)}),
@@ -297,6 +550,109 @@ class ArchivedTextMessageModelAdmin(ImportMixin, admin.ModelAdmin):
     resource_class = ArchivedTextMessageResource
     import_form_class = ArchivedTextMessageImportForm
     confirm_form_class = ArchivedTextMessageConfirmImportForm
+    change_list_template = "admin/botreader/archivedtextmessage/change_list.html"
+
+    def get_urls(self):
+        return [
+            path(
+                "bulk-import/",
+                self.admin_site.admin_view(self.bulk_import_view),
+                name="botreader_archivedtextmessage_bulk_import",
+            ),
+        ] + super().get_urls()
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context["has_bulk_import_permission"] = self.has_change_permission(
+            request
+        )
+        extra_context["tag_cloud"] = self.get_tag_cloud(request)
+        return super().changelist_view(request, extra_context)
+
+    def get_tag_cloud(self, request):
+        # The most used hashtags of the filtered chat read from the facet
+        # table, sized by count, each link adds or removes the hashtag from
+        # the hashtags filter.
+        top_hashtags = get_top_hashtags(request.GET.get("chat_id__exact"))
+        if not top_hashtags:
+            return []
+        selected = get_selected_hashtags(
+            request.GET.get(HashtagListFilter.parameter_name, "")
+        )
+        most = top_hashtags[0][1]
+        tag_cloud = []
+        for hashtag, count in sorted(top_hashtags):
+            params = request.GET.copy()
+            params.pop("p", None)
+            hashtags = toggle_hashtag(selected, hashtag)
+            if hashtags:
+                params[HashtagListFilter.parameter_name] = ",".join(hashtags)
+            else:
+                params.pop(HashtagListFilter.parameter_name, None)
+            tag_cloud.append(
+                {
+                    "hashtag": hashtag,
+                    "count": count,
+                    "selected": hashtag in selected,
+                    # font size between 100% and 200% of the text
+                    "size": 100 + round(100 * count / most),
+                    "query_string": "?" + params.urlencode(),
+                }
+            )
+        return tag_cloud
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if "hashtags" in form.changed_data:
+            update_hashtag_counts(
+                obj.chat_id, form.initial.get("hashtags"), obj.hashtags
+            )
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        refresh_hashtag_counts([obj.chat_id])
+
+    def delete_queryset(self, request, queryset):
+        chat_ids = set(queryset.order_by().values_list("chat_id", flat=True))
+        super().delete_queryset(request, queryset)
+        refresh_hashtag_counts(chat_ids)
+
+    def bulk_import_view(self, request):
+        # Streams the uploaded export into the table in chunks, unlike the
+        # import above which previews every row before saving it.
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        form = ArchivedTextMessageBulkImportForm(
+            request.POST or None, request.FILES or None
+        )
+        if request.method == "POST" and form.is_valid():
+            file = io.TextIOWrapper(
+                form.cleaned_data["file"].file, encoding="utf-8", newline=""
+            )
+            try:
+                imported = import_archived_messages(
+                    iter_records(file, form.cleaned_data["format"]),
+                    form.cleaned_data["chat_id"],
+                )
+            except ValueError as e:
+                # chunks committed before the error stay imported
+                self.message_user(request, f"Import failed: {e}", messages.ERROR)
+            else:
+                self.message_user(
+                    request,
+                    f"{imported} archived messages were imported successfully.",
+                    messages.SUCCESS,
+                )
+                return redirect("admin:botreader_archivedtextmessage_changelist")
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "title": "Bulk import",
+            "form": form,
+        }
+        return TemplateResponse(
+            request, "admin/botreader/archivedtextmessage/bulk_import.html", context
+        )
 
     def get_confirm_form_initial(self, request, import_form):
         initial = super().get_confirm_form_initial(request, import_form)
@@ -311,20 +667,6 @@ class ArchivedTextMessageModelAdmin(ImportMixin, admin.ModelAdmin):
             kwargs.update({"chat_id": chat_id})
         return kwargs
 
-    def get_search_results(self, request, queryset, search_term):
-        if not search_term:
-            return super().get_search_results(request, queryset, search_term)
-        query = SearchQuery(search_term, search_type="websearch")
-        vector = SearchVector("text")
-        rank = SearchRank(vector, query)
-        queryset = (
-            queryset.annotate(search=vector)
-            .annotate(rank=rank)
-            .filter(search=query)
-            .order_by("-rank")
-        )
-        return queryset, False
-
     def has_add_permission(self, request, obj=None):
         return False
 
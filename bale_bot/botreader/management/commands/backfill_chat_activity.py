@@ -0,0 +1,68 @@
+"""
+Django command to rebuild the chat activity rollups from stored messages and events.
+"""
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from botreader.models import ChatActivityRollup, TextMessage
+from botreader.services.chat_activity import get_period_start, rebuild_chat_activity
+
+
+class Command(BaseCommand):
+    """Django command to backfill the chat activity rollups."""
+
+    help = "Rebuild the hourly and daily chat activity rollups day by day."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            help="First day to rebuild, YYYY-MM-DD. Defaults to the first message.",
+        )
+        parser.add_argument(
+            "--until",
+            help="Last day to rebuild, YYYY-MM-DD. Defaults to the last message.",
+        )
+        parser.add_argument("--chat", type=int, action="append", dest="chat_ids")
+        parser.add_argument(
+            "--chunk-days",
+            type=int,
+            default=7,
+            help="Days rebuilt per query, bounds the rows read at once.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        dates = TextMessage.objects.aggregate(first=Min("date"), last=Max("date"))
+        since = self.get_day(options["since"], dates["first"])
+        until = self.get_day(options["until"], dates["last"])
+        if since is None or until is None:
+            self.stdout.write("There are no messages to backfill.")
+            return
+
+        chunk = timedelta(days=options["chunk_days"])
+        until += timedelta(days=1)
+        start = since
+        rollups = 0
+        while start < until:
+            end = min(start + chunk, until)
+            for granularity in ChatActivityRollup.Granularity:
+                rollups += rebuild_chat_activity(
+                    granularity, start, end, chat_ids=options["chat_ids"]
+                )
+            self.stdout.write(f"Rebuilt {start.date()} to {end.date()}")
+            start = end
+        self.stdout.write(self.style.SUCCESS(f"{rollups} rollups rebuilt."))
+
+    def get_day(self, value, default):
+        if value is None:
+            if default is None:
+                return None
+            return get_period_start(default, ChatActivityRollup.Granularity.DAY)
+        try:
+            day = datetime.strptime(value, "%Y-%m-%d").date()
+        except ValueError:
+            raise CommandError(f"Invalid day [{value}], expected YYYY-MM-DD.")
+        return timezone.make_aware(datetime.combine(day, time.min))
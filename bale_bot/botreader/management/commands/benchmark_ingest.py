@@ -0,0 +1,280 @@
+"""
+Django command to benchmark update ingestion against a local fake Bale API.
+"""
+
+import datetime
+import json
+import math
+import time
+import tracemalloc
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from bale_bot.settings import LEGAL_HOURS_FOR_MESSAGE_FORWARDING
+from botreader.management.fake_bale_api import (
+    DATE_SPAN,
+    DEFAULT_MIX,
+    UPDATE_KINDS,
+    FakeBaleApi,
+    serve,
+)
+from botreader.models import OutboundMessage
+from botreader.services import (
+    add_member_in_chat,
+    helpers,
+    outbox,
+    remove_msg_from_chat,
+    services,
+)
+
+# metrics where a higher value is a regression, compared with --baseline
+LOWER_IS_BETTER = (
+    "queries_per_update",
+    "page_p50",
+    "page_p99",
+    "peak_memory_bytes",
+    "outbox_queries_per_message",
+)
+HIGHER_IS_BETTER = ("updates_per_second", "outbox_messages_per_second")
+# the outbox is sent unthrottled, the rate limits would only measure sleeps
+UNLIMITED_RATE = 1_000_000
+
+
+def get_pinned_start():
+    # Updates are dated on a fixed day from the hour legal forwarding ends,
+    # so every run moderates the same forwards whatever the wall clock says.
+    end_legal_hour = int(LEGAL_HOURS_FOR_MESSAGE_FORWARDING.split("-")[1])
+    start = datetime.datetime(2024, 1, 1, end_legal_hour % 24)
+    return int(start.timestamp())
+
+
+def get_pinned_datetime(now):
+    class PinnedDatetime(datetime.datetime):
+        # the clock of the services, so joins are as recent as in production
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime.fromtimestamp(now, tz)
+
+    return PinnedDatetime
+
+
+def parse_pairs(value, cast):
+    # "text=60,reply=15" -> {"text": 60, "reply": 15}
+    pairs = {}
+    for pair in value.split(","):
+        key, _, number = pair.partition("=")
+        try:
+            pairs[key.strip()] = cast(number)
+        except ValueError:
+            raise CommandError(f"Invalid value [{pair}], expected name=number.")
+    return pairs
+
+
+def percentile(values, percent):
+    # nearest-rank percentile
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+class Command(BaseCommand):
+    """Django command to measure get_new_messages_and_save on synthetic updates."""
+
+    help = (
+        "Ingest synthetic updates from a local fake Bale API into a throwaway test "
+        "database and report throughput, queries, page latency and memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--updates", type=int, default=5000)
+        parser.add_argument("--page-size", type=int, default=100)
+        parser.add_argument(
+            "--mix",
+            default=",".join(
+                f"{kind}={weight}" for kind, weight in DEFAULT_MIX.items()
+            ),
+            help=f"Relative weights of the update kinds {', '.join(UPDATE_KINDS)}.",
+        )
+        parser.add_argument(
+            "--latency",
+            default="",
+            help="Seconds the fake API waits per method, like sendMessage=0.05,"
+            "deletemessage=0.05,getChatAdministrators=0.1,getupdates=0.01.",
+        )
+        parser.add_argument("--chats", type=int, default=20)
+        parser.add_argument("--users", type=int, default=500)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument(
+            "--baseline",
+            help="JSON results of an earlier run, fails when a metric got worse "
+            "by more than --tolerance.",
+        )
+        parser.add_argument("--tolerance", type=float, default=0.1)
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        mix = parse_pairs(options["mix"], int)
+        unknown_kinds = set(mix) - set(UPDATE_KINDS)
+        if unknown_kinds:
+            raise CommandError(f"Unknown update kinds {sorted(unknown_kinds)}.")
+        latency = parse_pairs(options["latency"], float) if options["latency"] else {}
+        fake_bale_api = FakeBaleApi(
+            options["updates"],
+            mix=mix,
+            chats=options["chats"],
+            users=options["users"],
+            latency=latency,
+            seed=options["seed"],
+            started_at=get_pinned_start(),
+        )
+
+        # the benchmark commits like production does, so it runs in its own
+        # database which is dropped afterwards
+        old_database_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        server, base_url = serve(fake_bale_api)
+        try:
+            with override_settings(BALE_BOT_BASE_URL=base_url):
+                results = self.run_benchmark(options, fake_bale_api.started_at)
+        finally:
+            server.shutdown()
+            server.server_close()
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+        results["options"] = {
+            key: options[key]
+            for key in ("updates", "page_size", "chats", "users", "seed")
+        }
+        results["options"].update(mix=mix, latency=latency)
+        results["api_calls"] = dict(fake_bale_api.calls)
+        self.write_results(results)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(results, file, indent=2)
+        if options["baseline"]:
+            self.compare(results, options["baseline"], options["tolerance"])
+
+    def run_benchmark(self, options, started_at):
+        helpers.user_cache.clear()
+        helpers.chat_cache.clear()
+        remove_msg_from_chat.admin_cache.clear()
+        page_latencies = []
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            # CaptureQueriesContext keeps at most 9000 queries, a counter
+            # stays exact on long runs
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        save_updates_page = services.save_updates_page
+
+        def timed_save_updates_page(update, result):
+            started_at = time.perf_counter()
+            save_updates_page(update, result)
+            page_latencies.append(time.perf_counter() - started_at)
+
+        tracemalloc.start()
+        try:
+            with connection.execute_wrapper(count_query), mock.patch.object(
+                services, "save_updates_page", timed_save_updates_page
+            ), mock.patch.object(
+                add_member_in_chat,
+                "datetime",
+                get_pinned_datetime(started_at + DATE_SPAN),
+            ):
+                ingest_started_at = time.perf_counter()
+                services.get_new_messages_and_save(batch_size=options["page_size"])
+                elapsed = time.perf_counter() - ingest_started_at
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # the welcome messages queued by joins are sent through the outbox
+        ingest_queries = queries
+        with connection.execute_wrapper(count_query), mock.patch.multiple(
+            outbox,
+            BOTREADER_OUTBOX_GLOBAL_RATE=UNLIMITED_RATE,
+            BOTREADER_OUTBOX_GLOBAL_BURST=UNLIMITED_RATE,
+            BOTREADER_OUTBOX_CHAT_RATE=UNLIMITED_RATE,
+            BOTREADER_OUTBOX_CHAT_BURST=UNLIMITED_RATE,
+        ):
+            outbox_started_at = time.perf_counter()
+            while outbox.send_outbox_batch(options["page_size"]):
+                pass
+            outbox_elapsed = time.perf_counter() - outbox_started_at
+        outbox_queries = queries - ingest_queries
+        sent = OutboundMessage.objects.filter(status=outbox.SENT_STATE).count()
+
+        updates = options["updates"]
+        return {
+            "finished_at": timezone.now().isoformat(),
+            "updates": updates,
+            "pages": len(page_latencies),
+            "seconds": round(elapsed, 3),
+            "updates_per_second": round(updates / elapsed, 1) if elapsed else 0,
+            "queries": ingest_queries,
+            "queries_per_update": (
+                round(ingest_queries / updates, 2) if updates else 0
+            ),
+            "page_p50": round(percentile(page_latencies, 50), 4),
+            "page_p99": round(percentile(page_latencies, 99), 4),
+            "peak_memory_bytes": peak_memory,
+            "outbox_messages": sent,
+            "outbox_seconds": round(outbox_elapsed, 3),
+            "outbox_messages_per_second": (
+                round(sent / outbox_elapsed, 1) if outbox_elapsed else 0
+            ),
+            "outbox_queries_per_message": (
+                round(outbox_queries / sent, 2) if sent else 0
+            ),
+        }
+
+    def write_results(self, results):
+        self.stdout.write(
+            "{updates} updates in {pages} pages, {seconds}s, {updates_per_second} "
+            "updates/s".format(**results)
+        )
+        self.stdout.write(
+            "{queries} queries, {queries_per_update} per update".format(**results)
+        )
+        self.stdout.write(
+            "page latency p50 {page_p50}s, p99 {page_p99}s".format(**results)
+        )
+        self.stdout.write(
+            "peak traced memory {:.1f} MiB".format(results["peak_memory_bytes"] / 2**20)
+        )
+        self.stdout.write(
+            "{outbox_messages} outbox messages sent in {outbox_seconds}s, "
+            "{outbox_messages_per_second} messages/s, {outbox_queries_per_message} "
+            "queries per message".format(**results)
+        )
+        self.stdout.write(f"Bale API calls {results['api_calls']}")
+
+    def compare(self, results, baseline_path, tolerance):
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+        regressions = []
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            before, after = baseline.get(metric), results[metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            self.stdout.write(f"{metric}: {before} -> {after} ({change:+.1%})")
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append(metric)
+        if regressions:
+            raise CommandError(
+                f"Regressed beyond {tolerance:.0%}: {', '.join(regressions)}"
+            )
+        self.stdout.write(self.style.SUCCESS("No regression against the baseline."))
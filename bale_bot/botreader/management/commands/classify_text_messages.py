@@ -0,0 +1,119 @@
+"""
+Django command to set the type of text messages in bulk.
+"""
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bale_bot.settings import BOTREADER_CLASSIFICATION_CHUNK_SIZE
+from botreader.models import ClassificationJob
+from botreader.services.classification import (
+    TEXT_MESSAGE_TYPES,
+    ClassificationError,
+    claim_classification_job,
+    create_classification_job,
+    run_classification_job,
+)
+
+
+class Command(BaseCommand):
+    """Django command to queue a classification job."""
+
+    help = (
+        "Queue a job setting the type of the given text messages, or of those "
+        "matching the filters, for process_classification_jobs. With --run the "
+        "job is applied right away."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("type", choices=TEXT_MESSAGE_TYPES)
+        parser.add_argument(
+            "--ids-file",
+            help="File listing the ids of the messages to classify, one per line.",
+        )
+        parser.add_argument("--chat", type=int, action="append")
+        parser.add_argument("--sender", type=int, action="append")
+        parser.add_argument(
+            "--from-type",
+            choices=TEXT_MESSAGE_TYPES,
+            action="append",
+            help="Only classify messages of this type.",
+        )
+        parser.add_argument("--since", help="ISO 8601 datetime, inclusive.")
+        parser.add_argument("--until", help="ISO 8601 datetime, exclusive.")
+        parser.add_argument(
+            "--run",
+            action="store_true",
+            help="Apply the job in this process instead of leaving it to a worker.",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=BOTREADER_CLASSIFICATION_CHUNK_SIZE
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        message_ids = None
+        if options["ids_file"]:
+            message_ids = self.read_ids(options["ids_file"])
+        filters = {
+            name: options[option]
+            for name, option in (
+                ("chat", "chat"),
+                ("sender", "sender"),
+                ("type", "from_type"),
+                ("since", "since"),
+                ("until", "until"),
+            )
+            if options[option] is not None
+        }
+        try:
+            job = create_classification_job(
+                options["type"], message_ids=message_ids, filters=filters
+            )
+        except (ClassificationError, ValueError) as e:
+            raise CommandError(e)
+        self.stdout.write(f"Classification job {job.pk} queued.")
+        if not options["run"]:
+            return
+
+        claimed = claim_classification_job(job_id=job.pk)
+        if claimed is None:
+            raise CommandError(
+                f"Job {job.pk} was claimed by process_classification_jobs first."
+            )
+        run_classification_job(
+            claimed,
+            options["chunk_size"],
+            on_progress=lambda job: self.stdout.write(
+                f"{job.processed}/{job.total} messages processed, "
+                f"{job.updated} changed"
+            ),
+        )
+        job = ClassificationJob.objects.get(pk=job.pk)
+        if job.status != "DONE":
+            raise CommandError(
+                f"Job {job.pk} stopped as {job.status}: {job.last_error}"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{job.updated} of {job.processed} messages changed type."
+            )
+        )
+
+    def read_ids(self, path):
+        message_ids = []
+        try:
+            with open(path) as file:
+                for number, line in enumerate(file, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        message_ids.append(uuid.UUID(line.strip()))
+                    except ValueError:
+                        raise CommandError(
+                            f"Invalid message id [{line.strip()}] on line {number} "
+                            f"of {path}."
+                        )
+        except OSError as e:
+            raise CommandError(e)
+        return message_ids
@@ -0,0 +1,53 @@
+"""
+Django command to long-poll Bale for new updates and save them as they arrive.
+"""
+import logging
+
+from django.conf import settings
+
+from botreader.management.worker import WorkerCommand
+from botreader.services.helpers import cache_stats
+from botreader.services.services import poll_new_messages_and_save
+
+logger = logging.getLogger(__name__)
+
+
+class Command(WorkerCommand):
+    """Django command to run the long-polling update consumer."""
+
+    help = "Long-poll getupdates in a loop until SIGTERM or SIGINT is received."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=settings.BALE_UPDATES_LONG_POLL_TIMEOUT,
+            help="Seconds the Bale server holds each getupdates call open.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.BALE_UPDATES_BATCH_SIZE,
+            help="Maximum number of updates fetched and committed per page.",
+        )
+        parser.add_argument(
+            "--error-delay",
+            type=float,
+            default=5,
+            help="Seconds to wait before polling again after a failure.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        self.install_signal_handlers()
+        self.stdout.write("Consuming updates...")
+        # the long poll itself waits for new updates, so there is no idle delay
+        self.run_loop(
+            lambda: poll_new_messages_and_save(
+                options["timeout"], options["batch_size"]
+            ),
+            idle_delay=0,
+            error_delay=options["error_delay"],
+        )
+        logger.info("User and chat cache stats: %s", cache_stats())
+        self.stdout.write(self.style.SUCCESS("Update consumer stopped."))
@@ -0,0 +1,53 @@
+"""
+Django command to import a channel export into the archived text messages.
+"""
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from botreader.services.archive_import import (
+    FORMATS,
+    ArchiveImportError,
+    get_format,
+    import_archived_messages,
+    iter_records,
+)
+
+
+class Command(BaseCommand):
+    """Django command to stream an export file into ArchivedTextMessage."""
+
+    help = (
+        "Upsert the records of a CSV, JSON array or NDJSON export, keyed on sid "
+        "and chat id, in chunks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--chat-id", required=True)
+        parser.add_argument(
+            "--format", choices=FORMATS, help="Defaults to the file extension."
+        )
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        try:
+            format = options["format"] or get_format(options["path"])
+            with open(options["path"], encoding="utf-8", newline="") as file:
+                imported = import_archived_messages(
+                    iter_records(file, format),
+                    options["chat_id"],
+                    batch_size=options["batch_size"],
+                    progress=self.write_progress,
+                )
+        except ArchiveImportError as e:
+            raise CommandError(f"Invalid export: {e}")
+        except (OSError, UnicodeDecodeError, json.JSONDecodeError, csv.Error) as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(f"{imported} records imported."))
+
+    def write_progress(self, read, elapsed):
+        throughput = read / elapsed if elapsed else 0
+        self.stdout.write(f"{read} records in {elapsed:.1f}s ({throughput:.0f}/s)")
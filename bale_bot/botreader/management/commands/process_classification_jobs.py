@@ -0,0 +1,35 @@
+"""
+Django command to run queued text message classification jobs.
+"""
+from bale_bot.settings import BOTREADER_CLASSIFICATION_CHUNK_SIZE
+from botreader.management.worker import WorkerCommand
+from botreader.services.classification import process_classification_jobs
+
+
+class Command(WorkerCommand):
+    """Django command to run the classification job worker."""
+
+    help = "Apply queued classification jobs until SIGTERM or SIGINT is received."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size", type=int, default=BOTREADER_CLASSIFICATION_CHUNK_SIZE
+        )
+        parser.add_argument(
+            "--idle-delay",
+            type=float,
+            default=5,
+            help="Seconds to sleep when no job is queued.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        self.install_signal_handlers()
+        self.stdout.write("Processing classification jobs...")
+        self.run_loop(
+            lambda: process_classification_jobs(
+                options["chunk_size"], should_stop=self.stopping.is_set
+            ),
+            idle_delay=options["idle_delay"],
+        )
+        self.stdout.write(self.style.SUCCESS("Classification job worker stopped."))
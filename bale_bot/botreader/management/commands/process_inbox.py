@@ -0,0 +1,51 @@
+"""
+Django command to drain webhook updates stored in the inbox table.
+"""
+import logging
+import threading
+
+from botreader.management.worker import WorkerCommand
+from botreader.services.helpers import cache_stats
+from botreader.services.inbox import process_inbox_batch
+
+logger = logging.getLogger(__name__)
+
+
+class Command(WorkerCommand):
+    """Django command to run a pool of inbox workers."""
+
+    help = "Process pending inbox updates with a pool of worker threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--idle-delay",
+            type=float,
+            default=1,
+            help="Seconds a worker sleeps when the inbox is empty.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        self.install_signal_handlers()
+        workers = [
+            threading.Thread(
+                target=self.run_loop,
+                args=(
+                    lambda: process_inbox_batch(options["batch_size"]),
+                    options["idle_delay"],
+                ),
+                name=f"inbox-worker-{number}",
+            )
+            for number in range(options["workers"])
+        ]
+        self.stdout.write(f"Processing inbox with {len(workers)} workers...")
+        for worker in workers:
+            worker.start()
+        # the main thread has to stay free to receive signals
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(timeout=1)
+        logger.info("User and chat cache stats: %s", cache_stats())
+        self.stdout.write(self.style.SUCCESS("Inbox workers stopped."))
@@ -0,0 +1,33 @@
+"""
+Django command to retry Bale operations that failed during ingestion.
+"""
+from botreader.management.worker import WorkerCommand
+from botreader.services.retry_queue import process_retry_queue
+
+# registers the retry handlers of every service
+import botreader.services.services  # noqa: F401
+
+
+class Command(WorkerCommand):
+    """Django command to run the retry queue worker."""
+
+    help = "Retry queued Bale operations until SIGTERM or SIGINT is received."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument(
+            "--idle-delay",
+            type=float,
+            default=10,
+            help="Seconds to sleep when no operation is due.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        self.install_signal_handlers()
+        self.stdout.write("Processing retry queue...")
+        self.run_loop(
+            lambda: process_retry_queue(options["batch_size"]),
+            idle_delay=options["idle_delay"],
+        )
+        self.stdout.write(self.style.SUCCESS("Retry queue worker stopped."))
@@ -0,0 +1,40 @@
+"""
+Django command to delete processed inbox updates and old side effect keys.
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from bale_bot.settings import BOTREADER_INBOX_RETENTION_DAYS
+from botreader.services.inbox import prune_inbox
+
+
+class Command(BaseCommand):
+    """Django command to prune the inbox and side effect tables."""
+
+    help = (
+        "Delete updates processed and side effects performed more than --days "
+        "days ago, in batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=BOTREADER_INBOX_RETENTION_DAYS,
+            help="Days to keep, has to outlast any redelivery of an update.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        before = timezone.now() - timedelta(days=options["days"])
+        pruned = prune_inbox(before, batch_size=options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                "{updates} updates and {side_effects} side effects pruned.".format(
+                    **pruned
+                )
+            )
+        )
@@ -0,0 +1,27 @@
+"""
+Django command to recount the message stats of users from their messages.
+"""
+from django.core.management.base import BaseCommand
+
+from botreader.models import User
+from botreader.services.message_stats import rebuild_user_message_stats
+
+
+class Command(BaseCommand):
+    """Django command to rebuild the user message stats table."""
+
+    help = "Recount the message stats of every user, or of the given user ids."
+
+    def add_arguments(self, parser):
+        parser.add_argument("uids", nargs="*", type=int)
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        users = User.objects.all()
+        if options["uids"]:
+            users = users.filter(uid__in=options["uids"])
+        rebuilt = rebuild_user_message_stats(users, batch_size=options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Message stats of {rebuilt} users rebuilt.")
+        )
@@ -0,0 +1,38 @@
+"""
+Django command to dispatch generated answers and send queued outbound messages.
+"""
+from botreader.management.worker import WorkerCommand
+from botreader.services.outbox import dispatch_generated_answers, send_outbox_batch
+
+
+class Command(WorkerCommand):
+    """Django command to run the rate limited outbox sender."""
+
+    help = (
+        "Dispatch answers set to SENDING and send queued messages with per chat "
+        "and global rate limits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument(
+            "--idle-delay",
+            type=float,
+            default=1,
+            help="Seconds to sleep when nothing could be sent.",
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        self.install_signal_handlers()
+        self.stdout.write("Sending outbox...")
+        self.run_loop(
+            lambda: self.send(options["batch_size"]),
+            idle_delay=options["idle_delay"],
+        )
+        self.stdout.write(self.style.SUCCESS("Outbox sender stopped."))
+
+    def send(self, batch_size):
+        dispatched = dispatch_generated_answers(batch_size)
+        sent = send_outbox_batch(batch_size)
+        return dispatched + sent
@@ -0,0 +1,184 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# kinds of synthetic updates served by getupdates
+UPDATE_KINDS = ("text", "reply", "edit", "join", "leave", "forward", "callback")
+DEFAULT_MIX = {
+    "text": 60,
+    "reply": 15,
+    "edit": 5,
+    "join": 5,
+    "leave": 5,
+    "forward": 5,
+    "callback": 5,
+}
+# the message id Bale gives entry and exit messages
+SERVICE_MESSAGE_ID = 0
+# seconds the dates of a stream spread over, shorter than the window in which
+# joins are welcomed
+DATE_SPAN = 300
+
+
+class FakeBaleApi:
+    """Serves synthetic Bale updates and answers bot calls with an optional latency.
+
+    Updates are built from their update_id, so the same options always
+    produce the same stream and nothing is kept in memory besides counters.
+    Message dates spread over DATE_SPAN seconds from `started_at`.
+    """
+
+    def __init__(
+        self,
+        updates,
+        mix=None,
+        chats=20,
+        users=500,
+        latency=None,
+        seed=0,
+        started_at=None,
+    ):
+        self.updates = updates
+        mix = mix or DEFAULT_MIX
+        self.kinds = [kind for kind in UPDATE_KINDS if mix.get(kind)]
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.chats = chats
+        self.users = users
+        # method -> seconds slept before answering
+        self.latency = latency or {}
+        self.seed = seed
+        if started_at is None:
+            started_at = int(time.time()) - DATE_SPAN
+        self.started_at = started_at
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+
+    def handle(self, method, params):
+        with self._calls_lock:
+            self.calls[method] += 1
+        delay = self.latency.get(method, 0)
+        if delay:
+            time.sleep(delay)
+        if method == "getupdates":
+            return {"ok": True, "result": self.get_updates(params)}
+        if method == "getChatAdministrators":
+            return {
+                "ok": True,
+                "result": [{"user": self.get_user(0)}, {"user": self.get_user(1)}],
+            }
+        if method in ("sendMessage", "deletemessage"):
+            return {"ok": True, "result": {}}
+        return {"ok": False, "description": "unknown method"}
+
+    def get_updates(self, params):
+        offset = max(int(params.get("offset", 0)), 1)
+        limit = int(params.get("limit", 100))
+        return [
+            self.get_update(update_id)
+            for update_id in range(offset, min(offset + limit, self.updates + 1))
+        ]
+
+    def get_update(self, update_id):
+        rng = random.Random(self.seed * 1_000_003 + update_id)
+        kind = rng.choices(self.kinds, self.weights)[0]
+        # a message can only refer to one sent before it
+        if update_id == 1 and kind in ("reply", "edit", "callback"):
+            kind = "text"
+        chat = self.get_chat(rng.randrange(self.chats))
+        sender = self.get_user(rng.randrange(self.users))
+        message = {
+            "message_id": update_id,
+            "from": sender,
+            "chat": chat,
+            "date": self.started_at + update_id * DATE_SPAN // (self.updates + 1),
+            "text": "message {update_id} #tag{tag}".format(
+                update_id=update_id, tag=rng.randrange(50)
+            ),
+        }
+        if kind == "reply":
+            message["reply_to_message"] = {"message_id": rng.randrange(1, update_id)}
+        elif kind == "join":
+            del message["text"]
+            message["message_id"] = SERVICE_MESSAGE_ID
+            message["new_chat_members"] = [self.get_user(rng.randrange(self.users))]
+        elif kind == "leave":
+            del message["text"]
+            message["message_id"] = SERVICE_MESSAGE_ID
+            message["left_chat_member"] = self.get_user(rng.randrange(self.users))
+        elif kind == "forward":
+            message["forward_from_chat"] = self.get_chat(rng.randrange(self.chats))
+            message["forward_from_message_id"] = rng.randrange(1, 1_000_000)
+
+        if kind == "edit":
+            message["message_id"] = rng.randrange(1, update_id)
+            return {"update_id": update_id, "edited_message": message}
+        if kind == "callback":
+            message["message_id"] = rng.randrange(1, update_id)
+            return {
+                "update_id": update_id,
+                "callback_query": {
+                    "id": str(update_id),
+                    "from": sender,
+                    "message": message,
+                },
+            }
+        return {"update_id": update_id, "message": message}
+
+    def get_chat(self, number):
+        return {
+            "id": -1_000_000 - number,
+            "type": "group",
+            "title": "chat {number}".format(number=number),
+            "first_name": "",
+            "last_name": "",
+            "username": "",
+        }
+
+    def get_user(self, number):
+        return {
+            "id": 1_000_000 + number,
+            "first_name": "user {number}".format(number=number),
+            "username": "user{number}".format(number=number),
+        }
+
+
+def serve(fake_bale_api):
+    # Starts a threaded HTTP server on a free local port, returns the server
+    # and the base url to use in place of BALE_BOT_BASE_URL.
+
+    class Handler(BaseHTTPRequestHandler):
+        # keeps the pooled connections of bale_api alive like tapi.bale.ai
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.answer()
+
+        def do_POST(self):
+            self.answer()
+
+        def answer(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                params.update(parse_qsl(self.rfile.read(length).decode()))
+            method = url.path.rstrip("/").rsplit("/", 1)[-1]
+            body = json.dumps(fake_bale_api.handle(method, params)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, "http://{host}:{port}/bot/".format(host=host, port=port)
@@ -0,0 +1,38 @@
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerCommand(BaseCommand):
+    """Base class for long-running commands that stop on SIGTERM or SIGINT."""
+
+    def install_signal_handlers(self):
+        self.stopping = threading.Event()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run_loop(self, step, idle_delay=1, error_delay=5):
+        # `step` returns how much work it did, the loop sleeps when it did none
+        try:
+            while not self.stopping.is_set():
+                # drop connections the database closed while we were waiting
+                close_old_connections()
+                try:
+                    done = step()
+                except Exception as e:
+                    logger.exception(e)
+                    self.stopping.wait(error_delay)
+                    continue
+                if not done:
+                    self.stopping.wait(idle_delay)
+        finally:
+            connection.close()
+
+    def stop(self, signum, frame):
+        logger.info("Signal %s received, stopping after the current step", signum)
+        self.stopping.set()
@@ -0,0 +1,47 @@
+# Generated by Django 4.1 on 2026-10-18 06:17
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0015_user_type_alter_textmessage_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UpdateInbox",
+            fields=[
+                (
+                    "update_id",
+                    models.BigIntegerField(primary_key=True, serialize=False),
+                ),
+                ("payload", models.JSONField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("PENDING", "Pending"),
+                            ("DONE", "Done"),
+                            ("FAILED", "Failed"),
+                        ],
+                        default="PENDING",
+                        max_length=10,
+                    ),
+                ),
+                (
+                    "received_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                ("processed_at", models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="updateinbox",
+            index=models.Index(
+                fields=["status", "update_id"], name="botreader_u_status_7a2a07_idx"
+            ),
+        ),
+    ]
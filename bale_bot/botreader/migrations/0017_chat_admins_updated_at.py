@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 06:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0016_updateinbox"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="admins_updated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations
+from django.db.models import Count, F
+
+
+def remove_duplicates(model, fields, order_by):
+    duplicates = (
+        model.objects.values(*fields).annotate(rows=Count("id")).filter(rows__gt=1)
+    )
+    for duplicate in duplicates:
+        lookup = {field: duplicate[field] for field in fields}
+        keep = model.objects.filter(**lookup).order_by(*order_by).first()
+        model.objects.filter(**lookup).exclude(id=keep.id).delete()
+
+
+def remove_duplicate_memberships_and_chat_events(apps, schema_editor):
+    Membership = apps.get_model("botreader", "Membership")
+    ChatEvent = apps.get_model("botreader", "ChatEvent")
+    # keep the membership that saw the latest entry, PostgreSQL sorts NULLs
+    # first in descending order
+    remove_duplicates(
+        Membership,
+        ("chat", "member"),
+        (F("last_membership_date").desc(nulls_last=True), "exited"),
+    )
+    remove_duplicates(
+        ChatEvent, ("user", "chat", "date", "event_type"), ("inviterUser",)
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("botreader", "0019_outboundmessage"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_memberships_and_chat_events, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.1 on 2026-10-18 06:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0020_remove_duplicate_memberships_and_chat_events"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="textmessage",
+            index=models.Index(fields=["-date"], name="botreader_t_date_610565_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="textmessage",
+            index=models.Index(
+                fields=["sender", "type"], name="botreader_t_sender__ba0e4a_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="chatevent",
+            constraint=models.UniqueConstraint(
+                fields=("user", "chat", "date", "event_type"),
+                name="unique_chatevent_user_chat_date_event_type",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="membership",
+            constraint=models.UniqueConstraint(
+                fields=("chat", "member"), name="unique_membership_chat_member"
+            ),
+        ),
+    ]
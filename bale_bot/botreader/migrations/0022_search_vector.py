@@ -0,0 +1,67 @@
+# Generated by Django 4.1 on 2026-10-18 06:25
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.db import migrations
+
+SEARCH_VECTOR_TABLES = ("botreader_textmessage", "botreader_archivedtextmessage")
+
+
+def search_vector_trigger_sql(table):
+    # tsvector_update_trigger needs a schema qualified configuration name
+    config = "pg_catalog." + settings.BOTREADER_SEARCH_CONFIG
+    return f"""
+        CREATE TRIGGER {table}_search_vector_update
+        BEFORE INSERT OR UPDATE OF text ON {table}
+        FOR EACH ROW EXECUTE PROCEDURE
+        tsvector_update_trigger(search_vector, '{config}', text);
+        UPDATE {table}
+        SET search_vector = to_tsvector('{config}'::regconfig, text);
+    """
+
+
+def drop_search_vector_trigger_sql(table):
+    return f"DROP TRIGGER IF EXISTS {table}_search_vector_update ON {table};"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0021_indexes_and_unique_constraints"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="archivedtextmessage",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="textmessage",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        *(
+            migrations.RunSQL(
+                search_vector_trigger_sql(table), drop_search_vector_trigger_sql(table)
+            )
+            for table in SEARCH_VECTOR_TABLES
+        ),
+        migrations.AddIndex(
+            model_name="archivedtextmessage",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="botreader_a_search__af0c7d_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="textmessage",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="botreader_t_search__82051c_gin"
+            ),
+        ),
+    ]
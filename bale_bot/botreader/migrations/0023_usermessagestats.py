@@ -0,0 +1,60 @@
+# Generated by Django 4.1 on 2026-10-18 06:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0022_search_vector"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserMessageStats",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="message_stats",
+                        serialize=False,
+                        to="botreader.user",
+                    ),
+                ),
+                ("messages_count", models.PositiveIntegerField(default=0)),
+                ("reply_messages_count", models.PositiveIntegerField(default=0)),
+                ("questions_count", models.PositiveIntegerField(default=0)),
+                (
+                    "answers_and_suggestions_count",
+                    models.PositiveIntegerField(default=0),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO botreader_usermessagestats (
+                user_id,
+                messages_count,
+                reply_messages_count,
+                questions_count,
+                answers_and_suggestions_count,
+                updated_at
+            )
+            SELECT
+                sender_id,
+                COUNT(*),
+                COUNT(reply_id),
+                COUNT(*) FILTER (WHERE type = 'QUESTION'),
+                COUNT(*) FILTER (WHERE type IN ('ANSWER', 'SUGGESTION')),
+                NOW()
+            FROM botreader_textmessage
+            WHERE sender_id IS NOT NULL
+            GROUP BY sender_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 4.1 on 2026-10-18 06:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0023_usermessagestats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChatActivityRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "granularity",
+                    models.CharField(
+                        choices=[("HOUR", "Hour"), ("DAY", "Day")], max_length=4
+                    ),
+                ),
+                ("period_start", models.DateTimeField()),
+                ("messages_count", models.PositiveIntegerField(default=0)),
+                ("type_counts", models.JSONField(default=dict)),
+                ("entries_count", models.PositiveIntegerField(default=0)),
+                ("exits_count", models.PositiveIntegerField(default=0)),
+                ("unique_senders_count", models.PositiveIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="textmessage",
+            index=models.Index(
+                fields=["chat", "date"], name="botreader_t_chat_id_c333b9_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="chatactivityrollup",
+            name="chat",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="activity_rollups",
+                to="botreader.chat",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="chatactivityrollup",
+            index=models.Index(
+                fields=["granularity", "period_start"],
+                name="botreader_c_granula_729774_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="chatactivityrollup",
+            constraint=models.UniqueConstraint(
+                fields=("chat", "granularity", "period_start"),
+                name="unique_chatactivityrollup_chat_granularity_period_start",
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1 on 2026-10-18 06:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0024_chatactivityrollup"),
+    ]
+
+    operations = [
+        # keep the row imported last of every duplicated (sid, chat_id)
+        migrations.RunSQL(
+            """
+            DELETE FROM botreader_archivedtextmessage AS duplicate
+            USING botreader_archivedtextmessage AS kept
+            WHERE duplicate.sid = kept.sid
+                AND duplicate.chat_id = kept.chat_id
+                AND duplicate.id < kept.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name="archivedtextmessage",
+            constraint=models.UniqueConstraint(
+                fields=("sid", "chat_id"), name="unique_archivedtextmessage_sid_chat_id"
+            ),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.1 on 2026-10-18 06:32
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0025_archivedtextmessage_unique_sid_chat_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedHashtagCount",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("chat_id", models.CharField(max_length=250)),
+                ("hashtag", models.CharField(max_length=100)),
+                ("count", models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="archivedtextmessage",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["hashtags"], name="botreader_a_hashtag_d47e89_gin"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="archivedhashtagcount",
+            index=models.Index(
+                fields=["chat_id", "-count"], name="botreader_a_chat_id_9596e4_idx"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="archivedhashtagcount",
+            constraint=models.UniqueConstraint(
+                fields=("chat_id", "hashtag"),
+                name="unique_archivedhashtagcount_chat_id_hashtag",
+            ),
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO botreader_archivedhashtagcount (chat_id, hashtag, count)
+            SELECT message.chat_id, hashtag, COUNT(DISTINCT message.id)
+            FROM botreader_archivedtextmessage AS message,
+                unnest(message.hashtags) AS hashtag
+            GROUP BY message.chat_id, hashtag
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
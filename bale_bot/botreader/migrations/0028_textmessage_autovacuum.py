@@ -0,0 +1,29 @@
+# Generated by Django 4.1 on 2026-10-18 06:38
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0027_inbox_attempts_and_side_effects"),
+    ]
+
+    operations = [
+        # the default scale factors wait for a fifth of the table to change,
+        # which on a large append-mostly table means rare and huge vacuums
+        migrations.RunSQL(
+            """
+            ALTER TABLE botreader_textmessage SET (
+                autovacuum_vacuum_scale_factor = 0.01,
+                autovacuum_analyze_scale_factor = 0.005
+            )
+            """,
+            """
+            ALTER TABLE botreader_textmessage RESET (
+                autovacuum_vacuum_scale_factor,
+                autovacuum_analyze_scale_factor
+            )
+            """,
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1 on 2026-10-18 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0028_textmessage_autovacuum"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="textmessage",
+            name="botreader_t_date_610565_idx",
+        ),
+        migrations.AddIndex(
+            model_name="textmessage",
+            index=models.Index(
+                fields=["-date", "-id"], name="botreader_t_date_2a9a26_idx"
+            ),
+        ),
+    ]
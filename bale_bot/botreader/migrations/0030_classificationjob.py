@@ -0,0 +1,85 @@
+# Generated by Django 4.1 on 2026-10-18 06:44
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0029_textmessage_date_id_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClassificationJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "type",
+                    models.CharField(
+                        blank=True,
+                        choices=[
+                            ("", "----"),
+                            ("QUESTION", "Question"),
+                            ("ANSWER", "Answer"),
+                            ("SUGGESTION", "Suggestion"),
+                            ("ADVERTISEMENT", "Advertisement"),
+                            ("STATEMENT", "Statement"),
+                            ("SELL", "Sell"),
+                            ("TRASH", "Trash"),
+                        ],
+                        max_length=15,
+                    ),
+                ),
+                (
+                    "message_ids",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.UUIDField(),
+                        blank=True,
+                        default=list,
+                        size=None,
+                    ),
+                ),
+                ("filters", models.JSONField(blank=True, default=dict)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("PENDING", "Pending"),
+                            ("RUNNING", "Running"),
+                            ("DONE", "Done"),
+                            ("FAILED", "Failed"),
+                        ],
+                        default="PENDING",
+                        max_length=10,
+                    ),
+                ),
+                ("total", models.PositiveIntegerField(null=True)),
+                ("processed", models.PositiveIntegerField(default=0)),
+                ("updated", models.PositiveIntegerField(default=0)),
+                ("cursor_date", models.DateTimeField(null=True)),
+                ("cursor_id", models.UUIDField(null=True)),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("last_error", models.TextField(blank=True)),
+                ("locked_at", models.DateTimeField(null=True)),
+                ("created_at", models.DateTimeField(default=django.utils.timezone.now)),
+                ("finished_at", models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="classificationjob",
+            index=models.Index(
+                fields=["status", "created_at"], name="botreader_c_status_1e6698_idx"
+            ),
+        ),
+    ]
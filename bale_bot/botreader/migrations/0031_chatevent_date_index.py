@@ -0,0 +1,17 @@
+# Generated by Django 4.1 on 2026-10-18 06:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0030_classificationjob"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="chatevent",
+            index=models.Index(fields=["-date"], name="botreader_c_date_20919c_idx"),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1 on 2026-10-18 06:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0031_chatevent_date_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RateLimitBucket",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=50, primary_key=True, serialize=False),
+                ),
+                ("tokens", models.FloatField()),
+                ("updated_at", models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name="outboundmessage",
+            name="locked_at",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
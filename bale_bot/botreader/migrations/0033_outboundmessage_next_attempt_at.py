@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 07:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0032_outbox_lease_and_rate_limit_buckets"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="outboundmessage",
+            name="next_attempt_at",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
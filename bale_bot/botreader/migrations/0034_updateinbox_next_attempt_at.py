@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0033_outboundmessage_next_attempt_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="updateinbox",
+            name="next_attempt_at",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.1 on 2026-10-18 07:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("botreader", "0034_updateinbox_next_attempt_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ClassificationJobMessage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("position", models.PositiveIntegerField()),
+                ("message_id", models.UUIDField()),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="job_messages",
+                        to="botreader.classificationjob",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="classificationjobmessage",
+            constraint=models.UniqueConstraint(
+                fields=("job", "position"),
+                name="unique_classificationjobmessage_job_position",
+            ),
+        ),
+        # the ids of unfinished jobs move to their rows, positions follow the
+        # array so `processed` still counts the rows already classified
+        migrations.RunSQL(
+            """
+            INSERT INTO botreader_classificationjobmessage (job_id, position, message_id)
+            SELECT job.id, item.position, item.message_id
+            FROM botreader_classificationjob job,
+                unnest(job.message_ids) WITH ORDINALITY AS item(message_id, position)
+            WHERE job.status IN ('PENDING', 'RUNNING')
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.RemoveField(
+            model_name="classificationjob",
+            name="message_ids",
+        ),
+    ]
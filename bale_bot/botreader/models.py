@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from uuid import uuid4
 from django.utils import timezone
 
@@ -8,6 +10,51 @@ class UpdateId(models.Model):
     update_id = models.BigIntegerField()
 
 
+class UpdateInbox(models.Model):
+    STATUS_CHOICES = [
+        ("PENDING", "Pending"),
+        ("PROCESSING", "Processing"),
+        ("DONE", "Done"),
+        ("FAILED", "Failed"),
+    ]
+    update_id = models.BigIntegerField(primary_key=True)
+    payload = models.JSONField()
+    status = models.CharField(choices=STATUS_CHOICES, default="PENDING", max_length=10)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # when a worker claimed the update, a claim older than the lease is
+    # taken over by another worker
+    locked_at = models.DateTimeField(null=True)
+    # an update that failed is not claimed again before this time
+    next_attempt_at = models.DateTimeField(null=True)
+    received_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "update_id"])]
+
+
+class SideEffect(models.Model):
+    # Keys of side effects already performed, so an update processed again
+    # does not repeat them.
+    key = models.CharField(max_length=200, primary_key=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+class RetryOperation(models.Model):
+    STATUS_CHOICES = [("PENDING", "Pending"), ("FAILED", "Failed")]
+    operation = models.CharField(max_length=50)
+    payload = models.JSONField()
+    status = models.CharField(choices=STATUS_CHOICES, default="PENDING", max_length=10)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "next_attempt_at"])]
+
+
 class TextMessage(models.Model):
     TEXT_MESSAGE_TYPE = [
         ("", "----"),
@@ -33,6 +80,18 @@ class TextMessage(models.Model):
         choices=TEXT_MESSAGE_TYPE, max_length=15, default="", blank=True
     )
     reply = models.ForeignKey("TextMessage", on_delete=models.PROTECT, null=True)
+    # kept up to date by a database trigger on text
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # the admin changelist pages through messages by (date, id)
+            models.Index(fields=["-date", "-id"]),
+            models.Index(fields=["sender", "type"]),
+            # recomputing the activity of a chat over a period
+            models.Index(fields=["chat", "date"]),
+            GinIndex(fields=["search_vector"]),
+        ]
 
     def __str__(self):
         offset = 30
@@ -46,6 +105,22 @@ class ArchivedTextMessage(models.Model):
     chat_id = models.CharField(max_length=250, default="")
     text = models.TextField()
     hashtags = ArrayField(models.CharField(max_length=100), blank=True)
+    # kept up to date by a database trigger on text
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=["search_vector"]),
+            # serves the hashtags __contains and __overlap filters
+            GinIndex(fields=["hashtags"]),
+        ]
+        # the key imports upsert on
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sid", "chat_id"],
+                name="unique_archivedtextmessage_sid_chat_id",
+            )
+        ]
 
     def __str__(self):
         offset = 30
@@ -54,6 +129,23 @@ class ArchivedTextMessage(models.Model):
         return self.text
 
 
+class ArchivedHashtagCount(models.Model):
+    # Number of archived messages of a chat carrying each hashtag, rebuilt
+    # whenever the archive of the chat changes.
+    chat_id = models.CharField(max_length=250)
+    hashtag = models.CharField(max_length=100)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["chat_id", "hashtag"],
+                name="unique_archivedhashtagcount_chat_id_hashtag",
+            )
+        ]
+        indexes = [models.Index(fields=["chat_id", "-count"])]
+
+
 class GeneratedAnswer(models.Model):
     STATUS_CHOICES = [("DRAFT", "Draft"), ("SENDING", "Sending"), ("SENT", "Sent")]
     human_answer = models.TextField(blank=True)
@@ -65,6 +157,42 @@ class GeneratedAnswer(models.Model):
     )
 
 
+class OutboundMessage(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid4)
+    chat_id = models.BigIntegerField()
+    text = models.TextField()
+    reply_to_message_id = models.BigIntegerField(null=True)
+    status = models.CharField(
+        choices=GeneratedAnswer.STATUS_CHOICES, default="SENDING", max_length=7
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # when a sender claimed the message, a claim older than the lease is
+    # taken over by another sender
+    locked_at = models.DateTimeField(null=True)
+    # a message that failed is not claimed again before this time
+    next_attempt_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True)
+    generated_answer = models.OneToOneField(
+        to=GeneratedAnswer,
+        related_name="outbound_message",
+        on_delete=models.CASCADE,
+        null=True,
+    )
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+
+class RateLimitBucket(models.Model):
+    # Token bucket shared by every outbox sender, the global one and one per
+    # chat, so senders running side by side stay within the same limits.
+    name = models.CharField(max_length=50, primary_key=True)
+    tokens = models.FloatField()
+    updated_at = models.DateTimeField()
+
+
 class User(models.Model):
     TYPE_CHOICES = [
         ("", "----"),
@@ -85,6 +213,22 @@ class User(models.Model):
         return name
 
 
+class UserMessageStats(models.Model):
+    # Message counts of a user, kept up to date on ingest and whenever the
+    # type of a message changes, so listing users never counts messages.
+    user = models.OneToOneField(
+        to=User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="message_stats",
+    )
+    messages_count = models.PositiveIntegerField(default=0)
+    reply_messages_count = models.PositiveIntegerField(default=0)
+    questions_count = models.PositiveIntegerField(default=0)
+    answers_and_suggestions_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 class Chat(models.Model):
     id = models.BigIntegerField(primary_key=True)
     type = models.CharField(max_length=200)
@@ -93,6 +237,7 @@ class Chat(models.Model):
     first_name = models.CharField(max_length=500)
     last_name = models.CharField(max_length=500)
     admins = models.ManyToManyField(to=User, default=[], related_name="groups_admin")
+    admins_updated_at = models.DateTimeField(null=True, blank=True)
     members = models.ManyToManyField(
         to=User, through="Membership", related_name="chats", blank=True
     )
@@ -117,6 +262,13 @@ class Membership(models.Model):
     exited = models.BooleanField(default=False)
     last_membership_date = models.DateTimeField(null=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["chat", "member"], name="unique_membership_chat_member"
+            )
+        ]
+
     def __str__(self):
         return f"{self.chat} | {self.member}"
 
@@ -141,3 +293,99 @@ class ChatEvent(models.Model):
     event_type = models.CharField(
         max_length=10, choices=EventType.choices, default=EventType.ENTRY
     )
+
+    class Meta:
+        # also serves the event lookups, which filter on all four columns
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "chat", "date", "event_type"],
+                name="unique_chatevent_user_chat_date_event_type",
+            )
+        ]
+        # the events API pages through events newest first
+        indexes = [models.Index(fields=["-date"])]
+
+
+class ChatActivityRollup(models.Model):
+    # Activity of a chat per hour and per day, recomputed for the periods a
+    # page of updates touched so dashboards read one row per period.
+    class Granularity(models.TextChoices):
+        HOUR = "HOUR"
+        DAY = "DAY"
+
+    chat = models.ForeignKey(
+        "Chat", on_delete=models.CASCADE, related_name="activity_rollups"
+    )
+    granularity = models.CharField(max_length=4, choices=Granularity.choices)
+    period_start = models.DateTimeField()
+    messages_count = models.PositiveIntegerField(default=0)
+    # message type -> number of messages, "" for messages without a type
+    type_counts = models.JSONField(default=dict)
+    entries_count = models.PositiveIntegerField(default=0)
+    exits_count = models.PositiveIntegerField(default=0)
+    unique_senders_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["chat", "granularity", "period_start"],
+                name="unique_chatactivityrollup_chat_granularity_period_start",
+            )
+        ]
+        indexes = [models.Index(fields=["granularity", "period_start"])]
+
+
+class ClassificationJob(models.Model):
+    # Sets the type of many text messages in chunks, either the messages
+    # listed in its job_messages or those matching `filters`, see
+    # services/classification.py. Progress is saved with every chunk so an
+    # interrupted job resumes where it stopped.
+    STATUS_CHOICES = [
+        ("PENDING", "Pending"),
+        ("RUNNING", "Running"),
+        ("DONE", "Done"),
+        ("FAILED", "Failed"),
+    ]
+    type = models.CharField(
+        choices=TextMessage.TEXT_MESSAGE_TYPE, max_length=15, blank=True
+    )
+    filters = models.JSONField(default=dict, blank=True)
+    status = models.CharField(choices=STATUS_CHOICES, default="PENDING", max_length=10)
+    total = models.PositiveIntegerField(null=True)
+    processed = models.PositiveIntegerField(default=0)
+    # messages whose type actually changed
+    updated = models.PositiveIntegerField(default=0)
+    # (date, id) of the last message processed by a filters job
+    cursor_date = models.DateTimeField(null=True)
+    cursor_id = models.UUIDField(null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # when a worker last saved progress, a job not saved for longer than the
+    # lease is taken over by another worker
+    locked_at = models.DateTimeField(null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"])]
+
+
+class ClassificationJobMessage(models.Model):
+    # A message listed in a classification job. Positions run from 1 in the
+    # order the messages are classified, so a chunk reads one range of the
+    # (job, position) constraint's index.
+    job = models.ForeignKey(
+        ClassificationJob, on_delete=models.CASCADE, related_name="job_messages"
+    )
+    position = models.PositiveIntegerField()
+    # not a foreign key, so ids of missing messages are skipped
+    message_id = models.UUIDField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["job", "position"],
+                name="unique_classificationjobmessage_job_position",
+            )
+        ]
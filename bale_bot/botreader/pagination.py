@@ -0,0 +1,296 @@
+import base64
+import binascii
+import json
+
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connection, models
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.db.models.lookups import GreaterThanOrEqual
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+from bale_bot.settings import BOTREADER_ADMIN_COUNT_LIMIT
+
+AFTER_VAR = "after"
+BEFORE_VAR = "before"
+
+
+class Row(models.Func):
+    # ROW(a, b) < ROW(x, y) is a single range condition on an index over
+    # (a, b), unlike the equivalent a < x OR (a = x AND b < y)
+    function = "ROW"
+    output_field = models.Field()
+
+
+class CappedCount(models.Subquery):
+    # number of rows of a subquery limited to the cap
+    template = "(SELECT COUNT(*) FROM (%(subquery)s) AS capped)"
+    output_field = models.BigIntegerField()
+
+
+def get_count_expression(queryset, limit=BOTREADER_ADMIN_COUNT_LIMIT):
+    # estimate_count as an expression, so the count is selected with another
+    # query instead of costing its own. PostgreSQL only runs the capped count
+    # when the estimate is below the limit.
+    count = CappedCount(queryset.order_by().values("pk")[:limit])
+    if queryset.query.where:
+        return count
+    estimate = RawSQL(
+        "SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+        [queryset.model._meta.db_table],
+        output_field=models.FloatField(),
+    )
+    return models.Case(
+        models.When(
+            GreaterThanOrEqual(estimate, limit),
+            then=Cast(estimate, models.BigIntegerField()),
+        ),
+        default=count,
+    )
+
+
+def interpret_count(queryset, count, limit=BOTREADER_ADMIN_COUNT_LIMIT):
+    # the (count, is_estimated, is_capped) of estimate_count for a value of
+    # get_count_expression
+    if count < limit:
+        return count, False, False
+    if queryset.query.where:
+        return count, False, True
+    return count, True, False
+
+
+def estimate_count(queryset, limit=BOTREADER_ADMIN_COUNT_LIMIT):
+    # Returns (count, is_estimated, is_capped). A whole table is estimated
+    # from the planner statistics, a filtered queryset is counted up to
+    # `limit` rows.
+    if not queryset.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+        # reltuples is -1 until the table is first vacuumed or analyzed
+        if row and row[0] >= limit:
+            return int(row[0]), True, False
+    count = queryset.order_by()[:limit].count()
+    return count, False, count >= limit
+
+
+class EstimatedCountPaginator(Paginator):
+    # OFFSET pagination without an exact COUNT(*), used when the changelist
+    # is sorted by a column other than the keyset.
+
+    @cached_property
+    def estimate(self):
+        return estimate_count(self.object_list)
+
+    @cached_property
+    def count(self):
+        return self.estimate[0]
+
+
+class KeysetPage:
+    def __init__(self, object_list, first_key, last_key, has_next, has_previous):
+        self.object_list = object_list
+        self.first_key = first_key
+        self.last_key = last_key
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+
+class KeysetPaginator:
+    # Pages through a queryset by the values of its ordering fields instead
+    # of an OFFSET, so every page costs one index range scan however deep
+    # it is. `ordering` must sort every field in the same direction and end
+    # with the primary key to make the keys unique.
+
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = list(ordering)
+        self.descending = self.ordering[0].startswith("-")
+        self.fields = [
+            (
+                queryset.model._meta.pk
+                if name.lstrip("-") == "pk"
+                else queryset.model._meta.get_field(name.lstrip("-"))
+            )
+            for name in self.ordering
+        ]
+        if any(name.startswith("-") != self.descending for name in self.ordering):
+            raise ImproperlyConfigured(
+                "Keyset ordering {ordering} mixes directions.".format(
+                    ordering=self.ordering
+                )
+            )
+        if not self.fields[-1].primary_key:
+            raise ImproperlyConfigured(
+                "Keyset ordering {ordering} does not end with the primary "
+                "key.".format(ordering=self.ordering)
+            )
+
+    @cached_property
+    def estimate(self):
+        # set by page() from its keys query, counted on its own only when
+        # the page is empty
+        return estimate_count(self.queryset)
+
+    def encode_key(self, key):
+        # str() keeps the microseconds DjangoJSONEncoder would cut off
+        return base64.urlsafe_b64encode(json.dumps(key, default=str).encode()).decode()
+
+    def decode_key(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if len(values) != len(self.fields):
+                raise ValueError("Wrong number of key values")
+            return [field.to_python(value) for field, value in zip(self.fields, values)]
+        except (binascii.Error, ValueError, TypeError, ValidationError):
+            raise InvalidPage("Invalid cursor {cursor}".format(cursor=cursor))
+
+    def page(self, after=None, before=None):
+        # `after` pages forward from a page's last key, `before` backward
+        # from a page's first key
+        cursor = before or after
+        backward = bool(before)
+        queryset = self.queryset
+        if cursor:
+            key = Row(
+                *(
+                    models.Value(value, output_field=field)
+                    for field, value in zip(self.fields, self.decode_key(cursor))
+                )
+            )
+            lookup = "lt" if self.descending != backward else "gt"
+            queryset = queryset.alias(
+                keyset=Row(*(models.F(field.attname) for field in self.fields))
+            ).filter(**{"keyset__" + lookup: key})
+        ordering = self.ordering
+        if backward:
+            ordering = [
+                name[1:] if name.startswith("-") else "-" + name for name in ordering
+            ]
+        # only the keys, and the count of the whole queryset, are read here,
+        # the rows of the page are fetched by primary key afterwards
+        rows = list(
+            queryset.order_by(*ordering)
+            .annotate(result_count=get_count_expression(self.queryset))
+            .values_list(*(field.attname for field in self.fields), "result_count")[
+                : self.per_page + 1
+            ]
+        )
+        if rows:
+            self.estimate = interpret_count(self.queryset, rows[0][-1])
+        elif not cursor:
+            self.estimate = (0, False, False)
+        keys = [row[:-1] for row in rows]
+        has_more = len(keys) > self.per_page
+        keys = keys[: self.per_page]
+        if backward:
+            keys.reverse()
+        object_list = self.queryset.filter(pk__in=[key[-1] for key in keys]).order_by(
+            *self.ordering
+        )
+        return KeysetPage(
+            object_list,
+            first_key=self.encode_key(keys[0]) if keys else None,
+            last_key=self.encode_key(keys[-1]) if keys else None,
+            has_next=bool(before) or has_more,
+            has_previous=bool(after) or (backward and has_more),
+        )
+
+
+class KeysetChangeList(ChangeList):
+    # Pages the changelist with a KeysetPaginator on the admin's ordering,
+    # and falls back to OFFSET pages when a column header sorts it.
+
+    def __init__(self, request, *args, **kwargs):
+        self.after = request.GET.get(AFTER_VAR)
+        self.before = request.GET.get(BEFORE_VAR)
+        super().__init__(request, *args, **kwargs)
+
+    def get_filters_params(self, params=None):
+        # the cursors are not lookups, they are taken out of the params
+        # like the page number so filter links start from the first page
+        if params is None:
+            self.params.pop(AFTER_VAR, None)
+            self.params.pop(BEFORE_VAR, None)
+        return super().get_filters_params(params)
+
+    def get_results(self, request):
+        self.keyset_page = None
+        self.result_count_estimated = False
+        self.result_count_capped = False
+        if ORDER_VAR in self.params:
+            super().get_results(request)
+            _, self.result_count_estimated, self.result_count_capped = (
+                self.paginator.estimate
+            )
+            return
+
+        paginator = KeysetPaginator(
+            self.queryset,
+            self.list_per_page,
+            self.model_admin.get_ordering(request),
+        )
+        try:
+            page = paginator.page(after=self.after, before=self.before)
+        except InvalidPage:
+            raise IncorrectLookupParameters
+        (
+            self.result_count,
+            self.result_count_estimated,
+            self.result_count_capped,
+        ) = paginator.estimate
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.result_list = page.object_list
+        self.can_show_all = False
+        self.multi_page = page.has_other_pages()
+        self.paginator = paginator
+        self.keyset_page = page
+        if page.has_previous():
+            self.first_page_url = self.get_query_string()
+            self.previous_page_url = self.get_query_string(
+                {BEFORE_VAR: page.first_key}
+            )
+        if page.has_next():
+            self.next_page_url = self.get_query_string({AFTER_VAR: page.last_key})
+
+
+class KeysetPaginationMixin:
+    # For ModelAdmins whose `ordering` is a keyset, see KeysetPaginator.
+    change_list_template = "admin/botreader/keyset_change_list.html"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+class DateCursorPagination(CursorPagination):
+    # newest first, served by the (date) indexes of messages and events
+    ordering = ("-date", "-id")
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+class IdCursorPagination(CursorPagination):
+    ordering = "id"
+    page_size_query_param = "page_size"
+    max_page_size = 1000
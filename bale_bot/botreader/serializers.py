@@ -0,0 +1,119 @@
+from rest_framework import serializers
+
+from .models import (
+    Chat,
+    ChatActivityRollup,
+    ChatEvent,
+    ClassificationJob,
+    Membership,
+    TextMessage,
+)
+from .services.classification import (
+    ClassificationError,
+    create_classification_job,
+    parse_filters,
+)
+
+
+class FieldSelectionMixin:
+    # Takes a `fields` argument listing the fields to keep, used for the
+    # ?fields= parameter of the read-only API.
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class ChatActivityRollupSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChatActivityRollup
+        fields = [
+            "chat",
+            "granularity",
+            "period_start",
+            "messages_count",
+            "type_counts",
+            "entries_count",
+            "exits_count",
+            "unique_senders_count",
+        ]
+
+
+class ClassificationJobSerializer(serializers.ModelSerializer):
+    # message_ids is only written, the ids are stored as rows of the job
+    message_ids = serializers.ListField(
+        child=serializers.UUIDField(), required=False, write_only=True
+    )
+
+    class Meta:
+        model = ClassificationJob
+        fields = [
+            "id",
+            "type",
+            "message_ids",
+            "filters",
+            "status",
+            "total",
+            "processed",
+            "updated",
+            "last_error",
+            "created_at",
+            "finished_at",
+        ]
+        read_only_fields = [
+            "status",
+            "total",
+            "processed",
+            "updated",
+            "last_error",
+            "created_at",
+            "finished_at",
+        ]
+
+    def validate_filters(self, filters):
+        if filters:
+            try:
+                parse_filters(filters)
+            except ClassificationError as e:
+                raise serializers.ValidationError(str(e))
+        return filters
+
+    def validate(self, data):
+        if bool(data.get("message_ids")) == bool(data.get("filters")):
+            raise serializers.ValidationError(
+                "Either message_ids or filters is required."
+            )
+        return data
+
+    def create(self, validated_data):
+        return create_classification_job(
+            validated_data["type"],
+            message_ids=validated_data.get("message_ids"),
+            filters=validated_data.get("filters"),
+        )
+
+
+class TextMessageSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    class Meta:
+        model = TextMessage
+        fields = ["id", "message_id", "date", "text", "type", "sender", "chat", "reply"]
+
+
+class ChatSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Chat
+        fields = ["id", "type", "title", "username", "first_name", "last_name"]
+
+
+class MembershipSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Membership
+        fields = ["id", "member", "chat", "exited", "last_membership_date"]
+
+
+class ChatEventSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ChatEvent
+        fields = ["id", "date", "user", "chat", "inviterUser", "event_type"]
@@ -0,0 +1,151 @@
+import csv
+import json
+import logging
+import time
+
+from ..models import ArchivedTextMessage
+from .hashtags import refresh_hashtag_counts
+
+logger = logging.getLogger(__name__)
+
+CSV_FORMAT = "csv"
+JSON_FORMAT = "json"
+NDJSON_FORMAT = "ndjson"
+FORMATS = (CSV_FORMAT, JSON_FORMAT, NDJSON_FORMAT)
+
+# characters read from a JSON array at a time
+JSON_READ_SIZE = 1 << 16
+
+
+class ArchiveImportError(ValueError):
+    pass
+
+
+def get_format(file_name):
+    extension = file_name.rsplit(".", 1)[-1].lower()
+    if extension == "jsonl":
+        return NDJSON_FORMAT
+    if extension in FORMATS:
+        return extension
+    raise ArchiveImportError(
+        "Can not tell the format of [{file_name}], expected one of {formats}".format(
+            file_name=file_name, formats=", ".join(FORMATS)
+        )
+    )
+
+
+def iter_records(file, format):
+    # Yields the records of an export one at a time, `file` is a text stream
+    # and is never read into memory as a whole.
+    if format == CSV_FORMAT:
+        return csv.DictReader(file)
+    if format == NDJSON_FORMAT:
+        return (json.loads(line) for line in file if line.strip())
+    if format == JSON_FORMAT:
+        return iter_json_array(file)
+    raise ArchiveImportError("Unknown format [{format}]".format(format=format))
+
+
+def iter_json_array(file):
+    # Decodes the items of a top-level JSON array one by one with raw_decode,
+    # keeping only the item being decoded and one read ahead in memory.
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    while True:
+        chunk = file.read(JSON_READ_SIZE)
+        buffer = buffer[position:] + chunk
+        position = 0
+        while True:
+            # skip whitespace and the separators between items
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise ArchiveImportError("A JSON export has to be an array")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the item continues in the next chunk
+                if not chunk:
+                    raise ArchiveImportError("The JSON export is truncated")
+                break
+            yield record
+        if not chunk:
+            raise ArchiveImportError("The JSON export is truncated")
+
+
+def get_hashtags(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        # exported by django-import-export as a comma separated list
+        value = value.strip("{}").split(",")
+    return [hashtag.strip() for hashtag in value if hashtag.strip()]
+
+
+def build_archived_message(record, chat_id):
+    if not isinstance(record, dict) or not record.get("sid"):
+        raise ArchiveImportError("Record has no sid: {record}".format(record=record))
+    sid = str(record["sid"]).strip()
+    return ArchivedTextMessage(
+        sid=sid,
+        chat_id=chat_id,
+        text=record.get("text") or "",
+        hashtags=get_hashtags(record.get("hashtags")),
+    )
+
+
+def upsert_archived_messages(archived_messages):
+    # One INSERT ... ON CONFLICT per chunk. A key repeated inside the chunk
+    # would make PostgreSQL reject the statement, so the last one wins.
+    archived_messages = list(
+        {message.sid: message for message in archived_messages}.values()
+    )
+    ArchivedTextMessage.objects.bulk_create(
+        archived_messages,
+        update_conflicts=True,
+        unique_fields=["sid", "chat_id"],
+        update_fields=["text", "hashtags"],
+    )
+    return len(archived_messages)
+
+
+def import_archived_messages(records, chat_id, batch_size=5000, progress=None):
+    # Every chunk is committed on its own, an interrupted import is resumed
+    # by running it again. `progress` is called after each chunk with the
+    # number of records read and the seconds spent so far.
+    started_at = time.monotonic()
+    read = 0
+    chunk = []
+    try:
+        for record in records:
+            chunk.append(build_archived_message(record, chat_id))
+            read += 1
+            if len(chunk) == batch_size:
+                upsert_archived_messages(chunk)
+                chunk = []
+                if progress:
+                    progress(read, time.monotonic() - started_at)
+        if chunk:
+            upsert_archived_messages(chunk)
+    finally:
+        # chunks committed before a failure stay imported
+        refresh_hashtag_counts([chat_id])
+    elapsed = time.monotonic() - started_at
+    if progress:
+        progress(read, elapsed)
+    logger.info(
+        "Imported {read} archived messages of chat [{chat_id}] in {elapsed:.1f}s".format(
+            read=read, chat_id=chat_id, elapsed=elapsed
+        )
+    )
+    return read
@@ -0,0 +1,204 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Calling these twice has the same effect as calling them once, so any failure
+# is retried. Other methods, like sendMessage, are only retried when the
+# request surely never reached Bale or was refused with a 429, a gateway error
+# may come after Bale already handled the request.
+IDEMPOTENT_METHODS = {"getupdates", "getChatAdministrators", "deletemessage"}
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+REFUSED_STATUS_CODE = 429
+
+# One pooled session per process, connections to tapi.bale.ai are kept alive
+# and reused by every service instead of opening a new one per call.
+_session = None
+_session_lock = threading.Lock()
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+class BaleApiError(Exception):
+    pass
+
+
+class CircuitOpenError(BaleApiError):
+    pass
+
+
+class CircuitBreaker:
+    # After `failure_threshold` consecutive failures calls are refused for
+    # `reset_timeout` seconds, then one call is let through to probe the API.
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # half open, the next failure opens the circuit again
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def get_circuit_breaker(method):
+    with _circuit_breakers_lock:
+        if method not in _circuit_breakers:
+            _circuit_breakers[method] = CircuitBreaker(
+                settings.BALE_API_CIRCUIT_FAILURE_THRESHOLD,
+                settings.BALE_API_CIRCUIT_RESET_TIMEOUT,
+            )
+        return _circuit_breakers[method]
+
+
+def get_backoff_delay(attempt):
+    # exponential backoff with full jitter
+    delay = min(
+        settings.BALE_API_BACKOFF_MAX, settings.BALE_API_BACKOFF_BASE * 2**attempt
+    )
+    return random.uniform(0, delay)
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+def build_session():
+    adapter = HTTPAdapter(
+        pool_connections=settings.BALE_API_POOL_SIZE,
+        pool_maxsize=settings.BALE_API_POOL_SIZE,
+        # retries are handled by call_with_retry
+        max_retries=0,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_method_url(method):
+    return settings.BALE_BOT_BASE_URL + method
+
+
+def get_timeout(read_timeout=None):
+    return (
+        settings.BALE_API_CONNECT_TIMEOUT,
+        read_timeout or settings.BALE_API_READ_TIMEOUT,
+    )
+
+
+def post(method, data=None, params=None, read_timeout=None):
+    # Raises requests.RequestException when Bale can not be reached in time.
+    started_at = time.perf_counter()
+    status = "error"
+    try:
+        response = get_session().post(
+            get_method_url(method),
+            data=data,
+            params=params,
+            timeout=get_timeout(read_timeout),
+        )
+        status = str(response.status_code)
+        return response
+    finally:
+        metrics.record_http_request(method, status, time.perf_counter() - started_at)
+
+
+def is_connect_error(error):
+    # Whether the request failed while connecting, so it surely never reached
+    # Bale. A connection dropped while waiting for the answer may come after
+    # Bale already handled the request.
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+
+
+def call_with_retry(method, data=None, params=None, read_timeout=None, attempts=None):
+    # Returns the parsed response body of the first definitive answer and
+    # raises BaleApiError once every attempt failed or the circuit is open.
+    attempts = attempts or settings.BALE_API_RETRIES + 1
+    circuit_breaker = get_circuit_breaker(method)
+    error = None
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(get_backoff_delay(attempt - 1))
+        if not circuit_breaker.allow():
+            raise CircuitOpenError(
+                "Circuit of Bale API method [{method}] is open".format(method=method)
+            )
+        try:
+            response = post(method, data=data, params=params, read_timeout=read_timeout)
+        except requests.RequestException as e:
+            circuit_breaker.record_failure()
+            error = e
+            if method not in IDEMPOTENT_METHODS and not is_connect_error(e):
+                break
+            continue
+        if response.status_code in RETRY_STATUS_CODES:
+            circuit_breaker.record_failure()
+            error = "HTTP {status_code}: {text}".format(
+                status_code=response.status_code, text=response.text[:200]
+            )
+            if (
+                method not in IDEMPOTENT_METHODS
+                and response.status_code != REFUSED_STATUS_CODE
+            ):
+                break
+            continue
+        circuit_breaker.record_success()
+        try:
+            return response.json()
+        except ValueError as e:
+            raise BaleApiError(
+                "Bale API method [{method}] returned an invalid body".format(method=method)
+            ) from e
+    raise BaleApiError(
+        "Calling Bale API method [{method}] failed {attempts} times: {error}".format(
+            method=method, attempts=attempt + 1, error=repr(error)
+        )
+    )
+
+
+def call(method, data=None, params=None, read_timeout=None):
+    # Returns the parsed response body, or None when the call failed.
+    try:
+        return call_with_retry(method, data=data, params=params, read_timeout=read_timeout)
+    except BaleApiError as e:
+        logger.error(e)
+        return None
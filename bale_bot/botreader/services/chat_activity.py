@@ -0,0 +1,169 @@
+import logging
+import operator
+from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
+from django.db import DatabaseError, transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from ..models import ChatActivityRollup, ChatEvent, TextMessage
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+Granularity = ChatActivityRollup.Granularity
+
+TRUNC_KINDS = {Granularity.HOUR: "hour", Granularity.DAY: "day"}
+PERIOD_LENGTHS = {
+    Granularity.HOUR: timedelta(hours=1),
+    Granularity.DAY: timedelta(days=1),
+}
+
+ROLLUP_FIELDS = (
+    "messages_count",
+    "type_counts",
+    "entries_count",
+    "exits_count",
+    "unique_senders_count",
+)
+
+
+def get_period_start(date, granularity):
+    # periods follow the local time zone, like Trunc does in the database
+    if timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    date = timezone.localtime(date).replace(minute=0, second=0, microsecond=0)
+    if granularity == Granularity.DAY:
+        date = date.replace(hour=0)
+    return date
+
+
+def get_empty_rollup():
+    return {
+        "messages_count": 0,
+        "type_counts": {},
+        "entries_count": 0,
+        "exits_count": 0,
+        "unique_senders_count": 0,
+    }
+
+
+def refresh_chat_activity_on_commit(chat_dates):
+    # `chat_dates` are (chat_id, date) pairs of saved messages and events.
+    # Periods are recomputed once the page is committed, so the counts
+    # include every row the page wrote.
+    chat_dates = [
+        (chat_id, date) for chat_id, date in chat_dates if chat_id is not None
+    ]
+    if chat_dates:
+        transaction.on_commit(lambda: _refresh_chat_activity(chat_dates))
+
+
+def _refresh_chat_activity(chat_dates):
+    try:
+        refresh_chat_activity(chat_dates)
+    except DatabaseError as e:
+        # the page is already committed, so the failure is counted for
+        # alerting and the rollups are rebuilt by
+        # `manage.py backfill_chat_activity`
+        metrics.record_chat_activity_refresh_error()
+        logger.exception(
+            "Refreshing the activity of chats failed: {error}".format(error=e)
+        )
+
+
+def refresh_chat_activity(chat_dates):
+    for granularity in Granularity:
+        rebuild_chat_activity(
+            granularity,
+            periods={
+                (chat_id, get_period_start(date, granularity))
+                for chat_id, date in chat_dates
+            },
+        )
+
+
+def rebuild_chat_activity(
+    granularity, start=None, end=None, chat_ids=None, periods=None
+):
+    # Recomputes the rollups of the periods between start and end, limited to
+    # `chat_ids`, or of the (chat_id, period_start) pairs in `periods`.
+    # Periods without any activity get no row, unless listed in `periods`,
+    # whose counts are then reset to zero.
+    kind = TRUNC_KINDS[granularity]
+    messages = TextMessage.objects.order_by()
+    events = ChatEvent.objects.order_by()
+    if periods is not None:
+        # only the rows of the listed periods are read, however far apart
+        # they are, each one is a range on the (chat, date) index of messages
+        # and on the date index of events. An empty `periods` matches nothing.
+        in_periods = reduce(
+            operator.or_,
+            (
+                Q(
+                    chat_id=chat_id,
+                    date__gte=period_start,
+                    date__lt=period_start + PERIOD_LENGTHS[granularity],
+                )
+                for chat_id, period_start in periods
+            ),
+            Q(pk__in=[]),
+        )
+        messages = messages.filter(in_periods)
+        events = events.filter(in_periods)
+    else:
+        messages = messages.filter(date__gte=start, date__lt=end)
+        events = events.filter(date__gte=start, date__lt=end)
+        if chat_ids is not None:
+            messages = messages.filter(chat__in=chat_ids)
+            events = events.filter(chat__in=chat_ids)
+
+    rollups = defaultdict(get_empty_rollup)
+    for period in periods or ():
+        rollups.setdefault(period, get_empty_rollup())
+    for row in (
+        messages.annotate(period_start=Trunc("date", kind))
+        .values("chat", "period_start", "type")
+        .annotate(count=Count("id"))
+    ):
+        rollup = rollups[(row["chat"], row["period_start"])]
+        rollup["messages_count"] += row["count"]
+        rollup["type_counts"][row["type"]] = row["count"]
+    for row in (
+        messages.annotate(period_start=Trunc("date", kind))
+        .values("chat", "period_start")
+        .annotate(unique_senders_count=Count("sender", distinct=True))
+    ):
+        rollups[(row["chat"], row["period_start"])]["unique_senders_count"] = row[
+            "unique_senders_count"
+        ]
+    for row in (
+        events.annotate(period_start=Trunc("date", kind))
+        .values("chat", "period_start", "event_type")
+        .annotate(count=Count("id"))
+    ):
+        rollup = rollups[(row["chat"], row["period_start"])]
+        if row["event_type"] == ChatEvent.EventType.ENTRY:
+            rollup["entries_count"] = row["count"]
+        else:
+            rollup["exits_count"] = row["count"]
+
+    if periods is not None:
+        rollups = {period: rollups[period] for period in periods}
+    ChatActivityRollup.objects.bulk_create(
+        [
+            ChatActivityRollup(
+                chat_id=chat_id,
+                granularity=granularity,
+                period_start=period_start,
+                **counts,
+            )
+            for (chat_id, period_start), counts in rollups.items()
+        ],
+        update_conflicts=True,
+        unique_fields=["chat_id", "granularity", "period_start"],
+        update_fields=[*ROLLUP_FIELDS, "updated_at"],
+    )
+    return len(rollups)
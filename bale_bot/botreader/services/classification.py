@@ -0,0 +1,286 @@
+import logging
+from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import F, Q, Value, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from bale_bot.settings import (
+    BOTREADER_CLASSIFICATION_CHUNK_SIZE,
+    BOTREADER_CLASSIFICATION_LEASE_SECONDS,
+    BOTREADER_CLASSIFICATION_MAX_ATTEMPTS,
+)
+from ..models import ClassificationJob, ClassificationJobMessage, TextMessage
+from ..pagination import Row
+from .chat_activity import refresh_chat_activity_on_commit
+from .message_stats import apply_type_changes_to_stats
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATE = "PENDING"
+RUNNING_STATE = "RUNNING"
+DONE_STATE = "DONE"
+FAILED_STATE = "FAILED"
+
+TEXT_MESSAGE_TYPES = [value for value, _ in TextMessage.TEXT_MESSAGE_TYPE]
+DATE_FIELD = TextMessage._meta.get_field("date")
+ID_FIELD = TextMessage._meta.get_field("id")
+
+
+class ClassificationError(ValueError):
+    pass
+
+
+def parse_filters(filters):
+    # Turns the filters of a job, like
+    #   {"chat": [-100], "sender": [12], "type": [""], "since": "2024-01-01T00:00"}
+    # into TextMessage lookups. chat, sender and type take lists, since and
+    # until ISO 8601 datetimes.
+    if not isinstance(filters, dict):
+        raise ClassificationError("Filters must be an object.")
+    lookups = {}
+    for name, value in filters.items():
+        if name in ("chat", "sender"):
+            if not isinstance(value, list) or not all(
+                isinstance(item, int) for item in value
+            ):
+                raise ClassificationError(f"{name} must be a list of ids.")
+            lookups[f"{name}__in"] = value
+        elif name == "type":
+            if not isinstance(value, list) or not set(value) <= set(TEXT_MESSAGE_TYPES):
+                raise ClassificationError(
+                    f"type must be a list of {TEXT_MESSAGE_TYPES}."
+                )
+            lookups["type__in"] = value
+        elif name in ("since", "until"):
+            try:
+                date = parse_datetime(value) if isinstance(value, str) else None
+            except ValueError:
+                date = None
+            if date is None:
+                raise ClassificationError(f"{name} must be an ISO 8601 datetime.")
+            if timezone.is_naive(date):
+                date = timezone.make_aware(date)
+            lookups["date__gte" if name == "since" else "date__lt"] = date
+        else:
+            raise ClassificationError(f"Unknown filter {name}.")
+    if not lookups:
+        raise ClassificationError("At least one filter is required.")
+    return lookups
+
+
+@transaction.atomic
+def create_classification_job(type, message_ids=None, filters=None):
+    if type not in TEXT_MESSAGE_TYPES:
+        raise ClassificationError(f"type must be one of {TEXT_MESSAGE_TYPES}.")
+    if bool(message_ids) == bool(filters):
+        raise ClassificationError("Either message ids or filters are required.")
+    if filters:
+        parse_filters(filters)
+        return ClassificationJob.objects.create(type=type, filters=filters)
+    # a repeated id is listed once, in the order it first appears
+    message_ids = list(dict.fromkeys(message_ids))
+    job = ClassificationJob.objects.create(type=type, total=len(message_ids))
+    ClassificationJobMessage.objects.bulk_create(
+        [
+            ClassificationJobMessage(job=job, position=position, message_id=message_id)
+            for position, message_id in enumerate(message_ids, start=1)
+        ],
+        batch_size=BOTREADER_CLASSIFICATION_CHUNK_SIZE,
+    )
+    return job
+
+
+@transaction.atomic
+def create_classification_job_for_queryset(type, queryset):
+    # The ids of the messages in `queryset` are copied into the job's rows by
+    # the database with one INSERT ... SELECT in (date, id) order, so a
+    # selection of millions of messages is never loaded into Python.
+    if type not in TEXT_MESSAGE_TYPES:
+        raise ClassificationError(f"type must be one of {TEXT_MESSAGE_TYPES}.")
+    job = ClassificationJob.objects.create(type=type)
+    # a plain query on the ids, like set_text_messages_type
+    positions = (
+        TextMessage.objects.filter(id__in=queryset.values("id"))
+        .annotate(
+            position=Window(RowNumber(), order_by=[F("date").asc(), F("id").asc()])
+        )
+        .order_by()
+        .values_list("id", "position")
+    )
+    sql, params = positions.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {table} (job_id, position, message_id) "
+            "SELECT %s, position, id FROM ({positions}) AS positions".format(
+                table=ClassificationJobMessage._meta.db_table, positions=sql
+            ),
+            [job.pk, *params],
+        )
+        job.total = cursor.rowcount
+    job.save(update_fields=["total"])
+    return job
+
+
+@transaction.atomic
+def set_text_messages_type(queryset, type):
+    # Sets the type of the messages in `queryset` and applies the change to
+    # the stats of their senders and the activity of their chats. Returns how
+    # many messages changed type.
+    # locked through a plain query on the ids, `queryset` may come from the
+    # admin with joins, annotations or DISTINCT
+    changes = list(
+        TextMessage.objects.filter(id__in=queryset.values("id"))
+        .exclude(type=type)
+        .select_for_update()
+        .order_by()
+        .values_list("id", "sender_id", "chat_id", "date", "type")
+    )
+    if not changes:
+        return 0
+    updated = TextMessage.objects.filter(
+        id__in=[message_id for message_id, *_ in changes]
+    ).update(type=type)
+    apply_type_changes_to_stats(
+        (sender_id, old_type, type) for _, sender_id, _, _, old_type in changes
+    )
+    refresh_chat_activity_on_commit(
+        (chat_id, date) for _, _, chat_id, date, _ in changes
+    )
+    return updated
+
+
+@transaction.atomic
+def claim_classification_job(job_id=None):
+    # A pending job, or a running one whose worker stopped saving progress,
+    # is marked RUNNING. Jobs locked by another worker are skipped.
+    now = timezone.now()
+    jobs = ClassificationJob.objects.all()
+    if job_id is not None:
+        jobs = jobs.filter(pk=job_id)
+    job = (
+        jobs.select_for_update(skip_locked=True)
+        .filter(
+            Q(status=PENDING_STATE)
+            | Q(
+                status=RUNNING_STATE,
+                locked_at__lt=now
+                - timedelta(seconds=BOTREADER_CLASSIFICATION_LEASE_SECONDS),
+            )
+        )
+        .order_by("created_at")
+        .first()
+    )
+    if job is None:
+        return None
+    job.status = RUNNING_STATE
+    job.locked_at = now
+    job.attempts += 1
+    if job.total is None:
+        job.total = TextMessage.objects.filter(**parse_filters(job.filters)).count()
+    job.save(update_fields=["status", "locked_at", "attempts", "total"])
+    return job
+
+
+@transaction.atomic
+def run_classification_chunk(job_id, chunk_size):
+    # Classifies the next chunk of the job and saves its progress in the
+    # same transaction. Returns whether the job has messages left.
+    job = ClassificationJob.objects.select_for_update().get(pk=job_id)
+    if job.status != RUNNING_STATE:
+        return False
+    if not job.filters:
+        # a chunk is the next range of positions, read from the index of the
+        # (job, position) constraint
+        message_ids = list(
+            ClassificationJobMessage.objects.filter(
+                job_id=job_id,
+                position__gt=job.processed,
+                position__lte=job.processed + chunk_size,
+            ).values_list("message_id", flat=True)
+        )
+        processed = len(message_ids)
+    else:
+        # filters jobs walk the messages in (date, id) order, so a chunk
+        # touches the activity of a short span of periods
+        messages = TextMessage.objects.filter(**parse_filters(job.filters))
+        if job.cursor_id is not None:
+            messages = messages.alias(keyset=Row(F("date"), F("id"))).filter(
+                keyset__gt=Row(
+                    Value(job.cursor_date, output_field=DATE_FIELD),
+                    Value(job.cursor_id, output_field=ID_FIELD),
+                )
+            )
+        keys = list(
+            messages.order_by("date", "id").values_list("date", "id")[:chunk_size]
+        )
+        message_ids = [message_id for _, message_id in keys]
+        processed = len(keys)
+        if keys:
+            job.cursor_date, job.cursor_id = keys[-1]
+
+    if not processed:
+        job.status = DONE_STATE
+        job.locked_at = None
+        job.finished_at = timezone.now()
+        job.save(update_fields=["status", "locked_at", "finished_at"])
+        # the listed ids are not needed once the job is done
+        ClassificationJobMessage.objects.filter(job_id=job_id).delete()
+        logger.info(
+            "Classification job [{job_id}] changed {updated} of {processed} "
+            "messages".format(
+                job_id=job.pk, updated=job.updated, processed=job.processed
+            )
+        )
+        return False
+
+    job.updated += set_text_messages_type(
+        TextMessage.objects.filter(id__in=message_ids), job.type
+    )
+    job.processed += processed
+    job.locked_at = timezone.now()
+    job.save(
+        update_fields=["updated", "processed", "cursor_date", "cursor_id", "locked_at"]
+    )
+    return True
+
+
+def run_classification_job(job, chunk_size, should_stop=None, on_progress=None):
+    # Runs a claimed job chunk by chunk. A job stopped by `should_stop` goes
+    # back to PENDING and continues from its last saved chunk.
+    try:
+        while run_classification_chunk(job.pk, chunk_size):
+            if on_progress is not None:
+                job.refresh_from_db(fields=["processed", "updated", "total"])
+                on_progress(job)
+            if should_stop is not None and should_stop():
+                ClassificationJob.objects.filter(
+                    pk=job.pk, status=RUNNING_STATE
+                ).update(
+                    status=PENDING_STATE, locked_at=None, attempts=F("attempts") - 1
+                )
+                return
+    except Exception as e:
+        logger.exception(
+            "Classification job [{job_id}] failed: {error}".format(
+                job_id=job.pk, error=e
+            )
+        )
+        ClassificationJob.objects.filter(pk=job.pk).update(
+            status=(
+                FAILED_STATE
+                if job.attempts >= BOTREADER_CLASSIFICATION_MAX_ATTEMPTS
+                else PENDING_STATE
+            ),
+            locked_at=None,
+            last_error=repr(e),
+        )
+
+
+def process_classification_jobs(chunk_size, should_stop=None):
+    job = claim_classification_job()
+    if job is None:
+        return 0
+    run_classification_job(job, chunk_size, should_stop=should_stop)
+    return 1
@@ -0,0 +1,75 @@
+import logging
+from django.db import connection, transaction
+from django.db.models import F, Sum
+
+from ..models import ArchivedHashtagCount
+
+logger = logging.getLogger(__name__)
+
+# A hashtag repeated in one message is counted once, like the __contains
+# filter it stands for.
+REFRESH_HASHTAG_COUNTS_SQL = """
+    INSERT INTO botreader_archivedhashtagcount (chat_id, hashtag, count)
+    SELECT message.chat_id, hashtag, COUNT(DISTINCT message.id)
+    FROM botreader_archivedtextmessage AS message,
+        unnest(message.hashtags) AS hashtag
+    WHERE message.chat_id = ANY(%s)
+    GROUP BY message.chat_id, hashtag
+"""
+
+
+@transaction.atomic
+def refresh_hashtag_counts(chat_ids):
+    # Recounts every hashtag of the given chats, used after imports and
+    # deletions which may touch any number of messages.
+    chat_ids = list(set(chat_ids))
+    if not chat_ids:
+        return
+    ArchivedHashtagCount.objects.filter(chat_id__in=chat_ids).delete()
+    with connection.cursor() as cursor:
+        cursor.execute(REFRESH_HASHTAG_COUNTS_SQL, [chat_ids])
+    logger.info(
+        "Hashtag counts of chats {chat_ids} refreshed".format(chat_ids=chat_ids)
+    )
+
+
+@transaction.atomic
+def update_hashtag_counts(chat_id, old_hashtags, new_hashtags):
+    # Applies the edit of one message's hashtags without recounting the chat.
+    old_hashtags = set(old_hashtags or ())
+    new_hashtags = set(new_hashtags or ())
+    added = new_hashtags - old_hashtags
+    removed = old_hashtags - new_hashtags
+    if added:
+        ArchivedHashtagCount.objects.bulk_create(
+            [
+                ArchivedHashtagCount(chat_id=chat_id, hashtag=hashtag, count=0)
+                for hashtag in added
+            ],
+            ignore_conflicts=True,
+        )
+        ArchivedHashtagCount.objects.filter(chat_id=chat_id, hashtag__in=added).update(
+            count=F("count") + 1
+        )
+    if removed:
+        ArchivedHashtagCount.objects.filter(
+            chat_id=chat_id, hashtag__in=removed
+        ).update(count=F("count") - 1)
+        ArchivedHashtagCount.objects.filter(
+            chat_id=chat_id, hashtag__in=removed, count=0
+        ).delete()
+
+
+def get_top_hashtags(chat_id=None, limit=50):
+    # Returns (hashtag, count) pairs of a chat, or of all chats summed.
+    if chat_id is not None:
+        hashtag_counts = ArchivedHashtagCount.objects.filter(chat_id=chat_id)
+    else:
+        hashtag_counts = ArchivedHashtagCount.objects.values("hashtag").annotate(
+            count=Sum("count")
+        )
+    return list(
+        hashtag_counts.order_by("-count", "hashtag").values_list("hashtag", "count")[
+            :limit
+        ]
+    )
@@ -1,63 +1,162 @@
-import requests
 import logging
+from copy import copy
+from django.db import IntegrityError, transaction
 
-from ..models import Chat, User
-from bale_bot.settings import BALE_BOT_BASE_URL
+from ..models import Chat, ChatEvent, SideEffect, User
+from .cache import LRUCache
+from .chat_activity import refresh_chat_activity_on_commit
+from bale_bot.settings import BOTREADER_CACHE_SIZE, BOTREADER_CACHE_TTL
 
 logger = logging.getLogger(__name__)
 
+# Users and chats seen by this process, most messages come from the same few
+# hundred users and chats so most lookups never reach the database.
+user_cache = LRUCache(BOTREADER_CACHE_SIZE, BOTREADER_CACHE_TTL)
+chat_cache = LRUCache(BOTREADER_CACHE_SIZE, BOTREADER_CACHE_TTL)
+
 def get_or_create_user(uid, username, name):
     # The difference between this method and Django's get_or_create method 
     # is the get method only works based on id, not all fields.    
-    try:
-        user = User.objects.get(uid=uid)
-        # Check if name or username of this user is updated
-        if user.name != name or user.username != username:
-            user.name = name
-            user.username = username
-            user.save()
-    except User.DoesNotExist as e:
-        user = User.objects.create(uid=uid, name=name, username=username)
+    user = user_cache.get(uid)
+    if user is not None and user.name == name and user.username == username:
+        return user
+    if user is None:
+        try:
+            user = User.objects.get(uid=uid)
+        except User.DoesNotExist as e:
+            user = User.objects.create(uid=uid, name=name, username=username)
+    # Check if name or username of this user is updated
+    if user.name != name or user.username != username:
+        # never change the cached instance before the write is committed
+        user = copy(user)
+        user.name = name
+        user.username = username
+        user.save(update_fields=['name', 'username'])
+    cache_on_commit(user_cache, {uid: user})
     return user
 
 
 def get_or_create_chat(message_chat):
     # The difference between this method and Django's get_or_create method 
     # is the get method only works based on id, not all fields.    
-    try:
-        chat = Chat.objects.get(id=message_chat['id'])
-    except Chat.DoesNotExist as e:
-        if 'title' in message_chat:
-            title = message_chat['title']
-        else:
-            title = ''
-        Chat.objects.create(id = message_chat['id'], first_name = message_chat['first_name'], last_name = message_chat['last_name'],
-            username = message_chat['username'], type = message_chat['type'], title = title)
-        chat = Chat.objects.get(id=message_chat['id'])
+    chat = chat_cache.get(message_chat['id'])
+    if chat is None:
+        try:
+            chat = Chat.objects.get(id=message_chat['id'])
+        except Chat.DoesNotExist as e:
+            chat = new_chat(message_chat)
+            chat.save(force_insert=True)
+        cache_on_commit(chat_cache, {chat.id: chat})
     return chat
 
-def get_send_message_url():
-    return BALE_BOT_BASE_URL + 'sendMessage'
+
+def get_or_create_users(message_users):
+    # Bulk version of get_or_create_user for a page of messages, users are
+    # read with one query and only new or renamed users are written.
+    latest_users = {
+        message_user['id']: (message_user['username'], message_user['first_name'])
+        for message_user in message_users
+    }
+    users = {}
+    for uid in latest_users:
+        user = user_cache.get(uid)
+        if user is not None:
+            users[uid] = user
+    cached_uids = set(users)
+    users.update(User.objects.in_bulk([uid for uid in latest_users if uid not in users]))
+    created_users = []
+    updated_users = []
+    for uid, (username, name) in latest_users.items():
+        user = users.get(uid)
+        if user is None:
+            users[uid] = User(uid=uid, name=name, username=username)
+            created_users.append(users[uid])
+        elif user.name != name or user.username != username:
+            users[uid] = copy(user)
+            users[uid].name = name
+            users[uid].username = username
+            updated_users.append(users[uid])
+    # an upsert, so a user created by another worker in the meantime is
+    # renamed instead of failing the page with an IntegrityError
+    User.objects.bulk_create(
+        created_users + updated_users,
+        update_conflicts=True,
+        unique_fields=['uid'],
+        update_fields=['name', 'username'],
+    )
+    cache_on_commit(
+        user_cache,
+        {uid: user for uid, user in users.items() if uid not in cached_uids},
+    )
+    cache_on_commit(user_cache, {user.uid: user for user in updated_users})
+    return users
 
 
-def send_message(chat_id, message, reply_message_id=None):
-    url = get_send_message_url()
+def get_or_create_chats(message_chats):
+    # Bulk version of get_or_create_chat for a page of messages.
+    latest_chats = {message_chat['id']: message_chat for message_chat in message_chats}
+    chats = {}
+    for chat_id in latest_chats:
+        chat = chat_cache.get(chat_id)
+        if chat is not None:
+            chats[chat_id] = chat
+    cached_chat_ids = set(chats)
+    chats.update(Chat.objects.in_bulk([chat_id for chat_id in latest_chats if chat_id not in chats]))
+    created_chats = [
+        new_chat(message_chat)
+        for chat_id, message_chat in latest_chats.items()
+        if chat_id not in chats
+    ]
+    # chats are not updated on ingest, one created by another worker in the
+    # meantime is left as it is
+    Chat.objects.bulk_create(created_chats, ignore_conflicts=True)
+    chats.update((chat.id, chat) for chat in created_chats)
+    cache_on_commit(
+        chat_cache,
+        {chat_id: chat for chat_id, chat in chats.items() if chat_id not in cached_chat_ids},
+    )
+    return chats
+
+
+def create_chat_event(**fields):
+    # The unique constraint on ChatEvent rejects an event that was already
+    # recorded, returns whether this call created it.
+    try:
+        with transaction.atomic():
+            chat_event = ChatEvent.objects.create(**fields)
+    except IntegrityError:
+        return False
+    refresh_chat_activity_on_commit([(chat_event.chat_id, chat_event.date)])
+    return True
 
-    if reply_message_id is None:
-        request_data = [('chat_id', chat_id), ('text', message)]
+
+def cache_on_commit(cache, entries):
+    # Rows read or written inside a transaction are only cached once it is
+    # committed, a rolled back page must not leave rows in the cache that
+    # do not exist in the database.
+    entries = dict(entries)
+    transaction.on_commit(lambda: [cache.set(key, value) for key, value in entries.items()])
+
+
+def cache_stats():
+    return {'users': user_cache.stats(), 'chats': chat_cache.stats()}
+
+
+def new_chat(message_chat):
+    if 'title' in message_chat:
+        title = message_chat['title']
     else:
-        request_data = [('chat_id', chat_id), ('text', message), ('reply_to_message_id', reply_message_id)]
+        title = ''
+    return Chat(id = message_chat['id'], first_name = message_chat['first_name'], last_name = message_chat['last_name'],
+        username = message_chat['username'], type = message_chat['type'], title = title)
+
 
+def claim_side_effect(key):
+    # Returns whether the side effect identified by `key` may be performed,
+    # an update processed again after a crash finds its key already stored.
     try:
-        request = requests.post(
-            url=url, data=request_data)
-        if request.status_code == 200:
-            logger.info(
-                'message sent successfully for this chat_id : ' + str(chat_id))
-            return True
-        else:
-            logger.error(
-                'message can not send successfully with this error: ' + request.text)
-            return False
-    except Exception as e:
-        print('%s' % type(e))
+        with transaction.atomic():
+            SideEffect.objects.create(key=key)
+    except IntegrityError:
+        return False
+    return True
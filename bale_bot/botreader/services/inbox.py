@@ -0,0 +1,140 @@
+import logging
+import random
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from bale_bot.settings import (
+    BOTREADER_INBOX_BACKOFF_BASE,
+    BOTREADER_INBOX_BACKOFF_MAX,
+    BOTREADER_INBOX_LEASE_SECONDS,
+    BOTREADER_INBOX_MAX_ATTEMPTS,
+)
+from ..models import SideEffect, UpdateInbox
+from . import services
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATE = "PENDING"
+PROCESSING_STATE = "PROCESSING"
+DONE_STATE = "DONE"
+FAILED_STATE = "FAILED"
+
+
+def store_updates(updates):
+    # update_id is the primary key, so a redelivered update is ignored
+    UpdateInbox.objects.bulk_create(
+        [
+            UpdateInbox(update_id=update["update_id"], payload=update)
+            for update in updates
+        ],
+        ignore_conflicts=True,
+    )
+
+
+@transaction.atomic
+def claim_updates(batch_size):
+    # Pending updates past their backoff, and updates whose worker did not
+    # finish them within the lease, are marked PROCESSING in a short
+    # transaction. Rows locked by another worker are skipped, so workers never
+    # claim the same update.
+    now = timezone.now()
+    claimable = Q(
+        Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+        status=PENDING_STATE,
+    ) | Q(
+        status=PROCESSING_STATE,
+        locked_at__lt=now - timedelta(seconds=BOTREADER_INBOX_LEASE_SECONDS),
+    )
+    entries = list(
+        UpdateInbox.objects.select_for_update(skip_locked=True)
+        .filter(claimable)
+        .order_by("update_id")[:batch_size]
+    )
+    UpdateInbox.objects.filter(
+        update_id__in=[entry.update_id for entry in entries]
+    ).update(status=PROCESSING_STATE, locked_at=now, attempts=F("attempts") + 1)
+    for entry in entries:
+        entry.attempts += 1
+    return entries
+
+
+def process_inbox_batch(batch_size):
+    # An update is marked DONE in the transaction that saves it, so an
+    # update is either fully processed or processed again from scratch.
+    entries = claim_updates(batch_size)
+    if not entries:
+        return 0
+
+    try:
+        with transaction.atomic():
+            services.insert_messages([entry.payload for entry in entries])
+            mark_done(entries)
+    except Exception:
+        # retry one by one so a single bad update does not hold back the batch
+        for entry in entries:
+            try:
+                with transaction.atomic():
+                    services.insert_messages([entry.payload])
+                    mark_done([entry])
+            except Exception as e:
+                logger.exception(
+                    "Processing update [{update_id}] failed: {error}".format(
+                        update_id=entry.update_id, error=e
+                    )
+                )
+                mark_failed(entry, e)
+    return len(entries)
+
+
+def mark_done(entries):
+    UpdateInbox.objects.filter(
+        update_id__in=[entry.update_id for entry in entries]
+    ).update(status=DONE_STATE, locked_at=None, processed_at=timezone.now())
+
+
+def get_next_attempt_at(attempts):
+    # exponential backoff with jitter, so a failing update does not take
+    # every batch
+    delay = min(
+        BOTREADER_INBOX_BACKOFF_MAX,
+        BOTREADER_INBOX_BACKOFF_BASE * 2 ** (attempts - 1),
+    )
+    return timezone.now() + timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def mark_failed(entry, error):
+    # the update is claimed again after its backoff until it runs out of
+    # attempts
+    UpdateInbox.objects.filter(update_id=entry.update_id).update(
+        status=FAILED_STATE
+        if entry.attempts >= BOTREADER_INBOX_MAX_ATTEMPTS
+        else PENDING_STATE,
+        locked_at=None,
+        next_attempt_at=get_next_attempt_at(entry.attempts),
+        last_error=repr(error),
+    )
+
+
+def prune_inbox(before, batch_size=1000):
+    # Deletes updates processed and side effects performed before `before`
+    # in batches, so neither table grows forever and no delete holds many
+    # locks. Bale only redelivers updates past the committed offset, so
+    # their keys are not needed for long.
+    pruned = {}
+    for name, queryset in (
+        (
+            "updates",
+            UpdateInbox.objects.filter(status=DONE_STATE, processed_at__lt=before),
+        ),
+        ("side_effects", SideEffect.objects.filter(created_at__lt=before)),
+    ):
+        pruned[name] = 0
+        while True:
+            keys = list(queryset.values_list("pk", flat=True)[:batch_size])
+            if not keys:
+                break
+            queryset.model.objects.filter(pk__in=keys).delete()
+            pruned[name] += len(keys)
+    return pruned
@@ -2,12 +2,14 @@ import datetime
 import logging
 
 from ..models import Chat, User, ChatEvent, Membership
-from .helpers import get_or_create_user, get_or_create_chat
+from .helpers import get_or_create_user, get_or_create_chat, create_chat_event
+from .metrics import instrumented
 
 logger = logging.getLogger(__name__)
 
 
 
+@instrumented("left_member_from_chat", "leave")
 def left_member_from_chat(message):
     if not 'left_chat_member' in message:
         raise ValueError('left_chat_member object is required')
@@ -25,9 +27,5 @@ def left_member_from_chat(message):
     chat = get_or_create_chat(message['chat'])
 
     # set exited in membership and log in chat event
-    membership, created = Membership.objects.get_or_create(chat=chat, member=user)
-    membership.exited = True
-    membership.save()
-    if not ChatEvent.objects.filter(user=user.uid, chat=chat_id, date=date, event_type=ChatEvent.EventType.EXIT).count() > 0:
-        ChatEvent.objects.create(
-            user=user, chat=chat, date=date, event_type=ChatEvent.EventType.EXIT)
+    Membership.objects.update_or_create(chat=chat, member=user, defaults={'exited': True})
+    create_chat_event(user=user, chat=chat, date=date, event_type=ChatEvent.EventType.EXIT)
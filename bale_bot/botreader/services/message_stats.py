@@ -0,0 +1,147 @@
+import logging
+from collections import defaultdict
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from ..models import TextMessage, UserMessageStats
+
+logger = logging.getLogger(__name__)
+
+QUESTION_TYPES = ("QUESTION",)
+ANSWER_AND_SUGGESTION_TYPES = ("ANSWER", "SUGGESTION")
+
+STATS_FIELDS = (
+    "messages_count",
+    "reply_messages_count",
+    "questions_count",
+    "answers_and_suggestions_count",
+)
+
+
+def get_message_stats_deltas(text_message):
+    return (
+        1,
+        int(text_message.reply_id is not None),
+        int(text_message.type in QUESTION_TYPES),
+        int(text_message.type in ANSWER_AND_SUGGESTION_TYPES),
+    )
+
+
+def add_text_messages_to_stats(text_messages):
+    # Called with every page of newly saved messages. Senders whose counts
+    # grow by the same amounts share one UPDATE, so a page costs a handful of
+    # queries and concurrent workers never overwrite each other's counts.
+    deltas = defaultdict(lambda: [0, 0, 0, 0])
+    for text_message in text_messages:
+        if text_message.sender_id is None:
+            continue
+        sender_deltas = deltas[text_message.sender_id]
+        for index, delta in enumerate(get_message_stats_deltas(text_message)):
+            sender_deltas[index] += delta
+    if not deltas:
+        return
+
+    UserMessageStats.objects.bulk_create(
+        [UserMessageStats(user_id=user_id) for user_id in deltas],
+        ignore_conflicts=True,
+    )
+    senders_by_deltas = defaultdict(list)
+    for user_id, sender_deltas in deltas.items():
+        senders_by_deltas[tuple(sender_deltas)].append(user_id)
+    for sender_deltas, user_ids in senders_by_deltas.items():
+        UserMessageStats.objects.filter(user_id__in=user_ids).update(
+            updated_at=timezone.now(),
+            **{
+                field: F(field) + delta
+                for field, delta in zip(STATS_FIELDS, sender_deltas)
+                if delta
+            },
+        )
+
+
+def apply_type_changes_to_stats(changes):
+    # `changes` are (sender_id, old_type, new_type) of messages whose type
+    # changed, applied as increments like add_text_messages_to_stats.
+    deltas = defaultdict(lambda: [0, 0])
+    for sender_id, old_type, new_type in changes:
+        if sender_id is None:
+            continue
+        sender_deltas = deltas[sender_id]
+        sender_deltas[0] += int(new_type in QUESTION_TYPES) - int(
+            old_type in QUESTION_TYPES
+        )
+        sender_deltas[1] += int(new_type in ANSWER_AND_SUGGESTION_TYPES) - int(
+            old_type in ANSWER_AND_SUGGESTION_TYPES
+        )
+    senders_by_deltas = defaultdict(list)
+    for user_id, sender_deltas in deltas.items():
+        if any(sender_deltas):
+            senders_by_deltas[tuple(sender_deltas)].append(user_id)
+    for sender_deltas, user_ids in senders_by_deltas.items():
+        UserMessageStats.objects.filter(user_id__in=user_ids).update(
+            updated_at=timezone.now(),
+            **{
+                field: F(field) + delta
+                for field, delta in zip(
+                    ("questions_count", "answers_and_suggestions_count"),
+                    sender_deltas,
+                )
+                if delta
+            },
+        )
+
+
+def refresh_user_message_stats(user_ids):
+    # Recounts the messages of the given users, used after message types
+    # changed since a type change can not be applied as a simple increment.
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return
+    counts = {
+        row["sender"]: row
+        for row in TextMessage.objects.filter(sender__in=user_ids)
+        .order_by()
+        .values("sender")
+        .annotate(
+            messages_count=Count("id"),
+            reply_messages_count=Count("reply"),
+            questions_count=Count("id", filter=Q(type__in=QUESTION_TYPES)),
+            answers_and_suggestions_count=Count(
+                "id", filter=Q(type__in=ANSWER_AND_SUGGESTION_TYPES)
+            ),
+        )
+    }
+    UserMessageStats.objects.bulk_create(
+        [
+            UserMessageStats(
+                user_id=user_id,
+                **{
+                    field: counts.get(user_id, {}).get(field, 0)
+                    for field in STATS_FIELDS
+                },
+            )
+            for user_id in user_ids
+        ],
+        update_conflicts=True,
+        unique_fields=["user_id"],
+        update_fields=[*STATS_FIELDS, "updated_at"],
+    )
+
+
+def rebuild_user_message_stats(user_queryset, batch_size=1000):
+    rebuilt = 0
+    user_ids = []
+    for user_id in (
+        user_queryset.order_by("uid")
+        .values_list("uid", flat=True)
+        .iterator(chunk_size=batch_size)
+    ):
+        user_ids.append(user_id)
+        if len(user_ids) == batch_size:
+            refresh_user_message_stats(user_ids)
+            rebuilt += len(user_ids)
+            user_ids = []
+    refresh_user_message_stats(user_ids)
+    rebuilt += len(user_ids)
+    logger.info("Message stats of {count} users rebuilt".format(count=rebuilt))
+    return rebuilt
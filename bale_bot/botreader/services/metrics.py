@@ -0,0 +1,418 @@
+import atexit
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SAMPLE_SUFFIXES = ("_bucket", "_sum", "_count")
+
+# snapshots of exited processes are summed up in ARCHIVE_NAME
+ARCHIVE_NAME = "archive.json"
+ARCHIVE_LOCK_NAME = "archive.lock"
+
+# name -> (type, help) of every exported metric
+METRICS = {
+    "botreader_updates_total": ("counter", "Updates received, by update type."),
+    "botreader_handler_seconds": ("histogram", "Wall time of update handlers."),
+    "botreader_handler_errors_total": ("counter", "Update handler calls that raised."),
+    "botreader_handler_db_queries_total": (
+        "counter",
+        "Database queries run by update handlers.",
+    ),
+    "botreader_handler_db_seconds_total": (
+        "counter",
+        "Time update handlers spent in database queries.",
+    ),
+    "botreader_handler_http_requests_total": (
+        "counter",
+        "Bale API requests sent by update handlers.",
+    ),
+    "botreader_handler_http_seconds_total": (
+        "counter",
+        "Time update handlers spent waiting on the Bale API.",
+    ),
+    "bale_api_requests_total": ("counter", "Bale API requests, by method and status."),
+    "bale_api_request_seconds": ("histogram", "Duration of Bale API requests."),
+    "botreader_chat_activity_refresh_errors_total": (
+        "counter",
+        "Chat activity refreshes that failed on ingest.",
+    ),
+}
+
+
+class MetricsRegistry:
+    # Every metric is kept as plain counters, histograms as their _bucket,
+    # _sum and _count series, so snapshots of several processes are merged
+    # by adding them up.
+
+    def __init__(self):
+        self.values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self.values[(name, labels)] += value
+
+    def observe(self, name, labels, value, buckets=SECONDS_BUCKETS):
+        # every bucket of the label set is created, also the ones the value
+        # is above, so a histogram always lists all of its buckets
+        with self._lock:
+            for bucket in buckets:
+                self.values[(name + "_bucket", labels + (("le", str(bucket)),))] += (
+                    1 if value <= bucket else 0
+                )
+            self.values[(name + "_bucket", labels + (("le", "+Inf"),))] += 1
+            self.values[(name + "_sum", labels)] += value
+            self.values[(name + "_count", labels)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                [name, list(labels), value]
+                for (name, labels), value in self.values.items()
+            ]
+
+
+registry = MetricsRegistry()
+_local = threading.local()
+_observers = []
+_flushed_at = 0
+_flush_lock = threading.Lock()
+
+
+class Measurement:
+    __slots__ = (
+        "handler",
+        "update_type",
+        "seconds",
+        "db_queries",
+        "db_seconds",
+        "http_requests",
+        "http_seconds",
+        "error",
+    )
+
+    def __init__(self, handler, update_type):
+        self.handler = handler
+        self.update_type = update_type
+        self.seconds = 0
+        self.db_queries = 0
+        self.db_seconds = 0
+        self.http_requests = 0
+        self.http_seconds = 0
+        self.error = False
+
+
+def register_observer(observer):
+    # `observer` is called with every finished Measurement, on the thread
+    # that ran the handler.
+    _observers.append(observer)
+    return observer
+
+
+def _get_measurements():
+    if not hasattr(_local, "measurements"):
+        _local.measurements = []
+    return _local.measurements
+
+
+@contextmanager
+def measure(handler, update_type=""):
+    # Times the block and counts the queries and Bale API calls it made. A
+    # nested measurement is included in the one around it.
+    if not settings.BOTREADER_METRICS_ENABLED:
+        yield None
+        return
+    measurements = _get_measurements()
+    measurement = Measurement(handler, update_type)
+    with ExitStack() as stack:
+        if not measurements:
+            stack.enter_context(connection.execute_wrapper(_measure_query))
+        measurements.append(measurement)
+        started_at = time.perf_counter()
+        try:
+            yield measurement
+        except Exception:
+            measurement.error = True
+            raise
+        finally:
+            measurement.seconds = time.perf_counter() - started_at
+            measurements.pop()
+            for observer in _observers:
+                observer(measurement)
+
+
+def instrumented(handler, update_type=""):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(handler, update_type):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _measure_query(execute, sql, params, many, context):
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started_at
+        for measurement in _get_measurements():
+            measurement.db_queries += 1
+            measurement.db_seconds += elapsed
+
+
+def record_http_request(method, status, seconds):
+    if not settings.BOTREADER_METRICS_ENABLED:
+        return
+    registry.inc("bale_api_requests_total", (("method", method), ("status", status)))
+    registry.observe("bale_api_request_seconds", (("method", method),), seconds)
+    for measurement in _get_measurements():
+        measurement.http_requests += 1
+        measurement.http_seconds += seconds
+    flush_if_due()
+
+
+def record_updates(update_type, count):
+    if settings.BOTREADER_METRICS_ENABLED and count:
+        registry.inc("botreader_updates_total", (("update_type", update_type),), count)
+
+
+def record_chat_activity_refresh_error():
+    if settings.BOTREADER_METRICS_ENABLED:
+        registry.inc("botreader_chat_activity_refresh_errors_total", ())
+        flush_if_due()
+
+
+@register_observer
+def record_measurement(measurement):
+    labels = (
+        ("handler", measurement.handler),
+        ("update_type", measurement.update_type),
+    )
+    registry.observe("botreader_handler_seconds", labels, measurement.seconds)
+    if measurement.error:
+        registry.inc("botreader_handler_errors_total", labels)
+    registry.inc("botreader_handler_db_queries_total", labels, measurement.db_queries)
+    registry.inc("botreader_handler_db_seconds_total", labels, measurement.db_seconds)
+    registry.inc(
+        "botreader_handler_http_requests_total", labels, measurement.http_requests
+    )
+    registry.inc(
+        "botreader_handler_http_seconds_total", labels, measurement.http_seconds
+    )
+    flush_if_due()
+
+
+@register_observer
+def log_measurement(measurement):
+    if not settings.BOTREADER_METRICS_LOG:
+        return
+    logger.info(
+        "handler={handler} update_type={update_type} seconds={seconds:.4f} "
+        "db_queries={db_queries} db_seconds={db_seconds:.4f} "
+        "http_requests={http_requests} http_seconds={http_seconds:.4f} "
+        "error={error}".format(
+            **{field: getattr(measurement, field) for field in Measurement.__slots__}
+        )
+    )
+
+
+def get_snapshot_path():
+    return os.path.join(
+        settings.BOTREADER_METRICS_DIR, "{pid}.json".format(pid=os.getpid())
+    )
+
+
+def flush_if_due():
+    if (
+        settings.BOTREADER_METRICS_DIR
+        and time.monotonic() - _flushed_at >= settings.BOTREADER_METRICS_FLUSH_INTERVAL
+    ):
+        flush()
+
+
+def flush():
+    # Writes the metrics of this process where the metrics endpoint, which
+    # runs in another process, reads them.
+    global _flushed_at
+    if not settings.BOTREADER_METRICS_DIR:
+        return
+    # another thread is already writing the same snapshot
+    if not _flush_lock.acquire(blocking=False):
+        return
+    _flushed_at = time.monotonic()
+    path = get_snapshot_path()
+    try:
+        os.makedirs(settings.BOTREADER_METRICS_DIR, exist_ok=True)
+        with open(path + ".tmp", "w") as file:
+            json.dump(registry.snapshot(), file)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.error(
+            "Writing metrics to {path} failed: {error}".format(path=path, error=e)
+        )
+    finally:
+        _flush_lock.release()
+
+
+atexit.register(flush)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running as another user
+        return True
+    return True
+
+
+def merge_snapshots(snapshots):
+    values = defaultdict(float)
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            values[(name, tuple(tuple(label) for label in labels))] += value
+    return values
+
+
+def archive_dead_snapshots():
+    # The snapshots of processes that exited are added to one archive
+    # snapshot and removed, so the directory does not grow with every
+    # restart and the counters of the dead processes never go down. Process
+    # ids are checked on this host, the bot processes have to share it with
+    # the metrics endpoint.
+    directory = settings.BOTREADER_METRICS_DIR
+    with open(os.path.join(directory, ARCHIVE_LOCK_NAME), "a") as lock_file:
+        # the other processes serving the endpoint wait, a snapshot is
+        # archived only once
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        dead_paths = []
+        for entry in os.scandir(directory):
+            pid, _, extension = entry.name.partition(".")
+            if (
+                extension == "json"
+                and pid.isdigit()
+                and int(pid) != os.getpid()
+                and not is_running(int(pid))
+            ):
+                dead_paths.append(entry.path)
+        if not dead_paths:
+            return
+
+        archive_path = os.path.join(directory, ARCHIVE_NAME)
+        snapshots = []
+        for path in [archive_path] + dead_paths:
+            try:
+                with open(path) as file:
+                    snapshots.append(json.load(file))
+            except FileNotFoundError:
+                continue
+        with open(archive_path + ".tmp", "w") as file:
+            json.dump(
+                [
+                    [name, list(labels), value]
+                    for (name, labels), value in merge_snapshots(snapshots).items()
+                ],
+                file,
+            )
+        os.replace(archive_path + ".tmp", archive_path)
+        for path in dead_paths:
+            os.remove(path)
+
+
+def collect():
+    # Sums the metrics of this process and the snapshots of the others.
+    snapshots = [registry.snapshot()]
+    if settings.BOTREADER_METRICS_DIR and os.path.isdir(settings.BOTREADER_METRICS_DIR):
+        try:
+            archive_dead_snapshots()
+        except (OSError, ValueError) as e:
+            logger.warning(
+                "Archiving metrics snapshots of exited processes failed: "
+                "{error}".format(error=e)
+            )
+        own_path = get_snapshot_path()
+        for entry in os.scandir(settings.BOTREADER_METRICS_DIR):
+            if not entry.name.endswith(".json") or entry.path == own_path:
+                continue
+            try:
+                with open(entry.path) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError) as e:
+                logger.warning(
+                    "Skipping metrics snapshot {path}: {error}".format(
+                        path=entry.path, error=e
+                    )
+                )
+    return merge_snapshots(snapshots)
+
+
+def get_sample_order(sample):
+    # the samples of each label set together, buckets by increasing le and
+    # then _sum and _count
+    name, labels, _ = sample
+    suffix = next((suffix for suffix in SAMPLE_SUFFIXES if name.endswith(suffix)), "")
+    return (
+        tuple(label for label in labels if label[0] != "le"),
+        SAMPLE_SUFFIXES.index(suffix) if suffix else 0,
+        float(dict(labels).get("le", 0)),
+    )
+
+
+def render():
+    # Prometheus text exposition format
+    series = defaultdict(list)
+    for (name, labels), value in collect().items():
+        metric = name
+        for suffix in SAMPLE_SUFFIXES:
+            if name.endswith(suffix) and name[: -len(suffix)] in METRICS:
+                metric = name[: -len(suffix)]
+        series[metric].append((name, labels, value))
+    lines = []
+    for metric, samples in series.items():
+        samples.sort(key=get_sample_order)
+        metric_type, metric_help = METRICS.get(metric, ("untyped", ""))
+        lines.append("# HELP {metric} {help}".format(metric=metric, help=metric_help))
+        lines.append("# TYPE {metric} {type}".format(metric=metric, type=metric_type))
+        for name, labels, value in samples:
+            lines.append(
+                "{name}{labels} {value}".format(
+                    name=name, labels=format_labels(labels), value=repr(float(value))
+                )
+            )
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{key}="{value}"'.format(
+                key=key,
+                value=str(value)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for key, value in labels
+        )
+        + "}"
+    )
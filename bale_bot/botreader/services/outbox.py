@@ -0,0 +1,267 @@
+import logging
+import random
+import time
+from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from bale_bot.settings import (
+    BOTREADER_OUTBOX_BACKOFF_BASE,
+    BOTREADER_OUTBOX_BACKOFF_MAX,
+    BOTREADER_OUTBOX_CHAT_BURST,
+    BOTREADER_OUTBOX_CHAT_RATE,
+    BOTREADER_OUTBOX_GLOBAL_BURST,
+    BOTREADER_OUTBOX_GLOBAL_RATE,
+    BOTREADER_OUTBOX_LEASE_SECONDS,
+    BOTREADER_OUTBOX_MAX_ATTEMPTS,
+)
+from ..models import GeneratedAnswer, OutboundMessage, RateLimitBucket
+from . import bale_api
+from .bale_api import BaleApiError, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# outbound messages reuse the GeneratedAnswer states, a message that could
+# not be sent goes back to draft until it is queued again
+DRAFT_STATE = "DRAFT"
+SENDING_STATE = "SENDING"
+SENT_STATE = "SENT"
+
+GLOBAL_BUCKET = "global"
+# key of the advisory lock the senders take turns on to claim messages
+CLAIM_LOCK_ID = 7_301_001
+
+
+def get_chat_bucket(chat_id):
+    return "chat:{chat_id}".format(chat_id=chat_id)
+
+
+def get_next_attempt_at(attempts):
+    # exponential backoff with jitter, so a failing chat is not hammered
+    delay = min(
+        BOTREADER_OUTBOX_BACKOFF_MAX,
+        BOTREADER_OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1),
+    )
+    return timezone.now() + timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+@transaction.atomic
+def try_take_token(name, rate, burst):
+    # Takes a token from the bucket `name` shared by every sender when one
+    # is available, otherwise returns the seconds until the next one is.
+    buckets = RateLimitBucket.objects.select_for_update().filter(name=name)
+    bucket = buckets.first()
+    if bucket is None:
+        RateLimitBucket.objects.bulk_create(
+            [RateLimitBucket(name=name, tokens=burst, updated_at=timezone.now())],
+            ignore_conflicts=True,
+        )
+        bucket = buckets.get()
+    now = timezone.now()
+    elapsed = max(0, (now - bucket.updated_at).total_seconds())
+    bucket.tokens = min(burst, bucket.tokens + elapsed * rate)
+    bucket.updated_at = now
+    if bucket.tokens >= 1:
+        bucket.tokens -= 1
+        wait = 0
+    else:
+        wait = (1 - bucket.tokens) / rate
+    bucket.save(update_fields=["tokens", "updated_at"])
+    return wait
+
+
+def enqueue_message(chat_id, text, reply_to_message_id=None):
+    return OutboundMessage.objects.create(
+        chat_id=chat_id, text=text, reply_to_message_id=reply_to_message_id
+    )
+
+
+def enqueue_generated_answer(generated_answer):
+    # An answer has at most one outbound message, queuing it again re-sends
+    # the current text instead of adding a second message.
+    outbound_message, created = OutboundMessage.objects.get_or_create(
+        generated_answer=generated_answer,
+        defaults={
+            "chat_id": generated_answer.textmessage.chat_id,
+            "text": generated_answer.human_answer,
+            "reply_to_message_id": generated_answer.textmessage.message_id,
+        },
+    )
+    if not created and outbound_message.status != SENDING_STATE:
+        outbound_message.text = generated_answer.human_answer
+        outbound_message.status = SENDING_STATE
+        outbound_message.attempts = 0
+        outbound_message.locked_at = None
+        outbound_message.next_attempt_at = None
+        outbound_message.save(
+            update_fields=["text", "status", "attempts", "locked_at", "next_attempt_at"]
+        )
+    return outbound_message
+
+
+@transaction.atomic
+def dispatch_generated_answers(batch_size):
+    # Answers an admin set to SENDING are claimed with SKIP LOCKED and handed
+    # to the outbox, so dispatchers running side by side never queue the same
+    # answer twice and the admin save does not wait for Bale.
+    generated_answers = list(
+        GeneratedAnswer.objects.select_for_update(skip_locked=True, of=("self",))
+        .select_related("textmessage")
+        .filter(status=SENDING_STATE)
+        .exclude(outbound_message__status=SENDING_STATE)
+        .order_by("created_at")[:batch_size]
+    )
+    for generated_answer in generated_answers:
+        enqueue_generated_answer(generated_answer)
+    return len(generated_answers)
+
+
+@transaction.atomic
+def claim_outbound_messages(batch_size):
+    # Queued messages, and messages whose sender did not finish them within
+    # the lease, are leased in a short transaction. Rows locked by another
+    # sender are skipped, so senders never claim the same message.
+    # Chats with messages leased by another sender are skipped too, so the
+    # messages of a chat go through one sender at a time and keep their
+    # order. Claims take turns on an advisory lock to see each other's leases.
+    # A chat whose message failed waits for its backoff for the same reason.
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s)", [CLAIM_LOCK_ID])
+    now = timezone.now()
+    lease_start = now - timedelta(seconds=BOTREADER_OUTBOX_LEASE_SECONDS)
+    busy_chat_ids = OutboundMessage.objects.filter(
+        Q(locked_at__gte=lease_start) | Q(next_attempt_at__gt=now),
+        status=SENDING_STATE,
+    ).values("chat_id")
+    outbound_messages = list(
+        OutboundMessage.objects.select_for_update(skip_locked=True)
+        .filter(
+            Q(locked_at__isnull=True) | Q(locked_at__lt=lease_start),
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+            status=SENDING_STATE,
+        )
+        .exclude(chat_id__in=busy_chat_ids)
+        .order_by("created_at")[:batch_size]
+    )
+    OutboundMessage.objects.filter(
+        id__in=[outbound_message.id for outbound_message in outbound_messages]
+    ).update(locked_at=now)
+    return outbound_messages
+
+
+def release_outbound_messages(outbound_messages):
+    # the next batch claims them again
+    OutboundMessage.objects.filter(
+        id__in=[outbound_message.id for outbound_message in outbound_messages],
+        status=SENDING_STATE,
+    ).update(locked_at=None)
+
+
+def send_outbox_batch(batch_size):
+    # Messages are sent and marked one by one without holding a transaction
+    # open during the HTTP calls, so a message is saved as SENT as soon as
+    # Bale accepted it.
+    outbound_messages = claim_outbound_messages(batch_size)
+    released_messages = []
+    throttled_chats = set()
+    sent = 0
+    try:
+        for index, outbound_message in enumerate(outbound_messages):
+            # later messages of a throttled chat wait too, to keep their order
+            if outbound_message.chat_id in throttled_chats or try_take_token(
+                get_chat_bucket(outbound_message.chat_id),
+                BOTREADER_OUTBOX_CHAT_RATE,
+                BOTREADER_OUTBOX_CHAT_BURST,
+            ):
+                throttled_chats.add(outbound_message.chat_id)
+                released_messages.append(outbound_message)
+                continue
+            wait_for_global_token()
+
+            try:
+                send_outbound_message(outbound_message)
+            except CircuitOpenError as e:
+                logger.warning(e)
+                released_messages.extend(outbound_messages[index:])
+                break
+            except Exception:
+                # the message may have been sent, it keeps its lease so it is
+                # not sent again right away
+                released_messages.extend(outbound_messages[index + 1 :])
+                raise
+            sent += 1
+    finally:
+        release_outbound_messages(released_messages)
+    return sent
+
+
+def wait_for_global_token():
+    wait = try_take_token(
+        GLOBAL_BUCKET, BOTREADER_OUTBOX_GLOBAL_RATE, BOTREADER_OUTBOX_GLOBAL_BURST
+    )
+    while wait:
+        time.sleep(wait)
+        wait = try_take_token(
+            GLOBAL_BUCKET, BOTREADER_OUTBOX_GLOBAL_RATE, BOTREADER_OUTBOX_GLOBAL_BURST
+        )
+
+
+def send_outbound_message(outbound_message):
+    request_data = [
+        ("chat_id", outbound_message.chat_id),
+        ("text", outbound_message.text),
+    ]
+    if outbound_message.reply_to_message_id is not None:
+        request_data.append(
+            ("reply_to_message_id", outbound_message.reply_to_message_id)
+        )
+
+    outbound_message.attempts += 1
+    try:
+        call_result = bale_api.call_with_retry("sendMessage", data=request_data)
+    except CircuitOpenError:
+        raise
+    except BaleApiError as e:
+        call_result = {"description": str(e)}
+
+    # the outcome is saved in its own short transaction right after the call
+    with transaction.atomic():
+        outbound_message.locked_at = None
+        if call_result.get("ok"):
+            outbound_message.status = SENT_STATE
+            outbound_message.sent_at = timezone.now()
+            if outbound_message.generated_answer_id is not None:
+                GeneratedAnswer.objects.filter(
+                    id=outbound_message.generated_answer_id
+                ).update(status=SENT_STATE)
+            logger.info(
+                "message sent successfully for this chat_id : "
+                + str(outbound_message.chat_id)
+            )
+        else:
+            outbound_message.last_error = str(call_result)
+            if outbound_message.attempts >= BOTREADER_OUTBOX_MAX_ATTEMPTS:
+                outbound_message.status = DRAFT_STATE
+                if outbound_message.generated_answer_id is not None:
+                    # back to draft, so it is not dispatched again on its own
+                    GeneratedAnswer.objects.filter(
+                        id=outbound_message.generated_answer_id
+                    ).update(status=DRAFT_STATE)
+            else:
+                outbound_message.next_attempt_at = get_next_attempt_at(
+                    outbound_message.attempts
+                )
+            logger.error(
+                "message can not send successfully with this error: " + str(call_result)
+            )
+        outbound_message.save(
+            update_fields=[
+                "attempts",
+                "last_error",
+                "status",
+                "sent_at",
+                "locked_at",
+                "next_attempt_at",
+            ]
+        )
@@ -1,15 +1,35 @@
-import json
-import requests
 import datetime
 import logging
-from bale_bot.settings import BALE_BOT_BASE_URL, LEGAL_HOURS_FOR_MESSAGE_FORWARDING
+import threading
+from datetime import timedelta
+from django.db import connection, transaction
+from django.utils import timezone
+from bale_bot.settings import (
+    BALE_API_INLINE_READ_TIMEOUT,
+    BOTREADER_ADMIN_CACHE_TTL,
+    BOTREADER_CACHE_SIZE,
+    LEGAL_HOURS_FOR_MESSAGE_FORWARDING,
+)
 
 from ..models import Chat
-from .helpers import get_or_create_user
+from . import bale_api
+from .bale_api import BaleApiError
+from .cache import LRUCache
+from .helpers import claim_side_effect, get_or_create_users
+from .metrics import instrumented
+from .retry_queue import enqueue, retry_handler
 
 logger = logging.getLogger(__name__)
 
+MODERATE_FORWARDED_MESSAGE_OPERATION = "moderate_forwarded_message"
 
+# uids of each chat's admins, a wave of forwards costs one lookup per chat
+admin_cache = LRUCache(BOTREADER_CACHE_SIZE, BOTREADER_ADMIN_CACHE_TTL)
+_refreshing_chats = set()
+_refreshing_chats_lock = threading.Lock()
+
+
+@instrumented("remove_forwarded_messages_in_illegal_hours", "forward")
 def remove_forwarded_messages_in_illegal_hours(message):
     if not "forward_from_message_id" in message and not "forward_from" in message and not "forward_from_chat" in message:
         raise ValueError("forward_from_message_id object is required")
@@ -25,57 +45,122 @@ def remove_forwarded_messages_in_illegal_hours(message):
     if message_hour >= start_legal_hour and message_hour < end_legal_hour:
         return
 
+    # a redelivered update must not moderate the message twice
+    if not claim_side_effect(
+        "deletemessage:{chat_id}:{message_id}".format(
+            chat_id=chat_id, message_id=message["message_id"]
+        )
+    ):
+        return
+
+    try:
+        moderate_forwarded_message(message)
+    except BaleApiError as e:
+        logger.error(
+            "Moderating forwarded message with id:[{message_id}] in chat with id:[{chat_id}] is queued for retry: {error}".format(
+                message_id=message["message_id"], chat_id=chat_id, error=e
+            )
+        )
+        enqueue(MODERATE_FORWARDED_MESSAGE_OPERATION, message, e)
+
+
+@retry_handler(MODERATE_FORWARDED_MESSAGE_OPERATION)
+def moderate_forwarded_message(message):
+    chat_id = message["chat"]["id"]
+
     # check sender user is not admin
     try:
-        admin_users = __get_and_update_admin_users(chat_id)
+        admin_ids = get_chat_admin_ids(chat_id)
     except PermissionError as e:
         logger.error(
             "Remove forwarded message service canceled Due to lack of admin permission to the bot"
         )
         return
     sender_user_id = message["from"]["id"]
-    for admin in admin_users:
-        if sender_user_id == admin["user"]["id"]:
-            return
+    if sender_user_id in admin_ids:
+        return
 
     # delete forwarded message
     __delete_message(chat_id, message["message_id"])
 
 
 def __delete_message(chat_id, message_id):
-    delete_message_url = BALE_BOT_BASE_URL + "deletemessage"
-    try:
-        for i in range(0, 3):
-            request = requests.post(
-                url=delete_message_url,
-                data=[("chat_id", chat_id), ("message_id", message_id)],
-            )
-            if request.status_code == 200:
-                break
-        if request.status_code == 200:
-            logger.info(
-                "message with id:[{message_id}] in chat with id:[{chat_id}] deleted successfully".format(
-                    message_id=message_id, chat_id=chat_id
-                )
+    # a single short attempt, the update's transaction must not wait on
+    # backoff and a failure is retried later by the retry queue
+    call_result = bale_api.call_with_retry(
+        "deletemessage",
+        data=[("chat_id", chat_id), ("message_id", message_id)],
+        read_timeout=BALE_API_INLINE_READ_TIMEOUT,
+        attempts=1,
+    )
+    if call_result.get("ok"):
+        logger.info(
+            "message with id:[{message_id}] in chat with id:[{chat_id}] deleted successfully".format(
+                message_id=message_id, chat_id=chat_id
             )
-        else:
-            logger.error(
-                "Did not delete message with id:[{message_id}] in chat with id:[{chat_id}] with 3 times trying".format(
-                    message_id=message_id, chat_id=chat_id
-                )
+        )
+    else:
+        logger.error(
+            "Did not delete message with id:[{message_id}] in chat with id:[{chat_id}]: {description}".format(
+                message_id=message_id,
+                chat_id=chat_id,
+                description=call_result.get("description"),
             )
+        )
+
+
+def get_chat_admin_ids(chat_id):
+    # Admins are answered from memory, then from the stored Chat.admins. Only
+    # a chat whose admins were never fetched waits for getChatAdministrators,
+    # a stale stored list is used as is and refreshed in the background.
+    admin_ids = admin_cache.get(chat_id)
+    if admin_ids is not None:
+        return admin_ids
+
+    chat = Chat.objects.only("id", "admins_updated_at").filter(id=chat_id).first()
+    if chat is None or chat.admins_updated_at is None:
+        return __get_and_update_admin_users(chat_id)
+
+    admin_ids = frozenset(chat.admins.values_list("uid", flat=True))
+    admin_cache.set(chat_id, admin_ids)
+    if timezone.now() - chat.admins_updated_at > timedelta(seconds=BOTREADER_ADMIN_CACHE_TTL):
+        refresh_admin_users_in_background(chat_id)
+    return admin_ids
+
+
+def refresh_admin_users_in_background(chat_id):
+    with _refreshing_chats_lock:
+        if chat_id in _refreshing_chats:
+            return
+        _refreshing_chats.add(chat_id)
+    threading.Thread(
+        target=__refresh_admin_users, args=(chat_id,), daemon=True
+    ).start()
+
+
+def __refresh_admin_users(chat_id):
+    try:
+        __get_and_update_admin_users(chat_id)
+    except PermissionError as e:
+        logger.error("Refreshing admins of chat [{chat_id}] failed".format(chat_id=chat_id))
     except Exception as e:
-        print("%s" % type(e))
+        logger.exception(e)
+    finally:
+        with _refreshing_chats_lock:
+            _refreshing_chats.discard(chat_id)
+        connection.close()
 
 
 def __get_and_update_admin_users(chat_id):
     # get chat admins
-    get_admin_url = (
-        BALE_BOT_BASE_URL + "getChatAdministrators" + "?chat_id=" + str(chat_id)
+    call_result = bale_api.call_with_retry(
+        "getChatAdministrators",
+        params={"chat_id": chat_id},
+        read_timeout=BALE_API_INLINE_READ_TIMEOUT,
+        attempts=1,
     )
-    call_result = None
-    while call_result is None or "ok" not in call_result:
-        call_result = call_service(get_admin_url)
+    if "ok" not in call_result:
+        raise BaleApiError("Bad getChatAdministrators result received")
     if (
         "description" in call_result
         and call_result["description"] == "permission_denied"
@@ -86,23 +171,11 @@ def __get_and_update_admin_users(chat_id):
 
     # update chat admins
     chat = Chat.objects.get(id=chat_id)
-    admins = []
-    for admin in admin_users:
-        user = get_or_create_user(
-            uid=admin["user"]["id"],
-            name=admin["user"]["first_name"],
-            username=admin["user"]["username"],
-        )
-        admins.append(user)
-    chat.admins.set(admins)
-
-    return admin_users
-
-
-def call_service(url):
-    try:
-        content = requests.post(url).text
-        parsed_data = json.loads(content)
-        return parsed_data
-    except Exception as e:
-        print("%s" % type(e))
+    admins = get_or_create_users([admin["user"] for admin in admin_users])
+    chat.admins.set(admins.values())
+    chat.admins_updated_at = timezone.now()
+    chat.save(update_fields=["admins_updated_at"])
+
+    admin_ids = frozenset(admins)
+    transaction.on_commit(lambda: admin_cache.set(chat_id, admin_ids))
+    return admin_ids
@@ -0,0 +1,95 @@
+import logging
+import random
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+
+from bale_bot.settings import (
+    BOTREADER_RETRY_QUEUE_BACKOFF_BASE,
+    BOTREADER_RETRY_QUEUE_BACKOFF_MAX,
+    BOTREADER_RETRY_QUEUE_LEASE_SECONDS,
+    BOTREADER_RETRY_QUEUE_MAX_ATTEMPTS,
+)
+from ..models import RetryOperation
+
+logger = logging.getLogger(__name__)
+
+PENDING_STATE = "PENDING"
+FAILED_STATE = "FAILED"
+
+# operation name -> function taking the stored payload, registered by the
+# services whose calls may be retried later
+_handlers = {}
+
+
+def retry_handler(operation):
+    def register(handler):
+        _handlers[operation] = handler
+        return handler
+
+    return register
+
+
+def get_next_attempt_at(attempts):
+    # exponential backoff with jitter, from seconds up to an hour apart
+    delay = min(
+        BOTREADER_RETRY_QUEUE_BACKOFF_MAX,
+        BOTREADER_RETRY_QUEUE_LEASE_SECONDS,
+        BOTREADER_RETRY_QUEUE_BACKOFF_BASE * 2**attempts,
+    )
+    return timezone.now() + timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def enqueue(operation, payload, error=""):
+    # Failed operations are stored and retried later so ingestion never
+    # waits on an API outage.
+    RetryOperation.objects.create(
+        operation=operation,
+        payload=payload,
+        last_error=str(error),
+        next_attempt_at=get_next_attempt_at(0),
+    )
+
+
+@transaction.atomic
+def claim_operations(batch_size):
+    # The due operations are leased by moving their next attempt past the
+    # lease, so the handlers run outside the transaction and a crashed worker
+    # only delays them.
+    now = timezone.now()
+    operations = list(
+        RetryOperation.objects.select_for_update(skip_locked=True)
+        .filter(status=PENDING_STATE, next_attempt_at__lte=now)
+        .order_by("next_attempt_at")[:batch_size]
+    )
+    lease_end = now + timedelta(seconds=BOTREADER_RETRY_QUEUE_LEASE_SECONDS)
+    for operation in operations:
+        operation.attempts += 1
+        operation.next_attempt_at = lease_end
+    RetryOperation.objects.bulk_update(operations, ["attempts", "next_attempt_at"])
+    return operations
+
+
+def process_retry_queue(batch_size):
+    operations = claim_operations(batch_size)
+    for operation in operations:
+        try:
+            _handlers[operation.operation](operation.payload)
+        except Exception as e:
+            operation.last_error = repr(e)
+            if operation.attempts >= BOTREADER_RETRY_QUEUE_MAX_ATTEMPTS:
+                operation.status = FAILED_STATE
+                logger.error(
+                    "Operation [{operation}] with payload {payload} gave up after {attempts} attempts: {error}".format(
+                        operation=operation.operation,
+                        payload=operation.payload,
+                        attempts=operation.attempts,
+                        error=operation.last_error,
+                    )
+                )
+            else:
+                operation.next_attempt_at = get_next_attempt_at(operation.attempts)
+            operation.save(update_fields=["last_error", "status", "next_attempt_at"])
+        else:
+            operation.delete()
+    return len(operations)
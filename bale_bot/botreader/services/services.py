@@ -1,24 +1,23 @@
-import json
-import requests
 import datetime
 import logging
 from django.db import transaction
-from django.db.models.signals import post_save
-from django.dispatch import receiver
 
-from bale_bot.settings import BALE_BOT_BASE_URL, WELCOME_MESSAGE
-from ..models import UpdateId
-from ..models import TextMessage, UpdateId, Chat, GeneratedAnswer
-from .helpers import get_or_create_user, get_or_create_chat, send_message
+from bale_bot.settings import (
+    BALE_API_READ_TIMEOUT,
+    BALE_UPDATES_BATCH_SIZE,
+)
+from ..models import TextMessage, UpdateId, Chat
+from . import bale_api, inbox
+from .helpers import get_or_create_users, get_or_create_chats
+from .message_stats import add_text_messages_to_stats
+from .chat_activity import refresh_chat_activity_on_commit
+from .metrics import instrumented, record_updates
 from .remove_msg_from_chat import remove_forwarded_messages_in_illegal_hours
 from .add_member_in_chat import adding_new_member_in_chat
 from .left_member_from_chat import left_member_from_chat
 
 logger = logging.getLogger(__name__)
 
-SENDING_ANSWER_STATE = "SENDING"
-ANSWER_SENT_STATE = "SENT"
-
 
 def new_messages_getter_scheduler():
     try:
@@ -27,13 +26,17 @@ def new_messages_getter_scheduler():
         logger.error(e)
 
 
-@transaction.atomic
-def get_new_messages_and_save():
+def get_new_messages_and_save(batch_size=None):
+    # Every page of updates is committed together with its offset, so a
+    # failure only rolls back the page in progress and the next run resumes
+    # right after the last committed page.
+    batch_size = batch_size or BALE_UPDATES_BATCH_SIZE
     none_response_counter = 0
     while True:
         update = UpdateId.objects.all().first()
-        url = get_update_message_url(update, BALE_BOT_BASE_URL)
-        response = call_service(url)
+        response = bale_api.call(
+            "getupdates", params=get_update_params(update, limit=batch_size)
+        )
         if response is None:
             logger.warning("None response is received")
             if none_response_counter == 3:
@@ -46,50 +49,88 @@ def get_new_messages_and_save():
         result = response["result"]
         if result is None:
             raise ValueError("Bad result received")
-        if (
-            update is not None
-            and len(result) == 1
-            and result[0]["update_id"] == update.update_id
-        ):
+        if not result:
             break
+        save_updates_page(update, result)
+
+
+def poll_new_messages_and_save(timeout, batch_size=None):
+    # Wait up to `timeout` seconds on the Bale side for new updates, so a
+    # long-running consumer gets them as soon as they arrive.
+    batch_size = batch_size or BALE_UPDATES_BATCH_SIZE
+    update = UpdateId.objects.all().first()
+    response = bale_api.call(
+        "getupdates",
+        params=get_update_params(update, timeout=timeout, limit=batch_size),
+        # the HTTP read timeout has to outlast the long poll
+        read_timeout=timeout + BALE_API_READ_TIMEOUT,
+    )
+    if response is None:
+        raise ValueError("None response is received")
+    result = response.get("result")
+    if result is None:
+        raise ValueError("Bad result received")
+    if result:
+        save_updates_page(update, result)
+    return len(result)
+
+
+def save_updates_page(update, result):
+    # The page is stored in the inbox together with its offset and then
+    # processed from there, so an update interrupted halfway is processed
+    # again instead of being lost with the offset already moved past it.
+    # Leftovers of earlier pages, pending past their backoff or left by a
+    # crashed worker, are claimed first as they have lower update ids.
+    with transaction.atomic():
+        inbox.store_updates(result)
         update_offset(update, result)
-        insert_messages(result)
+    while inbox.process_inbox_batch(len(result)):
+        pass
 
 
-def get_update_message_url(update: UpdateId, url):
-    url += "getupdates"
+def get_update_params(update: UpdateId, timeout=None, limit=None):
+    params = {}
     if update is not None:
-        url += "?offset=" + str(update.update_id)
-    return url
+        # offset is the first update we have not seen yet
+        params["offset"] = update.update_id + 1
+    if timeout:
+        params["timeout"] = timeout
+    if limit:
+        params["limit"] = limit
+    return params
 
 
 def update_offset(update, result):
+    if not result:
+        return
     if update is None:
-        if result:
-            UpdateId.objects.create(update_id=result[-1]["update_id"])
+        UpdateId.objects.create(update_id=result[-1]["update_id"])
     else:
-        if result:
-            update.update_id = result[-1]["update_id"]
+        update.update_id = result[-1]["update_id"]
         update.save()
 
 
 def insert_messages(result):
-    for res in result:
-        if "message" in res:
-            message = res["message"]
-        elif "edited_message" in res:
-            message = res["edited_message"]
-        elif "callback_query" in res:
-            message = res["callback_query"]["message"]
-        else:
-            raise ValueError("There is no readable content in message")
-
+    for update_type in UPDATE_TYPES:
+        record_updates(update_type, sum(update_type in res for res in result))
+    messages = [get_update_message(res) for res in result]
+
+    # one lookup for every message id in the page instead of one per update
+    existing_message_ids = set(
+        TextMessage.objects.filter(
+            message_id__in=[
+                message["message_id"] for message in messages if "message_id" in message
+            ]
+        ).values_list("message_id", flat=True)
+    )
+    new_messages = []
+    handled_messages = []
+    for message in messages:
         if "message_id" in message:
-            exist_message_id = TextMessage.objects.filter(
-                message_id=message["message_id"]
-            ).exists()
+            exist_message_id = message["message_id"] in existing_message_ids
             if not exist_message_id:
-                save_text_message(message)
+                existing_message_ids.add(message["message_id"])
+                new_messages.append(message)
             # if message exist and message_id is not about left or joins break
             if exist_message_id and message["message_id"] != 0:
                 continue
@@ -97,37 +138,88 @@ def insert_messages(result):
             raise ValueError(
                 "The message does not have an ID, nor is it an entry or exit message"
             )
+        handled_messages.append(message)
+
+    save_text_messages(new_messages)
+
+    # Joins, leaves and forwards are handled in the transaction that marks
+    # the update done, so a handler that fails rolls the update back and it
+    # is claimed again instead of being lost.
+    for message in handled_messages:
+        handle_message_events(message)
+
+
+def handle_message_events(message):
+    if "new_chat_members" in message:
+        adding_new_member_in_chat(message)
+    if "left_chat_member" in message:
+        left_member_from_chat(message)
+    if "forward_from_message_id" in message or "forward_from" in message or "forward_from_chat" in message:
+        remove_forwarded_messages_in_illegal_hours(message)
 
-        if "new_chat_members" in message:
-            adding_new_member_in_chat(message)
-        if "left_chat_member" in message:
-            left_member_from_chat(message)
-        if "forward_from_message_id" in message or "forward_from" in message or "forward_from_chat" in message:
-            remove_forwarded_messages_in_illegal_hours(message)
+
+UPDATE_TYPES = ("message", "edited_message", "callback_query")
+
+
+def get_update_message(res):
+    if "message" in res:
+        return res["message"]
+    if "edited_message" in res:
+        return res["edited_message"]
+    if "callback_query" in res:
+        return res["callback_query"]["message"]
+    raise ValueError("There is no readable content in message")
 
 
 def save_text_message(message):
-    text_message = TextMessage()
-    text_message.message_id = message["message_id"]
-    text_message.date = datetime.datetime.fromtimestamp(message["date"])
-    if "text" in message:
-        text = message["text"]
-        text = text.replace(chr(0), "") # remove null character 
-        text_message.text = text
-    if "caption" in message:
-        text_message.text = message["caption"]
-    if "from" in message:
-        text_message.sender = get_or_create_user(
-            uid=message["from"]["id"],
-            username=message["from"]["username"],
-            name=message["from"]["first_name"],
-        )
-    text_message.chat = get_or_create_chat(message["chat"])
-    if "reply_to_message" in message:
-        text_message.reply = TextMessage.objects.filter(
-            message_id=message["reply_to_message"]["message_id"]
-        ).first()
-    text_message.save()
+    save_text_messages([message])
+
+
+@instrumented("save_text_messages", "text")
+def save_text_messages(messages):
+    # Users, chats and reply targets of the whole page are fetched with one
+    # query per table and the messages are written with a single INSERT.
+    if not messages:
+        return
+    users = get_or_create_users(
+        [message["from"] for message in messages if "from" in message]
+    )
+    chats = get_or_create_chats([message["chat"] for message in messages])
+    replies = TextMessage.objects.only("id", "message_id").in_bulk(
+        [
+            message["reply_to_message"]["message_id"]
+            for message in messages
+            if "reply_to_message" in message
+        ],
+        field_name="message_id",
+    )
+
+    text_messages = []
+    for message in messages:
+        text_message = TextMessage()
+        text_message.message_id = message["message_id"]
+        text_message.date = datetime.datetime.fromtimestamp(message["date"])
+        if "text" in message:
+            text = message["text"]
+            text = text.replace(chr(0), "") # remove null character 
+            text_message.text = text
+        if "caption" in message:
+            text_message.text = message["caption"]
+        if "from" in message:
+            text_message.sender = users[message["from"]["id"]]
+        text_message.chat = chats[message["chat"]["id"]]
+        if "reply_to_message" in message:
+            text_message.reply = replies.get(
+                message["reply_to_message"]["message_id"]
+            )
+        # later messages of the same page may reply to this one
+        replies.setdefault(text_message.message_id, text_message)
+        text_messages.append(text_message)
+    TextMessage.objects.bulk_create(text_messages)
+    add_text_messages_to_stats(text_messages)
+    refresh_chat_activity_on_commit(
+        (text_message.chat_id, text_message.date) for text_message in text_messages
+    )
 
 
 def save_chat(send_from):
@@ -142,25 +234,3 @@ def save_chat(send_from):
     chat.save()
     return chat
 
-
-def call_service(url):
-    try:
-        content = requests.post(url).text
-        parsed_data = json.loads(content)
-        return parsed_data
-    except Exception as e:
-        print("%s" % type(e))
-
-
-@receiver(post_save, sender=GeneratedAnswer)
-def answer_generation_handler(sender, instance, **kwargs):
-    generated_answer_status = instance.status
-    if generated_answer_status == SENDING_ANSWER_STATE:
-        chat_id = instance.textmessage.chat.id
-        main_message_id = instance.textmessage.message_id
-        human_answer = instance.human_answer        
-        send_result = send_message(chat_id, human_answer, main_message_id)
-        if send_result:
-            instance.status = ANSWER_SENT_STATE
-            instance.save()
-            logger.info("answer message with id [{answer_id}] sent successfully".format(answer_id = instance.id))
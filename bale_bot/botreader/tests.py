@@ -1,3 +1,659 @@
+import tempfile
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, IntegrityError, connection, transaction
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
 
-# Create your tests here.
+from bale_bot.settings import (
+    BOTREADER_INBOX_LEASE_SECONDS,
+    BOTREADER_INBOX_MAX_ATTEMPTS,
+    BOTREADER_OUTBOX_MAX_ATTEMPTS,
+)
+from .models import (
+    Chat,
+    ChatActivityRollup,
+    ChatEvent,
+    ClassificationJob,
+    ClassificationJobMessage,
+    Membership,
+    OutboundMessage,
+    RateLimitBucket,
+    SideEffect,
+    TextMessage,
+    UpdateInbox,
+    User,
+    UserMessageStats,
+)
+from .services import classification, inbox, outbox
+from .services.chat_activity import (
+    _refresh_chat_activity,
+    get_period_start,
+    refresh_chat_activity,
+)
+from .services.helpers import chat_cache, create_chat_event, user_cache
+from .services.message_stats import refresh_user_message_stats
+from .services.services import insert_messages, save_updates_page
+
+
+def get_update(update_id, date, sender_id=1, chat_id=-100, **message):
+    # an update of a Bale getUpdates page
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(date.timestamp()),
+            "chat": {
+                "id": chat_id,
+                "type": "group",
+                "title": "group",
+                "username": "",
+                "first_name": "",
+                "last_name": "",
+            },
+            "from": {"id": sender_id, "username": "", "first_name": "member"},
+            "text": "text",
+            **message,
+        },
+    }
+
+
+def get_index(model, fields):
+    return next(index for index in model._meta.indexes if index.fields == fields)
+
+
+def get_constraint(model, name):
+    return next(
+        constraint for constraint in model._meta.constraints if constraint.name == name
+    )
+
+
+class HotLookupIndexTests(TestCase):
+    # Every hot lookup is explained with its index or constraint in place,
+    # then with it dropped inside the test transaction.
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(uid=1, name="member")
+        cls.chat = Chat.objects.create(
+            id=-100,
+            type="group",
+            title="group",
+            username="",
+            first_name="",
+            last_name="",
+        )
+        cls.date = timezone.now()
+        TextMessage.objects.create(
+            message_id=1, sender=cls.user, chat=cls.chat, date=cls.date, text="text"
+        )
+        Membership.objects.create(
+            chat=cls.chat, member=cls.user, last_membership_date=cls.date
+        )
+        ChatEvent.objects.create(
+            user=cls.user,
+            chat=cls.chat,
+            date=cls.date,
+            event_type=ChatEvent.EventType.ENTRY,
+        )
+
+    def setUp(self):
+        # the tables of a test hold a few rows, a sequential scan would always
+        # win without this
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, name, drop):
+        self.assertIn(name, queryset.explain())
+        with connection.schema_editor() as schema_editor:
+            drop(schema_editor)
+        self.assertNotIn(name, queryset.explain())
+
+    def test_message_changelist_uses_date_id_index(self):
+        index = get_index(TextMessage, ["-date", "-id"])
+        self.assertUsesIndex(
+            TextMessage.objects.order_by("-date", "-id")[:100],
+            index.name,
+            lambda schema_editor: schema_editor.remove_index(TextMessage, index),
+        )
+
+    def test_sender_type_counts_use_sender_type_index(self):
+        index = get_index(TextMessage, ["sender", "type"])
+        self.assertUsesIndex(
+            TextMessage.objects.filter(sender=self.user, type="").values(
+                "sender", "type"
+            ),
+            index.name,
+            lambda schema_editor: schema_editor.remove_index(TextMessage, index),
+        )
+
+    def test_membership_lookup_uses_unique_constraint(self):
+        constraint = get_constraint(Membership, "unique_membership_chat_member")
+        self.assertUsesIndex(
+            Membership.objects.filter(chat=self.chat, member=self.user).values(
+                "chat", "member"
+            ),
+            constraint.name,
+            lambda schema_editor: schema_editor.remove_constraint(
+                Membership, constraint
+            ),
+        )
+
+    def test_chat_event_lookup_uses_unique_constraint(self):
+        constraint = get_constraint(
+            ChatEvent, "unique_chatevent_user_chat_date_event_type"
+        )
+        self.assertUsesIndex(
+            ChatEvent.objects.filter(
+                user=self.user,
+                chat=self.chat,
+                date=self.date,
+                event_type=ChatEvent.EventType.ENTRY,
+            ),
+            constraint.name,
+            lambda schema_editor: schema_editor.remove_constraint(
+                ChatEvent, constraint
+            ),
+        )
+
+
+class UniquenessTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(uid=1, name="member")
+        cls.chat = Chat.objects.create(
+            id=-100,
+            type="group",
+            title="group",
+            username="",
+            first_name="",
+            last_name="",
+        )
+
+    def test_membership_is_unique_per_chat_and_member(self):
+        Membership.objects.create(chat=self.chat, member=self.user)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Membership.objects.create(chat=self.chat, member=self.user)
+
+    def test_chat_event_is_recorded_once(self):
+        fields = {
+            "user": self.user,
+            "chat": self.chat,
+            "date": timezone.now(),
+            "event_type": ChatEvent.EventType.ENTRY,
+        }
+        self.assertTrue(create_chat_event(**fields))
+        self.assertFalse(create_chat_event(**fields))
+        self.assertEqual(ChatEvent.objects.count(), 1)
+
+
+class ChangelistQueryTests(TestCase):
+    # A changelist page costs the session and user lookups, one keys query
+    # that also selects the capped count and one query for the rows of the
+    # page with their relations.
+    CHANGELIST_QUERIES = 4
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = get_user_model().objects.create_superuser(
+            username="admin", password="admin"
+        )
+        users = User.objects.bulk_create(
+            [User(uid=uid, name=f"user {uid}") for uid in range(1, 102)]
+        )
+        chat = Chat.objects.create(
+            id=-100,
+            type="group",
+            title="group",
+            username="",
+            first_name="",
+            last_name="",
+        )
+        now = timezone.now()
+        TextMessage.objects.bulk_create(
+            [
+                TextMessage(
+                    message_id=message_id,
+                    sender=users[message_id % len(users)],
+                    chat=chat,
+                    date=now - timedelta(minutes=message_id),
+                    text="text " * 100,
+                )
+                for message_id in range(1, 102)
+            ]
+        )
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def assertChangelistQueries(self, url):
+        with self.assertNumQueries(self.CHANGELIST_QUERIES):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["cl"].result_list), 100)
+        self.assertTrue(response.context["cl"].keyset_page.has_next())
+
+    def test_text_message_changelist(self):
+        self.assertChangelistQueries(reverse("admin:botreader_textmessage_changelist"))
+
+    def test_user_changelist(self):
+        self.assertChangelistQueries(reverse("admin:botreader_user_changelist"))
+
+    def test_text_message_changelist_notes_the_default_window(self):
+        url = reverse("admin:botreader_textmessage_changelist")
+        response = self.client.get(url)
+        self.assertEqual(len(response.context["messages"]), 1)
+        response = self.client.get(url, {"period": "all"})
+        self.assertEqual(len(response.context["messages"]), 0)
+
+
+@mock.patch("botreader.services.outbox.bale_api.call_with_retry")
+class OutboxTests(TestCase):
+    def test_leased_message_is_not_sent_twice(self, call_with_retry):
+        call_with_retry.return_value = {"ok": True}
+        outbound_message = outbox.enqueue_message(chat_id=1, text="hello")
+        self.assertEqual(outbox.claim_outbound_messages(10), [outbound_message])
+        # another sender finds nothing to send while the lease holds
+        self.assertEqual(outbox.send_outbox_batch(10), 0)
+        call_with_retry.assert_not_called()
+
+    def test_chat_with_leased_message_is_skipped(self, call_with_retry):
+        first = outbox.enqueue_message(chat_id=1, text="first")
+        outbox.enqueue_message(chat_id=1, text="second")
+        other_chat = outbox.enqueue_message(chat_id=2, text="other")
+        self.assertEqual(outbox.claim_outbound_messages(1), [first])
+        self.assertEqual(outbox.claim_outbound_messages(10), [other_chat])
+
+    def test_failed_message_backs_off_then_goes_to_draft(self, call_with_retry):
+        call_with_retry.return_value = {"ok": False, "description": "error"}
+        outbound_message = outbox.enqueue_message(chat_id=1, text="hello")
+        for attempt in range(1, BOTREADER_OUTBOX_MAX_ATTEMPTS + 1):
+            (claimed,) = outbox.claim_outbound_messages(10)
+            outbox.send_outbound_message(claimed)
+            outbound_message.refresh_from_db()
+            self.assertEqual(outbound_message.attempts, attempt)
+            if attempt < BOTREADER_OUTBOX_MAX_ATTEMPTS:
+                self.assertEqual(outbound_message.status, outbox.SENDING_STATE)
+                self.assertGreater(outbound_message.next_attempt_at, timezone.now())
+                self.assertEqual(outbox.claim_outbound_messages(10), [])
+                # the backoff is over
+                OutboundMessage.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(outbound_message.status, outbox.DRAFT_STATE)
+        self.assertEqual(outbox.claim_outbound_messages(10), [])
+        self.assertEqual(call_with_retry.call_count, BOTREADER_OUTBOX_MAX_ATTEMPTS)
+
+
+class RateLimitBucketTests(TestCase):
+    RATE = 2
+    BURST = 3
+
+    def take_token(self):
+        return outbox.try_take_token("chat:1", self.RATE, self.BURST)
+
+    def test_tokens_are_refused_past_the_burst(self):
+        for _ in range(self.BURST):
+            self.assertEqual(self.take_token(), 0)
+        wait = self.take_token()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1 / self.RATE)
+
+    def test_tokens_refill_as_time_passes(self):
+        now = timezone.now()
+        with mock.patch("botreader.services.outbox.timezone.now") as get_now:
+            get_now.return_value = now
+            for _ in range(self.BURST):
+                self.take_token()
+            self.assertEqual(self.take_token(), 1 / self.RATE)
+            get_now.return_value = now + timedelta(seconds=1)
+            # a second at two tokens per second
+            self.assertEqual(self.take_token(), 0)
+            self.assertEqual(self.take_token(), 0)
+            self.assertGreater(self.take_token(), 0)
+            get_now.return_value = now + timedelta(hours=1)
+            self.take_token()
+        # refilling stops at the burst
+        self.assertEqual(
+            RateLimitBucket.objects.get(name="chat:1").tokens, self.BURST - 1
+        )
+
+
+class MessageStatsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(uid=1, name="member")
+        cls.chat = Chat.objects.create(
+            id=-100,
+            type="group",
+            title="group",
+            username="",
+            first_name="",
+            last_name="",
+        )
+        cls.question = TextMessage.objects.create(
+            message_id=1,
+            sender=cls.user,
+            chat=cls.chat,
+            date=timezone.now(),
+            text="question",
+            type="QUESTION",
+        )
+        TextMessage.objects.create(
+            message_id=2,
+            sender=cls.user,
+            chat=cls.chat,
+            date=timezone.now(),
+            text="answer",
+            type="ANSWER",
+            reply=cls.question,
+        )
+
+    def assertStats(self, **counts):
+        stats = UserMessageStats.objects.get(user=self.user)
+        for field, count in counts.items():
+            self.assertEqual(getattr(stats, field), count, field)
+
+    def test_refresh_upserts_the_counts(self):
+        refresh_user_message_stats([self.user.uid])
+        self.assertStats(
+            messages_count=2,
+            reply_messages_count=1,
+            questions_count=1,
+            answers_and_suggestions_count=1,
+        )
+        TextMessage.objects.filter(id=self.question.id).update(type="ANSWER")
+        # the second refresh updates the existing row
+        refresh_user_message_stats([self.user.uid])
+        self.assertStats(
+            messages_count=2,
+            reply_messages_count=1,
+            questions_count=0,
+            answers_and_suggestions_count=2,
+        )
+        self.assertEqual(UserMessageStats.objects.count(), 1)
+
+
+class ChatActivityTests(TestCase):
+    def setUp(self):
+        # cached users and chats would outlive the rows of the test
+        self.addCleanup(user_cache.clear)
+        self.addCleanup(chat_cache.clear)
+        self.date = timezone.now().replace(minute=10, second=0, microsecond=0)
+        self.date -= timedelta(days=1)
+
+    def get_rollup(self, granularity, date=None):
+        return ChatActivityRollup.objects.get(
+            chat_id=-100,
+            granularity=granularity,
+            period_start=get_period_start(date or self.date, granularity),
+        )
+
+    def ingest(self, updates):
+        with self.captureOnCommitCallbacks(execute=True):
+            insert_messages(updates)
+
+    def test_ingest_refreshes_touched_periods(self):
+        self.ingest(
+            [
+                get_update(1, self.date),
+                get_update(2, self.date + timedelta(minutes=1), sender_id=2),
+            ]
+        )
+        for granularity in ChatActivityRollup.Granularity:
+            rollup = self.get_rollup(granularity)
+            self.assertEqual(rollup.messages_count, 2)
+            self.assertEqual(rollup.unique_senders_count, 2)
+            self.assertEqual(rollup.type_counts, {"": 2})
+        # a later page updates the rollup of the same period
+        self.ingest([get_update(3, self.date + timedelta(minutes=2))])
+        self.assertEqual(
+            self.get_rollup(ChatActivityRollup.Granularity.HOUR).messages_count, 3
+        )
+
+    def test_refresh_recounts_touched_periods(self):
+        self.ingest([get_update(1, self.date), get_update(2, self.date)])
+        TextMessage.objects.filter(message_id=1).update(type="QUESTION")
+        TextMessage.objects.filter(message_id=2).delete()
+        refresh_chat_activity([(-100, self.date)])
+        for granularity in ChatActivityRollup.Granularity:
+            rollup = self.get_rollup(granularity)
+            self.assertEqual(rollup.messages_count, 1)
+            self.assertEqual(rollup.type_counts, {"QUESTION": 1})
+        TextMessage.objects.all().delete()
+        # a period left without messages keeps its row with zero counts
+        refresh_chat_activity([(-100, self.date)])
+        self.assertEqual(
+            self.get_rollup(ChatActivityRollup.Granularity.DAY).messages_count, 0
+        )
+
+    def test_refresh_error_on_ingest_is_counted(self):
+        with mock.patch(
+            "botreader.services.chat_activity.refresh_chat_activity",
+            side_effect=DatabaseError,
+        ), mock.patch(
+            "botreader.services.chat_activity.metrics.record_chat_activity_refresh_error"
+        ) as record_error:
+            _refresh_chat_activity([(-100, self.date)])
+        record_error.assert_called_once_with()
+
+    def test_backfill_rebuilds_rollups(self):
+        with mock.patch("botreader.services.services.refresh_chat_activity_on_commit"):
+            self.ingest(
+                [
+                    get_update(1, self.date),
+                    get_update(2, self.date + timedelta(days=1, minutes=-5)),
+                ]
+            )
+        self.assertFalse(ChatActivityRollup.objects.exists())
+        call_command("backfill_chat_activity", stdout=StringIO())
+        self.assertEqual(
+            self.get_rollup(ChatActivityRollup.Granularity.HOUR).messages_count, 1
+        )
+        self.assertEqual(
+            self.get_rollup(
+                ChatActivityRollup.Granularity.DAY,
+                self.date + timedelta(days=1, minutes=-5),
+            ).messages_count,
+            1,
+        )
+        self.assertEqual(
+            ChatActivityRollup.objects.filter(
+                granularity=ChatActivityRollup.Granularity.HOUR
+            ).count(),
+            2,
+        )
+
+
+class InboxTests(TestCase):
+    def setUp(self):
+        self.addCleanup(user_cache.clear)
+        self.addCleanup(chat_cache.clear)
+        self.date = timezone.now()
+
+    def process(self, batch_size=10):
+        with self.captureOnCommitCallbacks(execute=True):
+            return inbox.process_inbox_batch(batch_size)
+
+    def test_redelivered_update_is_processed_once(self):
+        update = get_update(1, self.date)
+        inbox.store_updates([update])
+        inbox.store_updates([update])
+        self.assertEqual(self.process(), 1)
+        inbox.store_updates([update])
+        self.assertEqual(self.process(), 0)
+        self.assertEqual(TextMessage.objects.count(), 1)
+        self.assertEqual(UpdateInbox.objects.get().status, inbox.DONE_STATE)
+
+    def test_stale_lease_is_taken_over(self):
+        inbox.store_updates([get_update(1, self.date)])
+        self.assertEqual(len(inbox.claim_updates(10)), 1)
+        self.assertEqual(inbox.claim_updates(10), [])
+        UpdateInbox.objects.update(
+            locked_at=timezone.now()
+            - timedelta(seconds=BOTREADER_INBOX_LEASE_SECONDS + 1)
+        )
+        (entry,) = inbox.claim_updates(10)
+        self.assertEqual(entry.attempts, 2)
+
+    @mock.patch(
+        "botreader.services.services.insert_messages", side_effect=ValueError("bad")
+    )
+    def test_failing_update_backs_off_then_is_marked_failed(self, insert_messages):
+        inbox.store_updates([get_update(1, self.date)])
+        for attempt in range(1, BOTREADER_INBOX_MAX_ATTEMPTS + 1):
+            self.assertEqual(self.process(), 1)
+            entry = UpdateInbox.objects.get()
+            self.assertEqual(entry.attempts, attempt)
+            if attempt < BOTREADER_INBOX_MAX_ATTEMPTS:
+                self.assertEqual(entry.status, inbox.PENDING_STATE)
+                self.assertGreater(entry.next_attempt_at, timezone.now())
+                self.assertEqual(self.process(), 0)
+                # the backoff is over
+                UpdateInbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(entry.status, inbox.FAILED_STATE)
+        self.assertIn("bad", entry.last_error)
+        self.assertEqual(self.process(), 0)
+
+    def test_page_drains_leftover_updates(self):
+        inbox.store_updates([get_update(1, self.date)])
+        with self.captureOnCommitCallbacks(execute=True):
+            save_updates_page(None, [get_update(2, self.date)])
+        self.assertEqual(
+            set(UpdateInbox.objects.values_list("status", flat=True)),
+            {inbox.DONE_STATE},
+        )
+        self.assertEqual(TextMessage.objects.count(), 2)
+
+    def test_prune_deletes_processed_updates_and_old_side_effects(self):
+        old = timezone.now() - timedelta(days=30)
+        UpdateInbox.objects.bulk_create(
+            [
+                UpdateInbox(update_id=1, payload={}, status="DONE", processed_at=old),
+                UpdateInbox(
+                    update_id=2, payload={}, status="DONE", processed_at=timezone.now()
+                ),
+                UpdateInbox(update_id=3, payload={}, status="FAILED"),
+            ]
+        )
+        SideEffect.objects.bulk_create(
+            [SideEffect(key="old", created_at=old), SideEffect(key="new")]
+        )
+        call_command("prune_inbox", "--batch-size", "1", stdout=StringIO())
+        self.assertQuerysetEqual(
+            UpdateInbox.objects.order_by("update_id").values_list(
+                "update_id", flat=True
+            ),
+            [2, 3],
+        )
+        self.assertQuerysetEqual(
+            SideEffect.objects.values_list("key", flat=True), ["new"]
+        )
+
+
+class ClassificationJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(uid=1, name="member")
+        cls.chat = Chat.objects.create(
+            id=-100,
+            type="group",
+            title="group",
+            username="",
+            first_name="",
+            last_name="",
+        )
+        now = timezone.now()
+        # created newest first, so (date, id) order differs from insertion
+        cls.messages = [
+            TextMessage.objects.create(
+                message_id=message_id,
+                sender=user,
+                chat=cls.chat,
+                date=now - timedelta(minutes=message_id),
+                text="text",
+            )
+            for message_id in range(1, 6)
+        ]
+
+    def run_chunk(self, job, chunk_size=2):
+        with self.captureOnCommitCallbacks(execute=True):
+            return classification.run_classification_chunk(job.pk, chunk_size)
+
+    def test_ids_job_lists_each_id_once(self):
+        missing_id = uuid.uuid4()
+        message_ids = [self.messages[0].id, self.messages[1].id, missing_id]
+        job = classification.create_classification_job(
+            "QUESTION", message_ids=message_ids + [self.messages[0].id]
+        )
+        self.assertEqual(job.total, 3)
+        self.assertEqual(
+            list(
+                job.job_messages.order_by("position").values_list(
+                    "position", "message_id"
+                )
+            ),
+            list(enumerate(message_ids, start=1)),
+        )
+
+    def test_ids_job_runs_chunk_by_chunk(self):
+        job = classification.create_classification_job(
+            "QUESTION",
+            message_ids=[message.id for message in self.messages[:3]] + [uuid.uuid4()],
+        )
+        classification.claim_classification_job(job_id=job.pk)
+        self.assertTrue(self.run_chunk(job))
+        job.refresh_from_db()
+        self.assertEqual((job.processed, job.updated), (2, 2))
+        self.assertTrue(self.run_chunk(job))
+        self.assertFalse(self.run_chunk(job))
+        job.refresh_from_db()
+        self.assertEqual(job.status, classification.DONE_STATE)
+        self.assertEqual((job.processed, job.updated), (4, 3))
+        self.assertEqual(TextMessage.objects.filter(type="QUESTION").count(), 3)
+        self.assertFalse(ClassificationJobMessage.objects.exists())
+
+    def test_queryset_job_lists_messages_in_date_order(self):
+        job = classification.create_classification_job_for_queryset(
+            "ANSWER", TextMessage.objects.filter(chat=self.chat)
+        )
+        self.assertEqual(job.total, 5)
+        self.assertEqual(
+            list(
+                job.job_messages.order_by("position").values_list(
+                    "message_id", flat=True
+                )
+            ),
+            [message.id for message in reversed(self.messages)],
+        )
+        classification.run_classification_job(
+            classification.claim_classification_job(job_id=job.pk), chunk_size=2
+        )
+        job.refresh_from_db()
+        self.assertEqual(job.status, classification.DONE_STATE)
+        self.assertEqual(job.updated, 5)
+
+    def test_filters_job_walks_matching_messages(self):
+        job = classification.create_classification_job(
+            "SELL", filters={"chat": [self.chat.id]}
+        )
+        claimed = classification.claim_classification_job(job_id=job.pk)
+        self.assertEqual(claimed.total, 5)
+        while self.run_chunk(job):
+            pass
+        job.refresh_from_db()
+        self.assertEqual(job.status, classification.DONE_STATE)
+        self.assertEqual((job.processed, job.updated), (5, 5))
+
+    def test_ids_file_reports_the_invalid_line(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as ids_file:
+            ids_file.write(f"{self.messages[0].id}\n\nnot-an-id\n")
+            ids_file.flush()
+            with self.assertRaisesMessage(CommandError, "on line 3"):
+                call_command(
+                    "classify_text_messages", "QUESTION", "--ids-file", ids_file.name
+                )
+        self.assertFalse(ClassificationJob.objects.exists())
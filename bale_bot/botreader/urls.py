@@ -1,7 +1,32 @@
 from django.urls import path
-from .views import ReaderAPI
+from rest_framework.routers import SimpleRouter
+from .views import (
+    ChatActivityRollupAPI,
+    ChatEventViewSet,
+    ChatViewSet,
+    ClassificationJobAPI,
+    ClassificationJobListAPI,
+    MembershipViewSet,
+    MetricsAPI,
+    ReaderAPI,
+    TextMessageViewSet,
+    WebhookAPI,
+)
+
+router = SimpleRouter()
+router.register("messages", TextMessageViewSet)
+router.register("chats", ChatViewSet)
+router.register("memberships", MembershipViewSet)
+router.register("chat-events", ChatEventViewSet)
 
 
 urlpatterns = [
     path("update/", ReaderAPI.as_view()),
-]
\ No newline at end of file
+    path("webhook/<str:secret>/", WebhookAPI.as_view()),
+    path("chat-activity/", ChatActivityRollupAPI.as_view()),
+    path("metrics/", MetricsAPI.as_view()),
+    path("classification-jobs/", ClassificationJobListAPI.as_view()),
+    path("classification-jobs/<int:pk>/", ClassificationJobAPI.as_view()),
+]
+
+urlpatterns += router.urls
\ No newline at end of file
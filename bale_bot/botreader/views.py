@@ -1,9 +1,39 @@
+import csv
+import itertools
 import logging
 
-from rest_framework import status
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
+from rest_framework import generics, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
+from django.utils.dateparse import parse_datetime
+from bale_bot.settings import BOTREADER_EXPORT_CHUNK_SIZE
+from .models import (
+    Chat,
+    ChatActivityRollup,
+    ChatEvent,
+    ClassificationJob,
+    Membership,
+    TextMessage,
+)
+from .pagination import DateCursorPagination, IdCursorPagination
+from .serializers import (
+    ChatActivityRollupSerializer,
+    ChatEventSerializer,
+    ChatSerializer,
+    ClassificationJobSerializer,
+    MembershipSerializer,
+    TextMessageSerializer,
+)
 from .services.services import get_new_messages_and_save
+from .services.inbox import store_updates
+from .services import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -15,3 +45,252 @@ class ReaderAPI(APIView):
             logger.error(e)
             return Response(status=500, message="Can't receive data bot data")
         return Response(status=status.HTTP_200_OK)
+
+
+class WebhookAPI(APIView):
+    # Bale pushes updates without credentials, the secret path segment is
+    # what authenticates the caller.
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def post(self, request, secret):
+        webhook_secret = settings.BALE_WEBHOOK_SECRET
+        if not webhook_secret or not constant_time_compare(secret, webhook_secret):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        updates = request.data if isinstance(request.data, list) else [request.data]
+        if not all(isinstance(update, dict) and "update_id" in update for update in updates):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        store_updates(updates)
+        return Response(status=status.HTTP_200_OK)
+
+
+def parse_id(value):
+    return int(value)
+
+
+def parse_bool(value):
+    return {"true": True, "false": False}.get(value.lower())
+
+
+def parse_choice(choices):
+    def parse(value):
+        return value if value in choices else None
+
+    return parse
+
+
+ID_FILTER_ERROR = "Must be an id."
+DATETIME_FILTER_ERROR = "Must be an ISO 8601 datetime."
+
+
+def filter_by_params(queryset, params, filters):
+    # `filters` maps a query parameter to (lookup, parse, error). An __in
+    # lookup takes every value of a repeated parameter, like ?chat=1&chat=2,
+    # parse returns None or raises ValueError for an invalid value.
+    for param, (lookup, parse, error) in filters.items():
+        if param not in params:
+            continue
+        try:
+            values = [parse(value) for value in params.getlist(param)]
+        except ValueError:
+            values = [None]
+        if None in values:
+            raise ValidationError({param: error})
+        value = values if lookup.endswith("__in") else values[-1]
+        queryset = queryset.filter(**{lookup: value})
+    return queryset
+
+
+def get_selected_fields(params, fields):
+    # ?fields=id,date limits the fields returned to those listed
+    if "fields" not in params:
+        return list(fields)
+    selected = [name for name in params["fields"].split(",") if name]
+    if not selected or not set(selected) <= set(fields):
+        raise ValidationError(
+            {
+                "fields": "Must be a comma separated list of {fields}.".format(
+                    fields=", ".join(fields)
+                )
+            }
+        )
+    return selected
+
+
+class ChatActivityRollupAPI(generics.ListAPIView):
+    # Hourly or daily activity of chats, filtered by ?chat=, ?granularity=
+    # (HOUR or DAY, defaults to DAY), ?since= and ?until=.
+    serializer_class = ChatActivityRollupSerializer
+    filters = {
+        "chat": ("chat_id__in", parse_id, "Must be a chat id."),
+        "since": ("period_start__gte", parse_datetime, DATETIME_FILTER_ERROR),
+        "until": ("period_start__lt", parse_datetime, DATETIME_FILTER_ERROR),
+    }
+
+    def get_queryset(self):
+        params = self.request.query_params
+        granularity = params.get("granularity", ChatActivityRollup.Granularity.DAY)
+        if granularity not in ChatActivityRollup.Granularity.values:
+            raise ValidationError({"granularity": "Must be HOUR or DAY."})
+        queryset = ChatActivityRollup.objects.filter(granularity=granularity)
+        queryset = filter_by_params(queryset, params, self.filters)
+        return queryset.order_by("chat_id", "period_start")
+
+
+class Echo:
+    # file-like object for csv.writer, writerow returns the written line
+    def write(self, value):
+        return value
+
+
+EXPORT_CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson; charset=utf-8",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+class ReadOnlyExportViewSet(viewsets.ReadOnlyModelViewSet):
+    # Lists with cursor pagination, ?fields= selection and the query
+    # parameters in `filters`, and streams every matching row from
+    # export/ as NDJSON, or as CSV with ?output=csv.
+    filters = {}
+
+    def get_fields(self):
+        return get_selected_fields(
+            self.request.query_params, self.serializer_class.Meta.fields
+        )
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault("fields", self.get_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = filter_by_params(
+            super().get_queryset(), self.request.query_params, self.filters
+        )
+        # the fields the cursor is read from are loaded with the selection
+        ordering = self.pagination_class.ordering
+        if isinstance(ordering, str):
+            ordering = (ordering,)
+        return queryset.only(
+            *self.get_fields(), *(name.lstrip("-") for name in ordering)
+        )
+
+    @action(detail=False)
+    def export(self, request):
+        output = request.query_params.get("output", "ndjson")
+        if output not in EXPORT_CONTENT_TYPES:
+            raise ValidationError({"output": "Must be ndjson or csv."})
+        fields = self.get_fields()
+        queryset = self.get_queryset()
+        # a server-side cursor hands the rows over in chunks, so memory use
+        # does not grow with the number of rows
+        rows = (
+            queryset.order_by()
+            .values_list(
+                *(queryset.model._meta.get_field(name).attname for name in fields)
+            )
+            .iterator(chunk_size=BOTREADER_EXPORT_CHUNK_SIZE)
+        )
+        if output == "csv":
+            writer = csv.writer(Echo())
+            lines = itertools.chain(
+                [writer.writerow(fields)], (writer.writerow(row) for row in rows)
+            )
+        else:
+            encoder = JSONEncoder()
+            lines = (encoder.encode(dict(zip(fields, row))) + "\n" for row in rows)
+        response = StreamingHttpResponse(
+            lines, content_type=EXPORT_CONTENT_TYPES[output]
+        )
+        response["Content-Disposition"] = (
+            'attachment; filename="{name}.{output}"'.format(
+                name=self.basename, output=output
+            )
+        )
+        return response
+
+
+class TextMessageViewSet(ReadOnlyExportViewSet):
+    queryset = TextMessage.objects.all()
+    serializer_class = TextMessageSerializer
+    pagination_class = DateCursorPagination
+    filters = {
+        "chat": ("chat_id__in", parse_id, ID_FILTER_ERROR),
+        "sender": ("sender_id__in", parse_id, ID_FILTER_ERROR),
+        "type": (
+            "type__in",
+            parse_choice([value for value, _ in TextMessage.TEXT_MESSAGE_TYPE]),
+            "Must be a text message type.",
+        ),
+        "since": ("date__gte", parse_datetime, DATETIME_FILTER_ERROR),
+        "until": ("date__lt", parse_datetime, DATETIME_FILTER_ERROR),
+    }
+
+
+class ChatViewSet(ReadOnlyExportViewSet):
+    queryset = Chat.objects.all()
+    serializer_class = ChatSerializer
+    pagination_class = IdCursorPagination
+    filters = {"type": ("type__in", str, "Must be a chat type.")}
+
+
+class MembershipViewSet(ReadOnlyExportViewSet):
+    queryset = Membership.objects.all()
+    serializer_class = MembershipSerializer
+    pagination_class = IdCursorPagination
+    filters = {
+        "chat": ("chat_id__in", parse_id, ID_FILTER_ERROR),
+        "member": ("member_id__in", parse_id, ID_FILTER_ERROR),
+        "exited": ("exited", parse_bool, "Must be true or false."),
+    }
+
+
+class ChatEventViewSet(ReadOnlyExportViewSet):
+    queryset = ChatEvent.objects.all()
+    serializer_class = ChatEventSerializer
+    pagination_class = DateCursorPagination
+    filters = {
+        "chat": ("chat_id__in", parse_id, ID_FILTER_ERROR),
+        "user": ("user_id__in", parse_id, ID_FILTER_ERROR),
+        "event_type": (
+            "event_type__in",
+            parse_choice(ChatEvent.EventType.values),
+            "Must be ENTRY or EXIT.",
+        ),
+        "since": ("date__gte", parse_datetime, DATETIME_FILTER_ERROR),
+        "until": ("date__lt", parse_datetime, DATETIME_FILTER_ERROR),
+    }
+
+
+class ClassificationJobListAPI(generics.ListCreateAPIView):
+    # POST {"type": ..., "message_ids": [...]} or {"type": ..., "filters": {...}}
+    # queues a job for process_classification_jobs, see
+    # services/classification.py for the filters.
+    permission_classes = [IsAdminUser]
+    serializer_class = ClassificationJobSerializer
+    queryset = ClassificationJob.objects.order_by("-created_at")
+
+
+class ClassificationJobAPI(generics.RetrieveAPIView):
+    # progress of one job
+    permission_classes = [IsAdminUser]
+    serializer_class = ClassificationJobSerializer
+    queryset = ClassificationJob.objects.all()
+
+
+class MetricsAPI(APIView):
+    # Scraped by Prometheus with BOTREADER_METRICS_TOKEN as bearer token.
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        metrics_token = settings.BOTREADER_METRICS_TOKEN
+        authorization = request.META.get("HTTP_AUTHORIZATION", "")
+        if not metrics_token or not constant_time_compare(
+            authorization, "Bearer " + metrics_token
+        ):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        return HttpResponse(
+            metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )